@@ -6,9 +6,28 @@ appfy.recipe
 General utilities shared by all recipes.
 """
 import fnmatch
+import json
 import os
+import re
 import shutil
+import stat
+import struct
+import subprocess
+import sys
+import time
 import zipfile
+import zlib
+
+from appfy.recipe import utils
+
+try:
+    WindowsError
+except NameError:
+    # Like in shutil.
+    WindowsError = None
+
+# Fixed time for reproducible zip files: the earliest date they support.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
 
 def get_relative_path(path, base_path):
@@ -32,7 +51,8 @@ def get_relative_path(path, base_path):
     return 'join(base, %r)' % os.path.join(*r)
 
 
-def copytree(src, dst, dirname, symlinks=False, ignore=None, logger=None):
+def copytree(src, dst, dirname, symlinks=False, ignore=None, logger=None,
+             mode='copy'):
     """Recursively copy a directory tree using copy2().
 
     The destination directory must not already exist.
@@ -50,10 +70,13 @@ def copytree(src, dst, dirname, symlinks=False, ignore=None, logger=None):
 
         callable(src, names) -> ignored_names
 
-    Since copytree() is called recursively, the callable will be
-    called once for each directory that is copied. It returns a
-    list of names relative to the `src` directory that should
-    not be copied.
+    The tree is walked with utils.walk(), so the callable is called
+    once for each directory that is copied and each file is stat()ed
+    at most once. It returns a list of names relative to the `src`
+    directory that should not be copied.
+
+    The optional mode argument is one of `utils.INSTALL_MODES`. If it is not
+    'copy', files are linked instead of copied when possible.
 
     XXX Consider this example code rather than the ultimate tool.
 
@@ -67,112 +90,712 @@ def copytree(src, dst, dirname, symlinks=False, ignore=None, logger=None):
                 os.path.dirname(src)[len(dirname):], [os.path.basename(src)])
 
         if src[len(dirname):] not in ignored_names:
-            shutil.copyfile(src, dst)
+            if mode == 'copy':
+                shutil.copyfile(src, dst)
+            else:
+                utils.install_file(src, dst, mode)
 
         return
 
-    names = os.listdir(src)
-    if ignore is not None:
-        ignored_names = ignore(src[len(dirname):], names)
-
-    if os.path.isdir(dst):
-        if logger:
-            logger.info('%r already exists and will not be created.' % dst)
-    else:
-        os.makedirs(dst)
-
     errors = []
-    for name in names:
-        srcname = os.path.join(src, name)
-        dstname = os.path.join(dst, name)
-        if srcname[len(dirname):] in ignored_names:
-            continue
-        try:
-            if symlinks and os.path.islink(srcname):
-                linkto = os.readlink(srcname)
-                os.symlink(linkto, dstname)
-            elif os.path.isdir(srcname):
-                copytree(
-                    srcname, dstname, dirname, symlinks, ignore, logger=logger)
-            else:
-                if os.path.isfile(dstname):
+    copied_dirs = []
+
+    def onerror(err):
+        errors.append((err.filename, err.filename, str(err)))
+
+    for root, dirs, files in utils.walk(src, dirname, ignore,
+                                        followlinks=not symlinks,
+                                        onerror=onerror):
+        dstroot = dst + root[len(src):]
+        if os.path.isdir(dstroot):
+            if logger:
+                logger.info('%r already exists and will not be created.',
+                            dstroot)
+
+            existing = set(entry.name for entry in utils.scandir(dstroot)
+                           if entry.is_file())
+        else:
+            try:
+                os.makedirs(dstroot)
+            except os.error as why:
+                errors.append((root, dstroot, str(why)))
+                del dirs[:]
+                continue
+
+            existing = ()
+
+        copied_dirs.append((root, dstroot))
+        for entry in dirs + files:
+            dstname = os.path.join(dstroot, entry.name)
+            try:
+                if symlinks and entry.is_symlink():
+                    linkto = os.readlink(entry.path)
+                    os.symlink(linkto, dstname)
+                elif entry.is_dir():
+                    # Created when visited.
+                    pass
+                elif entry.name in existing:
                     if logger:
                         logger.info(
                             '%r already exists and will not be created.',
                             dstname)
+                elif mode == 'copy':
+                    shutil.copy2(entry.path, dstname)
                 else:
-                    shutil.copy2(srcname, dstname)
-            # XXX What about devices, sockets etc.?
+                    utils.install_file(entry.path, dstname, mode)
+                # XXX What about devices, sockets etc.?
+            except (IOError, os.error) as why:
+                errors.append((entry.path, dstname, str(why)))
+
+    # Children first, like the recursive version.
+    for root, dstroot in reversed(copied_dirs):
+        try:
+            shutil.copystat(root, dstroot)
+        except OSError as why:
+            if WindowsError is not None and isinstance(why, WindowsError):
+                # Copying file access times may fail on Windows
+                pass
+            else:
+                errors.extend((root, dstroot, str(why)))
+    if errors:
+        raise shutil.Error, errors
+
+
+def iter_files(src, dirname, ignore=None):
+    """Yields the files that copytree() would copy from `src`.
+
+    Each file is yielded as a ``(srcname, relname)`` tuple, where `relname`
+    is the path relative to `dirname`. The optional ignore argument has the
+    same meaning as in copytree().
+
+    `src` can also be inside a zip file, like a zipped egg. Then its files
+    are yielded with paths inside the zip file, which can be read with
+    utils.open_file(); nothing is extracted.
+    """
+    relname = src[len(dirname):]
+    if ignore is not None and relname in ignore(
+            os.path.dirname(src)[len(dirname):], [os.path.basename(src)]):
+        # Skip ignored subtrees before listing them.
+        return
+
+    zip_path = utils.split_zip_path(src)
+    if zip_path is not None:
+        for item in _iter_zip_files(zip_path, dirname, ignore):
+            yield item
+    elif os.path.isfile(src):
+        yield src, relname
+    else:
+        for item in _iter_files(src, dirname, ignore):
+            yield item
+
+
+def _iter_files(src, dirname, ignore):
+    # Ignored directories are pruned by walk() without being listed.
+    for root, dirs, files in utils.walk(src, dirname, ignore):
+        for entry in files:
+            yield entry.path, entry.path[len(dirname):]
+
+
+def _iter_zip_files(zip_path, dirname, ignore):
+    archive, name = zip_path
+    prefix = archive + os.sep
+    for member in utils.get_zip_file(archive).namelist():
+        if member.endswith('/') or not (member == name or
+                                        member.startswith(name + '/')):
+            continue
+
+        srcname = prefix + member.replace('/', os.sep)
+        relname = srcname[len(dirname):]
+        if ignore is not None:
+            # Check each directory, like when walking a directory tree.
+            parts = relname.split(os.sep)
+            path = ''
+            for part in parts:
+                if os.path.join(path, part) in ignore(path, [part]):
+                    break
+
+                path = os.path.join(path, part)
+            else:
+                yield srcname, relname
+        else:
+            yield srcname, relname
+
+
+def sync_files(files, dst, manifest, workers=1, mode='copy', logger=None):
+    """Incrementally mirrors a list of files into the `dst` directory.
+
+    `files` is a list of ``(srcname, relname)`` tuples, as returned by
+    iter_files(), and `manifest` is the dict returned by the previous call,
+    mapping each installed `relname` to the source path, size, mtime and sha1
+    of the file copied there. Only files that were added or changed are
+    copied and files that are no longer listed are removed from `dst`.
+
+    Returns the new manifest. If exception(s) occur, an Error is raised with
+    a list of reasons. Changed files are copied by `workers` threads, or
+    linked if `mode` is not 'copy', like in copy_files().
+    """
+    result = {}
+    changed = []
+    for srcname, relname in files:
+        dstname = os.path.join(dst, relname)
+        if relname in result:
+            if logger:
+                logger.info('%r already exists and will not be created.',
+                            dstname)
+            continue
+
+        st = utils.stat_file(srcname)
+        entry = {
+            'src': srcname,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'sha1': None,
+        }
+        result[relname] = entry
+
+        old = manifest.get(relname)
+        if old is None or old['size'] != st.st_size:
+            changed.append((srcname, relname, entry))
+            continue
+
+        try:
+            if os.stat(dstname).st_size != st.st_size:
+                raise OSError
+        except OSError:
+            # Removed or modified in the destination.
+            changed.append((srcname, relname, entry))
+            continue
+
+        if old['src'] == srcname and old['mtime'] == st.st_mtime:
+            entry['sha1'] = old['sha1']
+            continue
+
+        # Touched or moved to a new egg: only copy if the content changed.
+        entry['sha1'] = utils.get_checksum(srcname)
+        if old['sha1'] is None or entry['sha1'] != old['sha1']:
+            changed.append((srcname, relname, entry))
+
+    dstnames = dict((os.path.join(dst, item[1]), item[1]) for item in changed)
+    errors = _copy_files(
+        [(srcname, os.path.join(dst, relname), info)
+         for srcname, relname, info in changed],
+        workers=workers,
+        mode=mode,
+        replace=True,
+        logger=logger
+    )
+    for srcname, dstname, why in errors:
+        result.pop(dstnames.get(dstname), None)
+
+    removed = [relname for relname in manifest if relname not in result]
+    for relname in removed:
+        dstname = os.path.join(dst, relname)
+        try:
+            if os.path.isfile(dstname):
+                os.remove(dstname)
+
+            if relname.endswith('.py'):
+                # Stale bytecode would keep the removed module importable.
+                for bytecode in (dstname + 'c', dstname + 'o'):
+                    if os.path.isfile(bytecode):
+                        os.remove(bytecode)
+
+            # Prune directories left empty.
+            dirname = os.path.dirname(dstname)
+            while dirname.startswith(dst) and dirname != dst and \
+                    not os.listdir(dirname):
+                os.rmdir(dirname)
+                dirname = os.path.dirname(dirname)
+        except (IOError, os.error) as why:
+            errors.append((dstname, dstname, str(why)))
+
+    if logger:
+        logger.info('Synced %r: %d copied, %d removed, %d unchanged.',
+                    dst, len(changed), len(removed),
+                    len(result) - len(changed))
+
+    if errors:
+        raise shutil.Error(errors)
+
+    return result
+
+
+def copy_files(files, dst, workers=1, mode='copy', logger=None):
+    """Copies a list of files into the `dst` directory.
+
+    `files` is a list of ``(srcname, relname)`` tuples, as returned by
+    iter_files(). Files that already exist in `dst` are not copied again,
+    and the copy itself is split across `workers` threads.
+
+    The optional mode argument is one of `utils.INSTALL_MODES`. If it is not
+    'copy', files are linked instead of copied, falling back to a copy for
+    each file that can't be linked.
+
+    If exception(s) occur, an Error is raised with a list of reasons.
+    """
+    start = time.time()
+    seen = set()
+    to_copy = []
+    packages = []
+    for srcname, relname in files:
+        dstname = os.path.join(dst, relname)
+        if relname in seen:
+            if logger:
+                logger.info('%r already exists and will not be created.',
+                            dstname)
+            continue
+
+        seen.add(relname)
+        to_copy.append((srcname, dstname, None))
+        package = relname.split(os.sep)[0]
+        if package not in packages:
+            packages.append(package)
+
+    if logger:
+        for package in packages:
+            logger.info('Copying %r...' % package)
+
+    errors = _copy_files(to_copy, workers=workers, mode=mode, logger=logger)
+    errors.extend(_copy_dir_stats(files, dst))
+
+    if logger:
+        elapsed = max(time.time() - start, 0.001)
+        logger.info('Copied %d files to %r in %.2fs (%d files/s).',
+                    len(to_copy) - len(errors), dst, elapsed,
+                    (len(to_copy) - len(errors)) / elapsed)
+
+    if errors:
+        raise shutil.Error(errors)
+
+
+def _copy_dir_stats(files, dst):
+    """Copies the permission bits and times of the source directories.
+
+    Directories are done after their files, children first, like in
+    copytree(). Files inside zip files or whose source is not in a directory
+    tree like the destination, e.g. slimmed files, are skipped.
+
+    Returns a list of errors.
+    """
+    dirs = {}
+    for srcname, relname in files:
+        if not srcname.endswith(os.sep + relname) or \
+                utils.split_zip_path(srcname, check=False) is not None:
+            continue
+
+        srcroot = srcname[:len(srcname) - len(relname)]
+        relname = os.path.dirname(relname)
+        while relname and relname not in dirs:
+            dirs[relname] = os.path.join(srcroot, relname)
+            relname = os.path.dirname(relname)
+
+    errors = []
+    for relname in sorted(dirs, reverse=True):
+        dstname = os.path.join(dst, relname)
+        try:
+            shutil.copystat(dirs[relname], dstname)
+        except OSError as why:
+            if WindowsError is not None and isinstance(why, WindowsError):
+                # Copying file access times may fail on Windows
+                pass
+            else:
+                errors.append((dirs[relname], dstname, str(why)))
+
+    return errors
+
+
+def _copy_files(files, workers=1, mode='copy', replace=False, logger=None):
+    """Copies ``(srcname, dstname, entry)`` tuples using a pool of threads.
+
+    If `replace` is false, existing files are kept; otherwise they are
+    replaced in a single step, so that readers never see a partially written
+    file. The checksum of each copied file is stored in `entry`, if given;
+    linked files have no checksum.
+
+    Returns a list of errors.
+    """
+    # Create directories upfront, so that threads don't race for them.
+    dirnames = set(os.path.dirname(dstname) for _, dstname, _ in files)
+    errors = []
+    for dirname in sorted(dirnames):
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except (IOError, os.error) as why:
+                errors.append((dirname, dirname, str(why)))
+
+    def copy(item):
+        srcname, dstname, entry = item
+        try:
+            if not replace and os.path.isfile(dstname):
+                if logger:
+                    logger.info('%r already exists and will not be created.',
+                                dstname)
+                return
+
+            tmpname = dstname + '.tmp'
+            if mode != 'copy':
+                if not utils.install_file(srcname, tmpname, mode):
+                    fallbacks.append(srcname)
+            elif entry is None:
+                utils.copy_file(srcname, tmpname, hashtype=None)
+            else:
+                entry['sha1'] = utils.copy_file(srcname, tmpname)
+            utils.rename(tmpname, dstname)
         except (IOError, os.error) as why:
-            errors.append((srcname, dstname, str(why)))
-        # catch the Error from the recursive copytree so that we can
-        # continue with other files
-        except shutil.Error as err:
-            errors.extend(err.args[0])
+            return srcname, dstname, str(why)
+
+    fallbacks = []
+    results = utils.map_threads(copy, files, workers)
+    errors.extend(error for error in results if error is not None)
+
+    if fallbacks and logger:
+        logger.info('%d files could not be installed using %r mode and were '
+                    'copied instead.', len(fallbacks), mode)
+
+    return errors
+
+
+class PatternMatcher(object):
+    """Matches paths against a list of glob-style patterns.
+
+    All patterns are compiled into a single regular expression, so each path
+    is tested only once, no matter how many patterns there are.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+        if self.patterns:
+            self.regex = re.compile('|'.join(
+                _translate(os.path.normcase(p)) for p in self.patterns),
+                re.S)
+        else:
+            self.regex = None
+
+    def match(self, path):
+        """Returns True if `path` matches any of the patterns."""
+        if self.regex is None:
+            return False
+
+        return self.regex.match(os.path.normcase(path)) is not None
+
+    def __call__(self, path, names):
+        if self.regex is None:
+            return set()
+
+        match = self.regex.match
+        normcase = os.path.normcase
+        ignored_names = set()
+        for name in names:
+            name = os.path.join(path, name)
+            if match(normcase(name)) is not None:
+                ignored_names.add(name)
+
+        return ignored_names
+
+
+def _translate(pattern):
+    """Translates a glob-style pattern to a regular expression group."""
+    res = fnmatch.translate(pattern)
+    # Python 2.7 appends inline flags, which would apply to the whole
+    # combined expression anyway.
+    if res.endswith('(?ms)'):
+        res = res[:-len('(?ms)')]
+
+    return '(?:%s)' % res
+
+
+_matchers = {}
+
+
+# Compiles the (source, cfile, dfile, mtime) files read from stdin, skipping
+# bytecode that is up to date, and writes the number of compiled files and
+# the list of errors to stdout. It runs in a separate interpreter so that it
+# can use -O or -OO.
+_COMPILE_SCRIPT = """
+import errno, imp, json, marshal, os, py_compile, struct, sys, zipfile
+encoding = sys.getfilesystemencoding() or 'utf-8'
+archives = {}
+
+def compile_zipped(source, cfile, dfile, mtime):
+    archive = os.path.dirname(source)
+    while not os.path.isfile(archive):
+        if os.path.dirname(archive) == archive:
+            raise IOError(errno.ENOENT, 'No such file or directory', source)
+        archive = os.path.dirname(archive)
+    if archive not in archives:
+        archives[archive] = zipfile.ZipFile(archive, 'r')
+    name = source[len(archive) + len(os.sep):].replace(os.sep, '/')
+    code = archives[archive].read(name).replace('\\r\\n', '\\n')
+    try:
+        code = compile(code.rstrip('\\n') + '\\n', dfile, 'exec')
+    except Exception as e:
+        raise py_compile.PyCompileError(e.__class__, e, dfile)
+    f = open(cfile, 'wb')
+    f.write(imp.get_magic() + mtime)
+    marshal.dump(code, f)
+    f.close()
+
+compiled = 0
+errors = []
+for source, cfile, dfile, mtime in json.load(sys.stdin):
+    source, cfile, dfile = [p.encode(encoding) for p in (source, cfile, dfile)]
+    if mtime is None:
+        mtime = int(os.stat(source).st_mtime)
+    mtime = struct.pack('<I', mtime & 0xFFFFFFFF)
+    if os.path.isfile(cfile):
+        f = open(cfile, 'rb')
+        header = f.read(8)
+        f.close()
+        if header == imp.get_magic() + mtime:
+            continue
+    # Written to a new file: it may be a link to the bytecode in an egg or to
+    # an object of the shared store.
+    try:
+        os.unlink(cfile)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            errors.append((source, str(e)))
+            continue
     try:
-        shutil.copystat(src, dst)
-    except OSError as why:
-        if WindowsError is not None and isinstance(why, WindowsError):
-            # Copying file access times may fail on Windows
-            pass
+        if os.path.exists(source):
+            py_compile.compile(source, cfile, dfile, doraise=True)
         else:
-            errors.extend((src, dst, str(why)))
-    if errors:
-        raise shutil.Error, errors
+            compile_zipped(source, cfile, dfile, mtime)
+    except py_compile.PyCompileError as e:
+        lines = e.msg.strip().splitlines()
+        errors.append((source, '%s: %s' % (lines[0].strip(), lines[-1])))
+        continue
+    except (IOError, KeyError) as e:
+        # Missing source file or zip member.
+        errors.append((source, str(e)))
+        continue
+    f = open(cfile, 'r+b')
+    f.seek(4)
+    f.write(mtime)
+    f.close()
+    compiled += 1
+sys.stdout.write(json.dumps([compiled, errors]))
+"""
+
+
+def compile_files(files, optimize=0, workers=1):
+    """Byte-compiles python files using `workers` processes.
+
+    `files` is a list of ``(source, cfile, dfile, mtime)`` tuples: the source
+    file, the bytecode file to write, the file name shown in tracebacks and
+    the source timestamp stored in the bytecode, or None to use the source
+    mtime. Bytecode that is already up to date is not compiled again.
+    Sources inside zip files need an explicit mtime.
+
+    `optimize` is the optimization level: 0, 1 (-O) or 2 (-OO).
+
+    Returns the number of compiled files and a list of ``(source, error)``
+    tuples for files that failed to compile.
+    """
+    if not files:
+        return 0, []
+
+    args = [sys.executable] + ['-O'] * optimize + ['-c', _COMPILE_SCRIPT]
+    workers = max(min(workers, len(files)), 1)
+    chunks = [files[i::workers] for i in range(workers)]
+
+    def run(chunk):
+        process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = process.communicate(json.dumps(chunk))
+        if process.returncode != 0:
+            return 0, [(item[0], err.strip()) for item in chunk]
+
+        return json.loads(out)
+
+    compiled = 0
+    errors = []
+    for count, chunk_errors in utils.map_threads(run, chunks, workers):
+        compiled += count
+        errors.extend(chunk_errors)
+
+    return compiled, errors
 
 
 def ignore_patterns(*patterns):
     """Function that can be used as copytree() ignore parameter.
 
     Patterns is a sequence of glob-style patterns
-    that are used to exclude files
+    that are used to exclude files. Matchers are compiled once and cached,
+    so the same instance is returned for the same patterns.
 
     Adapted from Python 2.6 source.
     """
-    def _ignore_patterns(path, names):
-        names = [os.path.join(path, name) for name in names]
-        ignored_names = []
-        for pattern in patterns:
-            ignored_names.extend(fnmatch.filter(names, pattern))
+    matcher = _matchers.get(patterns)
+    if matcher is None:
+        matcher = _matchers[patterns] = PatternMatcher(patterns)
 
-        return set(ignored_names)
-    return _ignore_patterns
+    return matcher
 
 
 include_patterns = ignore_patterns
 
 
 def rmfiles(src, only=None):
-    names = os.listdir(src)
+    """Removes the files and directories inside `src` matched by `only`.
 
-    if only is not None:
-        only_names = only(src, names)
-    else:
-        only_names = set()
+    `only` is called like the copytree() ignore parameter, with absolute
+    paths, and returns the paths to remove.
+    """
+    if only is None:
+        return
+
+    for root, dirs, files in utils.walk(src):
+        only_names = only(root, [entry.name for entry in dirs + files])
+        if not only_names:
+            continue
+
+        for entry in files:
+            if entry.path in only_names and entry.is_file():
+                os.remove(entry.path)
+
+        for entry in list(dirs):
+            if entry.path in only_names:
+                shutil.rmtree(entry.path)
+                dirs.remove(entry)
 
-    for name in names:
-        srcname = os.path.join(src, name)
-        if srcname in only_names:
-            if os.path.isfile(srcname):
-                os.remove(srcname)
-            elif os.path.isdir(srcname):
-                shutil.rmtree(srcname)
-        elif os.path.isdir(srcname):
-            rmfiles(srcname, only=only)
 
+def zipdir(dirname, filename, previous=None, workers=1, logger=None):
+    """Creates a zip file with all files inside `dirname`.
 
-def zipdir(dirname, filename):
+    See zipfiles() for the meaning of `previous` and `workers`.
+    """
     assert os.path.isdir(dirname)
+    files = []
+    for root, dirs, entries in utils.walk(dirname, followlinks=False):
+        # NOTE: ignore empty directories
+        for entry in entries:
+            files.append((entry.path, entry.path[len(dirname)+len(os.sep):]))
+
+    zipfiles(files, filename, previous=previous, workers=workers,
+             logger=logger)
+
+
+def zipfiles(files, filename, previous=None, data=None, workers=1,
+             logger=None):
+    """Creates a reproducible zip file from a list of files.
+
+    `files` is a list of ``(srcname, arcname)`` tuples, which are read
+    directly from their sources, and `data` an optional dict of contents
+    keyed by arcname. Members are sorted by name and stored with fixed times
+    and permissions, so that the same files always result in an identical
+    archive.
+
+    If `previous` is the path of an archive created before, the compressed
+    data of members with the same name, size and CRC is copied from it
+    instead of compressing the files again.
+
+    Members are compressed by `workers` threads (zlib releases the GIL while
+    compressing) and written in order as they are ready.
+    """
+    members = {}
+    for srcname, arcname in files:
+        arcname = arcname.replace(os.sep, '/')
+        if arcname in members:
+            if logger:
+                logger.info('%r already exists and will not be created.',
+                            arcname)
+            continue
+
+        members[arcname] = srcname
+
+    contents = {}
+    for arcname, content in (data or {}).items():
+        contents[arcname.replace(os.sep, '/')] = content
+        members.setdefault(arcname.replace(os.sep, '/'), None)
+
+    old = None
+    if previous is not None and os.path.isfile(previous):
+        try:
+            old = zipfile.ZipFile(previous, 'r')
+        except (IOError, zipfile.BadZipfile):
+            old = None
+
+    def compress(arcname):
+        if arcname in contents:
+            data = contents[arcname]
+        else:
+            f = utils.open_file(members[arcname])
+            try:
+                data = f.read()
+            finally:
+                f.close()
+
+        crc = zlib.crc32(data) & 0xffffffff
+        if old is not None:
+            try:
+                info = old.getinfo(arcname)
+            except KeyError:
+                info = None
+
+            if (info is not None and info.CRC == crc and
+                    info.file_size == len(data) and
+                    info.compress_type == zipfile.ZIP_DEFLATED):
+                # Reused from the previous archive.
+                return arcname, crc, len(data), info
+
+        return arcname, crc, len(data), _deflate(data)
+
+    reused = 0
     z = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
     try:
-        for root, dirs, files in os.walk(dirname):
-            # NOTE: ignore empty directories
-            for f in files:
-                absf = os.path.join(root, f)
-                zf = absf[len(dirname)+len(os.sep):]
-                z.write(absf, zf)
+        for arcname, crc, size, raw in utils.imap_threads(
+                compress, sorted(members), workers):
+            if isinstance(raw, zipfile.ZipInfo):
+                raw = _read_raw_member(old, raw)
+                reused += 1
+
+            _write_raw_member(z, arcname, crc, size, raw)
 
         z.close()
     finally:
-        if z:
-            z.close()
+        z.close()
+        if old is not None:
+            old.close()
+
+    if logger:
+        logger.info('Created %r: %d files, %d compressed, %d reused.',
+                    filename, len(members), len(members) - reused, reused)
+
+
+def _deflate(data):
+    """Compresses data the same way as zipfile.ZipFile.write()."""
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _read_raw_member(z, info):
+    """Returns the compressed data of a zip member."""
+    z.fp.seek(info.header_offset)
+    header = z.fp.read(zipfile.sizeFileHeader)
+    if header[0:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile('Bad magic number for file header')
+
+    # Skip the file name and extra field of the local header.
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    z.fp.seek(name_length + extra_length, os.SEEK_CUR)
+    return z.fp.read(info.compress_size)
+
+
+def _write_raw_member(z, arcname, crc, size, raw):
+    """Appends already compressed data as a new member of a zip file."""
+    zinfo = zipfile.ZipInfo(arcname, ZIP_DATE_TIME)
+    zinfo.create_system = 3
+    zinfo.external_attr = (stat.S_IFREG | 0o644) << 16
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = len(raw)
+    zinfo.header_offset = z.fp.tell()
+    z.fp.write(zinfo.FileHeader())
+    z.fp.write(raw)
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
@@ -2,13 +2,18 @@
 import logging
 import os.path
 import shutil
+import tarfile
 import tempfile
 import urlparse
+import zipfile
 
 import setuptools.archive_util
 import zc.buildout
 from zc.buildout import download as zc_download
 
+from appfy.recipe import extract
+from appfy.recipe import fetch
+from appfy.recipe import instrument
 from appfy.recipe import utils
 
 
@@ -34,6 +39,8 @@ class Recipe(object):
         self.option_url = options.get('url')
         self.option_md5sum = options.get('md5sum')
         self.option_sha1sum = options.get('sha1sum')
+        self.option_sha256sum = options.get('sha256sum')
+        self.option_sha512sum = options.get('sha512sum')
         default_destinantion = os.path.join(
             buildout['buildout']['parts-directory'], self.name)
         self.option_destination = options.setdefault(
@@ -47,12 +54,54 @@ class Recipe(object):
         self.option_hash_name = utils.get_bool_option(
             options.setdefault('hash-name', 'false'))
         self.option_filename = options.get('filename', '').strip()
+        self.option_download_segments = int(
+            options.get('download-segments', '0').strip() or 0)
+        self.option_stream_extract = utils.get_bool_option(
+            options.setdefault('stream-extract', 'false'))
+        self.option_paranoid_verify = utils.get_bool_option(
+            options.setdefault('paranoid-verify', 'false'))
+        self.option_incremental_extract = utils.get_bool_option(
+            options.setdefault('incremental-extract', 'false'))
+        # Only replaces the files in the destination with clear-destination.
+        self.incremental_extract = (self.option_incremental_extract and
+                                    self.option_clear_destination)
+        if self.incremental_extract:
+            # Out of the destination, which is removed when the part is
+            # uninstalled.
+            self.extract_dir = options.setdefault(
+                'extract-directory', os.path.join(
+                    buildout['buildout']['parts-directory'],
+                    self.name + '.extract'))
+        # Set when the package is extracted while it is downloaded.
+        self.extracted_dir = None
+
+        # Expected checksums of the download, by hash type.
+        self.checksums = {}
+        for hashtype in utils.HASH_TYPES:
+            checksum = getattr(self, 'option_%ssum' % hashtype)
+            if checksum and checksum.strip():
+                self.checksums[hashtype] = checksum.strip().lower()
+        self.timer = instrument.Timer(
+            options.get('recipe', 'appfy.recipe:download'), name, self.logger,
+            options.get('timing-log', '').strip() or None)
 
     def install(self):
+        self.timer.restart()
+        try:
+            return self.install_download()
+        finally:
+            self.timer.finish()
+
+    def install_download(self):
         if not os.path.exists(self.download_cache):
             os.makedirs(self.download_cache)
 
-        cached_path, is_temp = self.download()
+        try:
+            cached_path, is_temp = self.download()
+        except Exception:
+            if self.extracted_dir is not None:
+                shutil.rmtree(self.extracted_dir)
+            raise
 
         parts = []
 
@@ -75,20 +124,25 @@ class Recipe(object):
 
                 # Copy the file to destination without extraction
                 target_path = os.path.join(self.option_destination, filename)
-                shutil.copy(cached_path, target_path)
+                with self.timer.phase('copy') as phase:
+                    shutil.copy(cached_path, target_path)
+                    phase.count(files=1,
+                                bytes=os.path.getsize(target_path))
                 if self.option_destination not in parts:
                     parts.append(target_path)
+            elif (self.incremental_extract and
+                    extract.get_archive_format(cached_path) is not None):
+                self.logger.info(
+                    'Extracting package to %s', self.option_destination)
+                for path in self.extract_incremental(cached_path):
+                    if path not in parts:
+                        parts.append(path)
             else:
-                # Extract the package
-                extract_dir = tempfile.mkdtemp("buildout-" + self.name)
-                try:
-                    setuptools.archive_util.unpack_archive(
-                        cached_path, extract_dir)
-                except setuptools.archive_util.UnrecognizedFormat:
-                    self.logger.error(
-                        'Unable to extract the package %s. Unknown format.',
-                        cached_path)
-                    raise zc.buildout.UserError('Package extraction error')
+                # Extract the package, if not done while downloading.
+                extract_dir = self.extracted_dir
+                if extract_dir is None:
+                    extract_dir = tempfile.mkdtemp("buildout-" + self.name)
+                    self.unpack(cached_path, extract_dir)
 
                 base = self.calculate_base(extract_dir)
 
@@ -98,30 +152,8 @@ class Recipe(object):
                 self.logger.info(
                     'Extracting package to %s', self.option_destination)
 
-                for filename in os.listdir(base):
-                    dest = os.path.join(self.option_destination, filename)
-                    if os.path.exists(dest):
-                        if self.option_clear_destination:
-                            shutil.rmtree(dest)
-                            self.logger.info('Removed: %r.' % dest)
-                            parts.append(dest)
-                        else:
-                            self.logger.error(
-                                'Target %s already exists. Either remove it '
-                                'or set ``clear-destination = true`` in your '
-                                'buildout.cfg to remove existing files and '
-                                'directories before moving downloaded files.',
-                                dest)
-                            raise zc.buildout.UserError(
-                                'File or directory already exists.')
-                    else:
-                        # Only add the file/directory to the list of installed
-                        # parts if it does not already exist. This way it does
-                        # not get accidentally removed when uninstalling.
-                        parts.append(dest)
-
-                    if not os.path.exists(dest):
-                        shutil.move(os.path.join(base, filename), dest)
+                with self.timer.phase('move') as phase:
+                    phase.count(files=self.move_extracted(base, parts))
 
                 shutil.rmtree(extract_dir)
 
@@ -134,6 +166,82 @@ class Recipe(object):
     def update(self):
         pass
 
+    def unpack(self, cached_path, extract_dir):
+        try:
+            with self.timer.phase('extract') as phase:
+                def progress_filter(src, dst):
+                    phase.count(files=1)
+                    return dst
+
+                setuptools.archive_util.unpack_archive(
+                    cached_path, extract_dir, progress_filter)
+        except setuptools.archive_util.UnrecognizedFormat:
+            self.logger.error(
+                'Unable to extract the package %s. Unknown format.',
+                cached_path)
+            raise zc.buildout.UserError('Package extraction error')
+
+    def extract_incremental(self, cached_path):
+        """Extracts the package, only writing the files that changed.
+
+        Returns the top-level files and directories extracted. When the part
+        is uninstalled, uninstall() moves them to `extract-directory`; they
+        are moved back here, to be compared with the package.
+        """
+        try:
+            with self.timer.phase('extract') as phase:
+                extractor = get_incremental_extractor(
+                    cached_path, self.option_destination, self.extract_dir,
+                    strip=self.option_strip_top_level_dir, phase=phase)
+                extractor.restore(os.path.join(self.extract_dir, 'files'))
+                kept = extractor()
+        except extract.ExtractError as e:
+            self.logger.error(str(e))
+            raise zc.buildout.UserError('Invalid package contents')
+        except (tarfile.TarError, zipfile.BadZipfile) as e:
+            self.logger.error('Unable to extract the package %s: %s',
+                              cached_path, e)
+            raise zc.buildout.UserError('Package extraction error')
+
+        self.logger.info('%d files written, %d unchanged and %d removed.',
+                         extractor.written, kept, extractor.removed)
+        return [os.path.join(self.option_destination, name)
+                for name in extractor.get_top_level()]
+
+    def move_extracted(self, base, parts):
+        """Moves the extracted files to the destination.
+
+        Returns the number of files and directories moved.
+        """
+        moved = 0
+        for filename in os.listdir(base):
+            dest = os.path.join(self.option_destination, filename)
+            if os.path.exists(dest):
+                if self.option_clear_destination:
+                    shutil.rmtree(dest)
+                    self.logger.info('Removed: %r.' % dest)
+                    parts.append(dest)
+                else:
+                    self.logger.error(
+                        'Target %s already exists. Either remove it '
+                        'or set ``clear-destination = true`` in your '
+                        'buildout.cfg to remove existing files and '
+                        'directories before moving downloaded files.',
+                        dest)
+                    raise zc.buildout.UserError(
+                        'File or directory already exists.')
+            else:
+                # Only add the file/directory to the list of installed
+                # parts if it does not already exist. This way it does
+                # not get accidentally removed when uninstalling.
+                parts.append(dest)
+
+            if not os.path.exists(dest):
+                shutil.move(os.path.join(base, filename), dest)
+                moved += 1
+
+        return moved
+
     def calculate_base(self, extract_dir):
         """Get base directory
 
@@ -160,12 +268,140 @@ class Recipe(object):
         d = zc_download.Download(
             self.buildout['buildout'],
             hash_name=self.option_hash_name)
-        cached_path, is_temp = d(self.option_url, md5sum=self.option_md5sum)
+        verified = False
+        was_cached = d.cache_dir and os.path.exists(
+            os.path.join(d.cache_dir, d.filename(self.option_url)))
+        with self.timer.phase('download') as phase:
+            if (self.option_download_segments and d.cache_dir and
+                    not d.offline and fetch.is_http_url(self.option_url)):
+                verified = self.fetch_to_cache(d)
+
+            # The md5sum is checked below, with the other checksums.
+            cached_path, is_temp = d(self.option_url)
+            phase.count(files=1, bytes=os.path.getsize(cached_path))
+
+        if self.checksums and not verified:
+            # Checksums recorded for the cached file are trusted, unless it
+            # changed since then.
+            with self.timer.phase('checksum') as phase:
+                checksums = utils.get_checksums(
+                    cached_path, sorted(self.checksums),
+                    cache=not is_temp and not self.option_paranoid_verify)
+                phase.count(files=1, bytes=os.path.getsize(cached_path))
 
-        if (self.option_sha1sum and
-           self.option_sha1sum != utils.get_checksum(cached_path)):
-            raise zc_download.ChecksumError(
-                'SHA1 checksum mismatch for cached download '
-                'from %r at %r' % (self.option_url, cached_path))
+            try:
+                self.check_checksums(cached_path, checksums)
+            except zc_download.ChecksumError:
+                # Like zc.buildout, don't keep new downloads that don't match.
+                if is_temp or not was_cached:
+                    os.remove(cached_path)
+                    utils.remove_checksums(cached_path)
+                raise
 
         return cached_path, is_temp
+
+    def check_checksums(self, path, checksums):
+        """Raises ChecksumError if `checksums` are not the expected ones."""
+        for hashtype, checksum in sorted(self.checksums.items()):
+            if checksums.get(hashtype) != checksum:
+                raise zc_download.ChecksumError(
+                    '%s checksum mismatch for download from %r at %r' % (
+                        hashtype.upper(), self.option_url, path))
+
+    def fetch_to_cache(self, d):
+        """Downloads the file into the cache of `d` in ranged segments.
+
+        Then `d` finds it in the cache. Interrupted downloads are resumed.
+        With `stream-extract`, zip and tar files are extracted at the same
+        time to `extracted_dir`. Returns True if the file was fetched, and
+        its checksums were verified while it was fetched.
+        """
+        if not os.path.isdir(d.cache_dir):
+            os.makedirs(d.cache_dir)
+
+        cached_path = os.path.join(d.cache_dir, d.filename(self.option_url))
+        if os.path.exists(cached_path):
+            return False
+
+        stream_format = None
+        if (self.option_stream_extract and not self.option_download_only and
+                not self.incremental_extract):
+            stream_format = extract.get_stream_format(self.option_url)
+
+        f = fetch.Fetch(self.option_url, cached_path,
+                        segments=self.option_download_segments,
+                        zip_tail=stream_format == 'zip',
+                        hashtypes=sorted(self.checksums), logger=self.logger)
+        extractor = None
+        if stream_format is not None:
+            extract_dir = tempfile.mkdtemp("buildout-" + self.name)
+            extractor = extract.StreamExtractor(
+                f, stream_format, extract_dir,
+                phase=self.timer.phase('extract'))
+            extractor.start()
+
+        try:
+            f.fetch()
+        except fetch.NETWORK_ERRORS as e:
+            raise zc.buildout.UserError(
+                'Error downloading %s: %s' % (self.option_url, e))
+        finally:
+            if extractor is not None:
+                extractor.join()
+                if not f.complete:
+                    shutil.rmtree(extract_dir)
+
+        checksums = f.get_checksums()
+        try:
+            self.check_checksums(f.part_path, checksums)
+        except zc_download.ChecksumError:
+            # Not saved in the cache, nor resumed.
+            f.discard()
+            if extractor is not None:
+                shutil.rmtree(extract_dir)
+            raise
+
+        f.finish()
+        if checksums:
+            utils.write_checksums(cached_path, checksums)
+        if extractor is None:
+            return True
+
+        if f.restarts:
+            # Bytes of the old file may have been extracted.
+            shutil.rmtree(extract_dir)
+            return True
+
+        try:
+            extractor.check()
+        except (tarfile.TarError, zipfile.BadZipfile, EnvironmentError) as e:
+            # Extracted again from the cache, failing like without streaming.
+            self.logger.warning('Unable to extract %s while downloading: %s',
+                                self.option_url, e)
+            shutil.rmtree(extract_dir)
+            return True
+
+        self.extracted_dir = extract_dir
+        return True
+
+
+def get_incremental_extractor(path, destination, extract_dir, **kwargs):
+    """Returns an IncrementalExtractor with its manifest in `extract_dir`."""
+    return extract.IncrementalExtractor(
+        path, destination, os.path.join(extract_dir, 'manifest.json'),
+        **kwargs)
+
+
+def uninstall(name, options):
+    """Keeps the files of an incremental extraction in `extract-directory`.
+
+    Buildout removes the installed files after this, so they are moved out
+    of the destination, and moved back when the part is installed again.
+    """
+    extract_dir = options.get('extract-directory')
+    if not extract_dir:
+        return
+
+    extractor = get_incremental_extractor(None, options['destination'],
+                                          extract_dir)
+    extractor.stash(os.path.join(extract_dir, 'files'))
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+appfy.recipe.extract
+--------------------
+
+Extraction of archives while they are downloaded by fetch.Fetch, so that the
+total time is close to the longest of both instead of their sum.
+
+Zip members are extracted as soon as their bytes are fetched, in any order,
+once the central directory is available. Tar files, compressed or not, are
+extracted in order as the bytes arrive.
+
+Also incremental extraction of archives, which only writes the members that
+changed since the previous extraction.
+"""
+import copy
+import os
+import posixpath
+import shutil
+import sys
+import tarfile
+import threading
+import urlparse
+import zipfile
+
+from appfy.recipe import utils
+
+CHUNK_SIZE = 2 ** 16
+
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tbz2')
+
+
+def get_stream_format(url):
+    """Returns 'zip' or 'tar' if `url` can be extracted while downloaded.
+
+    Returns None for other files.
+    """
+    name = urlparse.urlparse(url)[2].lower()
+    if name.endswith('.zip'):
+        return 'zip'
+
+    if name.endswith(TAR_EXTENSIONS):
+        return 'tar'
+
+    return None
+
+
+def open_part(fetch):
+    """Opens the partial file of `fetch` for reading.
+
+    It is unbuffered: a buffered file could return bytes read before they
+    were fetched.
+    """
+    return open(fetch.part_path, 'rb', 0)
+
+
+def get_archive_format(path):
+    """Returns 'zip' or 'tar' for these archives, or None for other files."""
+    if zipfile.is_zipfile(path):
+        return 'zip'
+
+    if tarfile.is_tarfile(path):
+        return 'tar'
+
+    return None
+
+
+def is_safe_name(name):
+    """Returns False for member names outside the destination."""
+    parts = name.replace('\\', '/').split('/')
+    return not name.startswith(('/', '\\')) and ':' not in parts[0] and \
+        '..' not in parts
+
+
+def is_safe_link(member, dest):
+    """Returns False for tar links to a path outside `dest`.
+
+    Symbolic links are relative to the directory of the member, like in
+    setuptools.archive_util, and hard links to the root of the archive.
+    Links extracted before are followed, so that a link can't point outside
+    through another one.
+    """
+    if not member.issym() and not member.islnk():
+        return True
+
+    if member.issym():
+        linkname = posixpath.join(posixpath.dirname(member.name),
+                                  member.linkname)
+    else:
+        linkname = member.linkname
+
+    if not is_safe_name(posixpath.normpath(linkname)):
+        return False
+
+    dest = os.path.realpath(dest)
+    path = os.path.realpath(os.path.join(dest, *linkname.split('/')))
+    return path == dest or path.startswith(dest + os.sep)
+
+
+def split_name(name):
+    """Returns the parts of a member name."""
+    return [part for part in name.replace('\\', '/').split('/')
+            if part not in ('', '.')]
+
+
+def write_zip_member(z, info, target):
+    """Writes a zip member to `target`, like setuptools.archive_util does."""
+    src = z.open(info)
+    try:
+        dst = open(target, 'wb')
+        try:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+    unix_attributes = info.external_attr >> 16
+    if unix_attributes:
+        os.chmod(target, unix_attributes)
+
+
+def remove_path(path):
+    """Removes a file, link or directory tree, if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def make_dir(path):
+    """Creates a directory, replacing a file in its place."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        return
+
+    remove_path(path)
+    os.makedirs(path)
+
+
+class ExtractError(Exception):
+    pass
+
+
+class Reader(object):
+    """A file object reading a file in order while a Fetch downloads it."""
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.pos = 0
+        self.file = None
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            available = self.fetch.wait_available(self.pos)
+            if not available:
+                break
+
+            if size >= 0:
+                available = min(available, size)
+                size -= available
+
+            if self.file is None:
+                self.file = open_part(self.fetch)
+
+            self.file.seek(self.pos)
+            chunks.append(self.file.read(available))
+            self.pos += available
+
+        return ''.join(chunks)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class StreamExtractor(threading.Thread):
+    """Extracts the file of a Fetch into `dest` while it is downloaded.
+
+    `format` is 'zip' or 'tar'. If given, `phase` is an instrument.Phase
+    that times the extraction and counts the files extracted. Errors are
+    raised by check(), after the thread ends.
+    """
+
+    def __init__(self, fetch, format, dest, phase=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fetch = fetch
+        self.format = format
+        self.dest = dest
+        self.phase = phase
+        self.error = None
+
+    def run(self):
+        try:
+            if self.phase is not None:
+                with self.phase:
+                    self.extract()
+            else:
+                self.extract()
+        except Exception:
+            self.error = sys.exc_info()
+
+    def check(self):
+        """Raises the error that stopped the extraction, if any."""
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def extract(self):
+        if self.format == 'zip':
+            self.extract_zip()
+        else:
+            self.extract_tar()
+
+    def count(self):
+        if self.phase is not None:
+            self.phase.count(files=1)
+
+    def extract_zip(self):
+        fetch = self.fetch
+        # Without the central directory first, wait for the whole file.
+        tail_start = fetch.wait(lambda: [fetch.state.get('zip-tail')])[0]
+        if tail_start is None:
+            fetch.wait(lambda: fetch.complete)
+        else:
+            fetch.wait_for(tail_start, fetch.state['size'] - 1)
+
+        f = open_part(fetch)
+        z = zipfile.ZipFile(f, 'r')
+        try:
+            infos = sorted(z.infolist(), key=lambda info: info.header_offset)
+            ends = [info.header_offset for info in infos[1:]]
+            ends.append(getattr(z, 'start_dir', fetch.state['size']))
+
+            # Members in each segment, in order, so that only the first one
+            # of each segment is checked when bytes arrive.
+            queues = [[] for segment in fetch.state['segments']]
+            for info, end in reversed(zip(infos, ends)):
+                for queue, segment in zip(queues, fetch.state['segments']):
+                    if segment[0] <= info.header_offset <= segment[1]:
+                        queue.append((info, end))
+                        break
+
+            def get_ready():
+                ready = []
+                for queue in queues:
+                    while queue and fetch.is_done(queue[-1][0].header_offset,
+                                                  queue[-1][1] - 1):
+                        ready.append(queue.pop()[0])
+
+                return ready
+
+            while [queue for queue in queues if queue]:
+                for info in fetch.wait(get_ready):
+                    self.extract_zip_member(z, info)
+        finally:
+            z.close()
+            f.close()
+
+    def extract_zip_member(self, z, info):
+        """Extracts a zip member like setuptools.archive_util does."""
+        name = info.filename
+        if not is_safe_name(name):
+            return
+
+        target = os.path.join(self.dest, *name.split('/'))
+        if name.endswith('/'):
+            if not os.path.isdir(target):
+                os.makedirs(target)
+
+            return
+
+        dirname = os.path.dirname(target)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        write_zip_member(z, info, target)
+        self.count()
+
+    def extract_tar(self):
+        reader = Reader(self.fetch)
+        try:
+            tar = tarfile.open(fileobj=reader, mode='r|*')
+            try:
+                # Don't change the owner when running as root.
+                tar.chown = lambda *args: None
+                for member in tar:
+                    if (not is_safe_name(member.name) or member.isdev() or
+                            not is_safe_link(member, self.dest)):
+                        continue
+
+                    tar.extract(member, self.dest)
+                    if member.isfile():
+                        self.count()
+            finally:
+                tar.close()
+        finally:
+            reader.close()
+
+
+class IncrementalExtractor(object):
+    """Extracts an archive to `dest`, only writing the members that changed.
+
+    Members are compared with the manifest of the previous extraction, saved
+    in `manifest_path`: their size and CRC in zip files, or their header in
+    tar files, and the size, modification time and inode of the extracted
+    file, to detect local changes. Files and directories of the previous
+    extraction that are not in the archive anymore are removed. Without a
+    manifest, the top-level entries of the archive are removed from `dest`
+    and extracted again.
+
+    If `strip` is true, the top-level directory of the archive is not
+    extracted. If given, `phase` is an instrument.Phase that counts the
+    files written. Tar links to paths outside `dest` are not extracted.
+    """
+
+    def __init__(self, path, dest, manifest_path, strip=False, phase=None):
+        self.path = path
+        self.dest = dest
+        self.manifest_path = manifest_path
+        self.strip = strip
+        self.phase = phase
+        self.written = 0
+        self.removed = 0
+
+    def __call__(self):
+        """Extracts the archive and returns the number of files kept."""
+        if get_archive_format(self.path) == 'zip':
+            z = zipfile.ZipFile(self.path, 'r')
+            try:
+                members = [(info.filename, info.filename.endswith('/'),
+                            [info.file_size, info.CRC,
+                             info.external_attr >> 16], info)
+                           for info in z.infolist()]
+                return self.sync(members, lambda info, target:
+                                 write_zip_member(z, info, target))
+            finally:
+                z.close()
+
+        tar = tarfile.open(self.path, 'r')
+        try:
+            # Don't change the owner when running as root.
+            tar.chown = lambda *args: None
+            members = [(member.name, member.isdir(),
+                        [member.size, member.mtime, member.mode, member.type,
+                         member.linkname, member.chksum], member)
+                       for member in tar.getmembers() if not member.isdev()]
+            return self.sync(members, lambda member, target:
+                             self.write_tar_member(tar, member, target))
+        finally:
+            tar.close()
+
+    def get_relname(self, name):
+        """Returns the path of a member name relative to `dest`."""
+        parts = split_name(name)
+        if self.strip:
+            parts = parts[1:]
+
+        return '/'.join(parts)
+
+    def get_entries(self, members):
+        """Returns the ``(relname, is_dir, signature, member)`` to extract.
+
+        Raises ExtractError if the top-level directory should be stripped,
+        but there's more than one entry in the root of the archive.
+        """
+        members = [member for member in members if is_safe_name(member[0])]
+        if self.strip:
+            top_level = set(split_name(member[0])[0] for member in members
+                            if split_name(member[0]))
+            if len(top_level) != 1:
+                raise ExtractError('Unable to strip top level directory '
+                                   'because there are more than one element '
+                                   'in the root of the package.')
+
+        entries = []
+        for name, is_dir, signature, member in members:
+            relname = self.get_relname(name)
+            if relname:
+                entries.append((relname, is_dir, signature, member))
+
+        return entries
+
+    def sync(self, members, write):
+        entries = self.get_entries(members)
+        manifest = utils.read_manifest(self.manifest_path)
+        if manifest.get('strip-top-level-dir') != self.strip:
+            manifest = {}
+
+        # Only keep a manifest if the extraction finishes.
+        if os.path.isfile(self.manifest_path):
+            os.remove(self.manifest_path)
+
+        old_files = manifest.get('files')
+        if old_files is None:
+            old_files = {}
+            for relname in set(entry[0].split('/')[0] for entry in entries):
+                remove_path(os.path.join(self.dest, relname))
+
+        files = {}
+        dirs = set()
+        for relname, is_dir, signature, member in entries:
+            target = os.path.join(self.dest, *relname.split('/'))
+            parts = relname.split('/')
+            for i in range(1, len(parts) if not is_dir else len(parts) + 1):
+                dirs.add('/'.join(parts[:i]))
+
+            if is_dir:
+                make_dir(target)
+                continue
+
+            old = old_files.get(relname)
+            if (old is not None and old[0] == signature and
+                    old[1] == self.get_key(target)):
+                files[relname] = old
+                continue
+
+            make_dir(os.path.dirname(target))
+            remove_path(target)
+            if write(member, target) is False:
+                # Not safe to extract.
+                continue
+
+            files[relname] = [signature, self.get_key(target)]
+            self.written += 1
+            if self.phase is not None:
+                self.phase.count(files=1)
+
+        for relname in old_files:
+            if relname not in files:
+                path = os.path.join(self.dest, *relname.split('/'))
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    os.remove(path)
+                    self.removed += 1
+
+        # Deepest first, so that their parents are empty.
+        for relname in sorted(manifest.get('dirs', []), reverse=True):
+            if relname not in dirs:
+                try:
+                    os.rmdir(os.path.join(self.dest, *relname.split('/')))
+                except OSError:
+                    # Not empty, or already removed.
+                    pass
+
+        utils.write_manifest(self.manifest_path, {
+            'strip-top-level-dir': self.strip,
+            'files': files,
+            'dirs': sorted(dirs),
+        })
+        return len(files) - self.written
+
+    def get_top_level(self):
+        """Returns the top-level files and directories of the extraction."""
+        manifest = utils.read_manifest(self.manifest_path)
+        names = set()
+        for relname in manifest.get('files', {}).keys() + manifest.get(
+                'dirs', []):
+            names.add(relname.split('/')[0])
+
+        return sorted(names)
+
+    def stash(self, stash_dir):
+        """Moves the extracted files from `dest` to `stash_dir`.
+
+        Done when they would be removed, to compare them with the archive
+        when they are restored.
+        """
+        remove_path(stash_dir)
+        os.makedirs(stash_dir)
+        for name in self.get_top_level():
+            path = os.path.join(self.dest, name)
+            if os.path.lexists(path):
+                shutil.move(path, os.path.join(stash_dir, name))
+
+    def restore(self, stash_dir):
+        """Moves the files stashed by stash() back to `dest`."""
+        if not os.path.isdir(stash_dir):
+            return
+
+        make_dir(self.dest)
+        for name in os.listdir(stash_dir):
+            path = os.path.join(self.dest, name)
+            if not os.path.lexists(path):
+                shutil.move(os.path.join(stash_dir, name), path)
+
+        shutil.rmtree(stash_dir)
+
+    def get_key(self, path):
+        try:
+            return utils.get_file_key(os.lstat(path))
+        except OSError:
+            return None
+
+    def write_tar_member(self, tar, member, target):
+        """Extracts a tar member to `target`.
+
+        Returns False if it's a link to a path outside `dest`.
+        """
+        member = copy.copy(member)
+        member.name = os.path.relpath(target, self.dest).replace(os.sep, '/')
+        if member.islnk():
+            member.linkname = self.get_relname(member.linkname)
+
+        if not is_safe_link(member, self.dest):
+            return False
+
+        tar.extract(member, self.dest)
@@ -0,0 +1,615 @@
+# -*- coding: utf-8 -*-
+"""
+appfy.recipe.fetch
+------------------
+
+Downloads of large files over HTTP, split in byte ranges fetched at the same
+time. Interrupted downloads are resumed from the bytes already fetched, which
+are recorded in a state file beside the partial file. Servers that don't
+support ranges are downloaded in a single stream. Ranges are requested with
+`If-Range`, so that the download starts over if the file changes meanwhile.
+
+The partial file can be read while it is downloaded, waiting for the bytes
+needed with Fetch.wait_for() or Fetch.wait_available().
+
+Checksums of the file are computed while it is downloaded, from the bytes
+fetched in a row from the start.
+"""
+import hashlib
+import httplib
+import os
+import re
+import struct
+import threading
+import time
+import urllib2
+import zipfile
+
+from appfy.recipe import utils
+
+CHUNK_SIZE = 2 ** 16
+
+# Files are not split in segments smaller than this.
+MIN_SEGMENT_SIZE = 2 ** 20
+
+# Seconds between saves of the download state.
+SAVE_INTERVAL = 1
+
+# Bytes fetched from the end of zip files to find the central directory.
+ZIP_TAIL_SIZE = 2 ** 16
+
+CONTENT_RANGE_RE = re.compile(r'^bytes\s+(\d+)-(\d+)/(\d+)$')
+
+# Errors after which a segment is requested again.
+NETWORK_ERRORS = (IOError, httplib.HTTPException)
+
+
+class FileChanged(IOError):
+    """The file changed in the server while it was downloaded."""
+
+
+def is_http_url(url):
+    return url.split(':', 1)[0].lower() in ('http', 'https')
+
+
+def open_url(url, start=None, end=None, timeout=60, if_range=None):
+    """Opens `url`, requesting the bytes from `start` to `end` if given.
+
+    With `if_range`, an ETag or date, the server sends the whole file
+    instead of the range if the file changed.
+    """
+    request = urllib2.Request(url)
+    if start is not None:
+        request.add_header('Range', 'bytes=%d-%s' % (
+            start, '' if end is None else end))
+        if if_range:
+            request.add_header('If-Range', if_range)
+
+    return urllib2.urlopen(request, timeout=timeout)
+
+
+def get_range_info(response):
+    """Returns the total size and validator of a response to a range request.
+
+    The validator is made of the ETag and Last-Modified headers, to detect
+    that the file changed. Returns None if the server doesn't support ranges.
+    """
+    if response.getcode() != 206:
+        return None
+
+    headers = response.info()
+    match = CONTENT_RANGE_RE.match(headers.getheader('Content-Range') or '')
+    if match is None:
+        return None
+
+    validator = '%s %s' % (headers.getheader('ETag') or '',
+                           headers.getheader('Last-Modified') or '')
+    return int(match.group(3)), validator.strip()
+
+
+def get_if_range(response):
+    """Returns the ETag or date to send as `If-Range`, or None.
+
+    Weak ETags can't be used with ranges, so Last-Modified is used instead.
+    """
+    headers = response.info()
+    etag = headers.getheader('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return headers.getheader('Last-Modified')
+
+
+def get_zip_tail_start(tail, size):
+    """Returns the offset where the central directory of a zip file starts.
+
+    `tail` are the last bytes of the file, of `size` bytes. Returns None if
+    `tail` has no end of central directory record, or for zip64 files.
+    """
+    pos = tail.rfind(zipfile.stringEndArchive)
+    record = tail[pos:pos + zipfile.sizeEndCentDir]
+    if pos < 0 or len(record) != zipfile.sizeEndCentDir:
+        return None
+
+    values = struct.unpack(zipfile.structEndArchive, record)
+    cd_size = values[zipfile._ECD_SIZE]
+    if cd_size == 0xFFFFFFFF or values[zipfile._ECD_OFFSET] == 0xFFFFFFFF:
+        return None
+
+    # Relative to the end, in case data was prepended to the archive.
+    cd_start = size - len(tail) + pos - cd_size
+    return max(min(cd_start, size - len(tail)), 0)
+
+
+def split_segments(size, segments):
+    """Returns `segments` ``[start, end, position]`` ranges of `size` bytes.
+
+    `position` is the next byte to fetch. Segments are at least
+    MIN_SEGMENT_SIZE bytes.
+    """
+    count = max(min(segments, size // MIN_SEGMENT_SIZE), 1)
+    length = max(-(-size // count), 1)
+    return [[start, min(start + length, size) - 1, start]
+            for start in range(0, size, length)]
+
+
+class Fetch(object):
+    """Downloads `url` to `path`, fetching `segments` ranges at a time.
+
+    The data is written to `path` plus `.part`, and the ranges fetched so far
+    to `path` plus `.part.json`, so that a new Fetch of the same URL resumes
+    the download, unless the file changed in the server. `path` is only
+    created when the download is complete.
+
+    If `zip_tail` is true, the central directory of zip files is fetched
+    first, so that members can be extracted as they arrive. The checksums of
+    `hashtypes` are returned by get_checksums().
+
+    If the file changes in the server, the download starts over, up to
+    `retries` times.
+    """
+
+    def __init__(self, url, path, segments=4, retries=3, timeout=60,
+                 zip_tail=False, hashtypes=(), logger=None):
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.json'
+        self.segments = segments
+        self.retries = retries
+        self.timeout = timeout
+        self.zip_tail = zip_tail
+        self.logger = logger
+        self.state = None
+        self.fetched = 0
+        # Validator of the file sent in ranged requests.
+        self.if_range = None
+        # Set when a segment finds that the file changed.
+        self.changed = False
+        self.restarts = 0
+        self.lock = threading.Lock()
+        # Notified when bytes are fetched, or the download ends.
+        self.condition = threading.Condition(self.lock)
+        self.complete = False
+        self.failed = False
+        self.saved_at = 0
+        self.hashes = [(hashtype, getattr(hashlib, hashtype)())
+                       for hashtype in hashtypes]
+        # Bytes from the start that were hashed.
+        self.hashed = 0
+        self.hash_lock = threading.Lock()
+
+    def __call__(self):
+        """Downloads the file and returns the number of bytes fetched.
+
+        Bytes fetched before a resume are not counted. Raises IOError if the
+        download fails; then it can be resumed.
+        """
+        fetched = self.fetch()
+        self.finish()
+        return fetched
+
+    def fetch(self):
+        """Downloads the partial file, without moving it to `path`.
+
+        Readers waiting for bytes are woken up when it ends.
+        """
+        try:
+            self.fetch_file()
+        except BaseException:
+            self.set_done(failed=True)
+            raise
+
+        self.set_done()
+        return self.fetched
+
+    def set_done(self, failed=False):
+        self.condition.acquire()
+        try:
+            self.failed = failed
+            self.complete = not failed
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def fetch_file(self):
+        """Downloads the file, starting over if it changes in the server."""
+        while True:
+            try:
+                self.fetch_ranges()
+                return
+            except FileChanged:
+                if self.restarts >= self.retries:
+                    raise
+
+            if self.logger:
+                self.logger.info('%s changed in the server, downloading it '
+                                 'again.', self.url)
+
+            self.restart()
+
+    def restart(self):
+        """Discards the bytes fetched, so that the download starts over."""
+        self.discard()
+        self.condition.acquire()
+        try:
+            self.state = None
+            self.fetched = 0
+            self.changed = False
+            self.if_range = None
+        finally:
+            self.condition.release()
+
+        self.hashes = [(hashtype, getattr(hashlib, hashtype)())
+                       for hashtype, checksum in self.hashes]
+        self.hashed = 0
+        self.restarts += 1
+
+    def fetch_ranges(self):
+        try:
+            response = open_url(self.url, 0, 0, self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code != 416:
+                raise
+
+            # Empty files can't have ranges.
+            response = open_url(self.url, timeout=self.timeout)
+
+        try:
+            info = get_range_info(response)
+            if info is None:
+                if response.getcode() != 200:
+                    response.close()
+                    response = open_url(self.url, timeout=self.timeout)
+
+                if self.logger:
+                    self.logger.info('Downloading %s in a single stream: the '
+                                     'server does not support ranges.',
+                                     self.url)
+
+                self.fetch_stream(response)
+                return
+
+            self.if_range = get_if_range(response)
+            response.read()
+        finally:
+            response.close()
+
+        self.load_state(*info)
+        segments = [s for s in self.state['segments'] if s[2] <= s[1]]
+        tail_start = self.state.get('zip-tail')
+        if segments and tail_start is not None and segments[-1][0] == \
+                tail_start:
+            # The central directory first.
+            errors = [self.fetch_segment(segments.pop())]
+        else:
+            errors = []
+
+        if not [error for error in errors if error is not None]:
+            errors.extend(utils.map_threads(self.fetch_segment, segments,
+                                            workers=len(segments)))
+
+        errors = [error for error in errors if error is not None]
+        for error in errors:
+            if isinstance(error, FileChanged):
+                raise error
+
+        self.save_state()
+        if errors:
+            raise IOError('Error downloading %s, %d of %d bytes are saved to '
+                          'resume later: %s' % (
+                              self.url, self.get_done(), self.state['size'],
+                              errors[0]))
+
+    def load_state(self, size, validator):
+        """Loads the ranges already fetched, or starts a new download."""
+        state = utils.read_manifest(self.state_path)
+        if (state.get('url') == self.url and state.get('size') == size and
+                state.get('validator') == validator and
+                os.path.isfile(self.part_path) and
+                os.path.getsize(self.part_path) == size):
+            self.set_state(state)
+            if self.logger:
+                self.logger.info('Resuming download of %s at %d of %d bytes.',
+                                 self.url, self.get_done(), size)
+            return
+
+        tail_start = None
+        if self.zip_tail and size > ZIP_TAIL_SIZE:
+            tail_start = self.get_zip_tail_start(size)
+
+        if tail_start is None:
+            segments = split_segments(size, self.segments)
+        else:
+            segments = split_segments(tail_start, self.segments)
+            segments.append([tail_start, size - 1, tail_start])
+
+        state = {
+            'url': self.url,
+            'size': size,
+            'validator': validator,
+            'segments': segments,
+            'zip-tail': tail_start,
+        }
+        self.set_state(state)
+        f = open(self.part_path, 'wb')
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+
+        self.save_state()
+        if self.logger:
+            self.logger.info('Downloading %s: %d bytes in %d segments.',
+                             self.url, size, len(self.state['segments']))
+
+    def get_zip_tail_start(self, size):
+        response = open_url(self.url, size - ZIP_TAIL_SIZE, size - 1,
+                            self.timeout, self.if_range)
+        try:
+            self.check_range(response, size - ZIP_TAIL_SIZE, size - 1)
+            tail = response.read()
+        finally:
+            response.close()
+
+        return get_zip_tail_start(tail, size)
+
+    def set_state(self, state):
+        self.condition.acquire()
+        try:
+            self.state = state
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def save_state(self):
+        self.lock.acquire()
+        try:
+            utils.write_manifest(self.state_path, self.state)
+            self.saved_at = time.time()
+        finally:
+            self.lock.release()
+
+    def get_done(self):
+        """Returns the number of bytes already fetched."""
+        return sum(pos - start for start, end, pos in self.state['segments'])
+
+    def fetch_segment(self, segment):
+        """Fetches the rest of a segment, retrying after network errors.
+
+        Returns the last error, or None if the segment was fetched.
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                self.fetch_range(segment)
+                return None
+            except FileChanged as e:
+                # The other segments stop too.
+                self.changed = True
+                return e
+            except NETWORK_ERRORS as e:
+                error = e
+                if self.logger:
+                    self.logger.info('Error downloading bytes %d-%d of %s, '
+                                     'attempt %d of %d: %s', segment[2],
+                                     segment[1], self.url, attempt + 1,
+                                     self.retries + 1, e)
+
+        return error
+
+    def check_range(self, response, start, end):
+        """Raises IOError if `response` is not the range from `start`.
+
+        Raises FileChanged if the whole file was sent because it doesn't
+        match the `If-Range` validator.
+        """
+        if response.getcode() == 200 and self.if_range:
+            raise FileChanged('%s changed in the server.' % self.url)
+
+        if response.getcode() != 206:
+            raise IOError('The server did not return the range %d-%d.' %
+                          (start, end))
+
+    def fetch_range(self, segment):
+        start, end, pos = segment
+        response = open_url(self.url, pos, end, self.timeout, self.if_range)
+        try:
+            self.check_range(response, pos, end)
+            f = open(self.part_path, 'r+b')
+            try:
+                f.seek(pos)
+                while segment[2] <= end:
+                    if self.changed:
+                        raise FileChanged('%s changed in the server.' %
+                                          self.url)
+
+                    pos = segment[2]
+                    data = response.read(min(CHUNK_SIZE, end - pos + 1))
+                    if not data:
+                        raise IOError('Connection closed at byte %d.' % pos)
+
+                    f.write(data)
+                    # Only fetched bytes that were written are saved.
+                    f.flush()
+                    self.add_fetched(segment, len(data))
+                    self.update_hashes(pos, data)
+            finally:
+                f.close()
+        finally:
+            response.close()
+
+    def add_fetched(self, segment, size, save=True):
+        self.condition.acquire()
+        try:
+            segment[2] += size
+            self.fetched += size
+            save = save and time.time() - self.saved_at > SAVE_INTERVAL
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+        if save:
+            self.save_state()
+
+    def fetch_stream(self, response):
+        """Writes the whole response to the partial file.
+
+        It can't be resumed, so the state is not saved.
+        """
+        length = response.info().getheader('Content-Length')
+        segment = [0, int(length) - 1 if length else float('inf'), 0]
+        self.set_state({
+            'url': self.url,
+            'size': int(length) if length else None,
+            'segments': [segment],
+        })
+        f = open(self.part_path, 'wb')
+        try:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+
+                pos = segment[2]
+                f.write(data)
+                f.flush()
+                self.add_fetched(segment, len(data), save=False)
+                self.update_hashes(pos, data)
+        finally:
+            f.close()
+
+        length = response.info().getheader('Content-Length')
+        if length is not None and int(length) != self.fetched:
+            raise IOError('Error downloading %s: got %d of %s bytes.' % (
+                self.url, self.fetched, length))
+
+    def update_hashes(self, pos=None, data=None):
+        """Hashes `data`, fetched at `pos`, if it follows the bytes hashed.
+
+        Then hashes the bytes after them that were fetched by other segments,
+        reading them from the partial file. If another thread is hashing, it
+        returns at once: that thread reads the data from the file.
+        """
+        if not self.hashes or not self.hash_lock.acquire(False):
+            return
+
+        f = None
+        try:
+            if data is not None and pos == self.hashed:
+                self.hash_data(data)
+
+            while True:
+                self.condition.acquire()
+                try:
+                    available = self.get_available(self.hashed)
+                finally:
+                    self.condition.release()
+
+                if not available:
+                    break
+
+                if f is None:
+                    f = open(self.part_path, 'rb', 0)
+
+                f.seek(self.hashed)
+                while available:
+                    data = f.read(min(utils.CHECKSUM_CHUNK_SIZE, available))
+                    if not data:
+                        raise IOError('Error reading %s at byte %d.' % (
+                            self.part_path, self.hashed))
+
+                    self.hash_data(data)
+                    available -= len(data)
+        finally:
+            if f is not None:
+                f.close()
+
+            self.hash_lock.release()
+
+    def hash_data(self, data):
+        for hashtype, checksum in self.hashes:
+            checksum.update(data)
+
+        self.hashed += len(data)
+
+    def get_checksums(self):
+        """Returns the checksums of the fetched file, by hash type."""
+        self.update_hashes()
+        if self.hashes and self.hashed != self.get_done():
+            raise IOError('Only %d bytes of %s were hashed.' % (self.hashed,
+                                                                self.url))
+
+        return dict((hashtype, checksum.hexdigest())
+                    for hashtype, checksum in self.hashes)
+
+    def is_done(self, start, end):
+        """Returns True if the bytes from `start` to `end` were fetched."""
+        for first, last, pos in self.state['segments']:
+            if first <= end and start <= last and pos <= min(last, end):
+                return False
+
+        return True
+
+    def get_available(self, pos):
+        """Returns the number of bytes fetched in a row from `pos`."""
+        count = 0
+        for first, last, done in sorted(self.state['segments']):
+            if first <= pos + count <= last:
+                if done <= pos + count:
+                    break
+
+                count = done - pos
+                if done <= last:
+                    break
+
+        return count
+
+    def wait(self, ready):
+        """Waits until `ready()` returns a true value, and returns it.
+
+        `ready` is called with the lock held, once the download started.
+        Raises IOError if the download fails.
+        """
+        self.condition.acquire()
+        try:
+            while True:
+                if self.failed:
+                    raise IOError('Error downloading %s.' % self.url)
+
+                if self.state is not None:
+                    result = ready()
+                    if result:
+                        return result
+
+                self.condition.wait(1)
+        finally:
+            self.condition.release()
+
+    def wait_for(self, start, end):
+        """Waits until the bytes from `start` to `end` are fetched."""
+        self.wait(lambda: self.complete or self.is_done(start, end))
+
+    def wait_available(self, pos):
+        """Waits for bytes after `pos` and returns how many there are.
+
+        Returns 0 at the end of the file.
+        """
+        def ready():
+            available = self.get_available(pos)
+            if available or self.complete:
+                # A true value, even with 0 bytes.
+                return [available]
+
+        return self.wait(ready)[0]
+
+    def finish(self):
+        utils.rename(self.part_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def discard(self):
+        """Removes the partial file, so that the next Fetch starts over."""
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -6,6 +6,21 @@ Downloads libraries from PyPi and installs in the app directory. This recipe
 extends `zc.recipe.egg.Scripts <http://pypi.python.org/pypi/zc.recipe.egg>`_,
 so all the options from that recipe are also valid.
 
+Eggs are unzipped by default, as with `unzip = true`: each egg is unpacked
+in the eggs directory, and its files are then copied to `lib-directory`.
+Reading zipped eggs in place is opt-in: with `unzip = false`, zipped eggs are
+kept zipped and their files are read directly from the egg, without the
+unpacked copy. Known limitations:
+
+- zc.buildout 2 always unzips eggs, so this only works with zc.buildout 1.
+- Eggs already unpacked in the eggs directory are not zipped again.
+- The other scripts and parts that use the same eggs get them zipped, and
+  some libraries can't be imported from a zip file.
+- Files in zipped eggs can't be linked, so they are copied whatever
+  `install-mode` is set.
+- File times are the ones stored in the egg, and directories are created
+  with the default permissions.
+
 Options
 ~~~~~~~
 
@@ -14,7 +29,8 @@ Options
     `distlib`.
 :use-zipimport: If `true`, a zip file with the libraries is created
     instead of a directory. The zip filename will be the value of
-    `lib-directory` plus `.zip`.
+    `lib-directory` plus `.zip`. The zip file is reproducible: it is only
+    replaced if the libraries changed.
 :ignore-globs: A list of glob patterns to not be copied from the library.
 :ignore-packages: A list of top-level package names or modules to be ignored.
     This is useful to ignore dependencies that won't be used. Some packages may
@@ -24,6 +40,82 @@ Options
     inside the parts dir as a backup when building, instead of deleting it.
     This is to avoid accidental deletion if `lib-directory` is badly
     configured. Default to `true`.
+:delete-safe-keep: Maximum number of backups kept by `delete-safe`; older
+    ones are removed. `0` keeps all backups. Default to `0`.
+:delete-safe-max-bytes: Maximum total size of the backups kept by
+    `delete-safe`; older ones are removed, but the last backup is always
+    kept. `0` means no limit. Default to `0`.
+:prune-entry-points: A list of app entry points: python files or `app.yaml`
+    files, whose handler scripts and `appengine_config` are used. If set,
+    only the modules imported from them, directly or not, are installed.
+    Other files are installed if their top-level package is used. Imports
+    are found statically, so use `prune-allow` for dynamic imports.
+:prune-allow: A list of glob patterns of module names to always install
+    when `prune-entry-points` is set, e.g. `babel.localedata*`.
+:incremental: If `true`, keep a manifest of the installed files in the parts
+    dir and only copy or remove the files that changed since the last build,
+    instead of copying all of them every time; the others are hardlinked
+    from the old `lib-directory` into the new one. With `use-zipimport`,
+    only changed files are compressed again. Default to `false`.
+:copy-workers: Number of threads used to copy the library files. Default
+    to `1`.
+:zip-workers: Number of threads used to compress the library files when
+    `use-zipimport` is `true`. The archive is the same for any number of
+    workers. Default to `1`.
+:zip-layout: How libraries are zipped when `use-zipimport` is `true`:
+    `single` creates one zip file, and `per-package` creates a zip file for
+    each top-level package inside `lib-directory`, so that only the zips of
+    the packages that changed are created again. These zips are listed in
+    `lib-directory/archives.pth`, and are added to sys.path by
+    `site.addsitedir()` or `google.appengine.ext.vendor.add()` with
+    `lib-directory`. The lib zip or `lib-directory` built before with
+    another layout is removed. Default to `single`.
+:install-mode: How files are installed from the eggs: `copy`, `hardlink`,
+    `reflink` or `symlink`. Linking avoids copying the data when the eggs and
+    `lib-directory` are in the same filesystem; files that can't be linked
+    are copied. Don't edit linked files, as this also changes the eggs.
+    Symlinks are relative, so they only work if the eggs directory is moved
+    along with `lib-directory`; use them for local development, not to
+    deploy. Default to `copy`.
+:report-file: JSON file where the number of files, bytes and compressed
+    bytes of each installed package, and its largest files, are saved after
+    each build. The limits are checked before the new libraries replace the
+    old ones. Default is `report.json` in the part directory.
+:max-files: Maximum number of library files, counting the files inside the
+    zips with `use-zipimport`. If exceeded, the build fails and the largest
+    packages are listed. `0` means no limit. Default to `0`.
+:max-bytes: Maximum size of the libraries, compressed with
+    `use-zipimport`. If exceeded, the build fails and the largest packages
+    are listed. `0` means no limit. Default to `0`.
+:shared-lib-store: A directory shared by several buildouts, where library
+    files are stored once by content and hardlinked into `lib-directory`,
+    instead of copied from the eggs (`install-mode` is ignored). Files in
+    the store are read-only. The `lib_store_gc` script of
+    `appfy.recipe.gae:tools` removes the files no longer used by any
+    `lib-directory`. Not used with `use-zipimport`.
+:precompile: If `true`, byte-compile the libraries and install the bytecode
+    in `lib-directory` or in the zip file, so that it isn't compiled when
+    instances start. Modules that fail to compile are skipped and reported.
+    Default to `false`.
+:precompile-optimize: Optimization level used to byte-compile: `0` (`.pyc`
+    files), `1` or `2` (`.pyo` files, like using python `-O` or `-OO`).
+    Default to `0`.
+:precompile-workers: Number of processes used to byte-compile. Default to
+    `1`.
+:slim-sources: If `true`, install python sources without docstrings and
+    comments, to reduce the size of the libraries. Line numbers are kept,
+    as well as license notices. Docstrings are replaced by empty strings, so
+    `__doc__` is empty. Slimmed files are cached in the parts dir by content.
+    Sources that can't be compiled after slimming are installed unchanged.
+    Default to `false`.
+:slim-sources-ignore: A list of glob patterns of files, relative to
+    `lib-directory`, to install unchanged with `slim-sources`, e.g.
+    `docopt.py` or `ply/*` for libraries that use their docstrings.
+:slim-sources-workers: Number of processes used to slim the sources.
+    Default to `1`.
+:timing-log: File where the time of each build phase, with the files and
+    bytes it processed, is appended as a JSON line, to follow build times.
+    A summary of the phases is always logged. Default is none.
 
 Example
 ~~~~~~~
@@ -59,16 +151,27 @@ Example
       site
       pkg_resources
 """
+import calendar
 import datetime
+import filecmp
+import hashlib
 import logging
 import os
+import re
 import shutil
-import tempfile
+import threading
 import uuid
+import zipfile
 
+import zc.buildout
 from zc.recipe import egg
 
 from appfy import recipe
+from appfy.recipe import importgraph
+from appfy.recipe import instrument
+from appfy.recipe import slim
+from appfy.recipe import store
+from appfy.recipe import utils
 
 BASE = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(os.path.realpath(__file__))))))
@@ -82,24 +185,56 @@ or edit things here because any changes will be lost!
 
 Use a different directory for extra libraries instead of this one."""
 
+# Ways to zip the libraries with `use-zipimport`.
+ZIP_LAYOUTS = ('single', 'per-package')
+
+# Suffix of the backups made by delete-safe: the date, and a random suffix if
+# there are several in the same second.
+BACKUP_DATE_RE = r'_(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2})(?:_[0-9a-f]{8})?'
+
+# Lists the package zips of `lib-directory`, to be added to sys.path.
+ZIPS_PTH = 'archives.pth'
+
+# Threads removing old libraries, by path, so that a path isn't reused by
+# another recipe before it is removed.
+_delete_threads = {}
+
 
 class Recipe(egg.Scripts):
     def __init__(self, buildout, name, opts):
         # Set a logger with the section name.
         self.logger = logging.getLogger(name)
 
-        # Unzip eggs by default or we can't use some.
+        # Unzip eggs by default, as in previous versions.
         opts.setdefault('unzip', 'true')
 
         self.eggs_dir = buildout['buildout']['eggs-directory']
         self.parts_dir = buildout['buildout']['parts-directory']
         self.temp_dir = os.path.join(self.parts_dir, 'temp')
+        self.part_dir = os.path.join(self.parts_dir, name)
+        self.manifest_path = os.path.join(self.part_dir, 'manifest.json')
+        self.metadata_cache_path = os.path.join(
+            self.part_dir, 'metadata.json')
+        self.hashes_path = os.path.join(self.part_dir, 'hashes.json')
+        # Removes the old libraries while buildout goes on.
+        self.delete_thread = None
 
         lib_dir = opts.get('lib-directory', 'distlib')
         self.lib_path = os.path.abspath(lib_dir)
+        self.report_path = os.path.abspath(opts.get(
+            'report-file', os.path.join(self.part_dir, 'report.json')))
+        self.max_files = int(opts.get('max-files', '0'))
+        self.max_bytes = int(opts.get('max-bytes', '0'))
 
         self.use_zip = opts.get('use-zipimport', 'false') == 'true'
-        if self.use_zip:
+        self.zip_layout = opts.get('zip-layout', 'single').strip()
+        if self.zip_layout not in ZIP_LAYOUTS:
+            raise zc.buildout.UserError(
+                'Invalid zip-layout %r: must be one of %s.' % (
+                    self.zip_layout, ', '.join(ZIP_LAYOUTS)))
+
+        self.use_single_zip = self.use_zip and self.zip_layout == 'single'
+        if self.use_single_zip:
             self.lib_path += '.zip'
 
         # Set list of globs and packages to be ignored.
@@ -110,78 +245,829 @@ class Recipe(egg.Scripts):
             i for i in opts.get('ignore-packages', '').splitlines()
             if i.strip()
         ]
+        # Compiled once and shared by all packages.
+        self.to_ignore = recipe.ignore_patterns(*self.ignore_globs)
+
+        # Set entry points used to prune unreachable modules.
+        self.prune_entry_points = [
+            os.path.abspath(i.strip())
+            for i in opts.get('prune-entry-points', '').splitlines()
+            if i.strip()
+        ]
+        self.prune_allow = [
+            i.strip() for i in opts.get('prune-allow', '').splitlines()
+            if i.strip()
+        ]
 
         self.delete_safe = opts.get('delete-safe', 'true') != 'false'
+        self.backup_keep = int(opts.get('delete-safe-keep', '0'))
+        self.backup_max_bytes = int(opts.get('delete-safe-max-bytes', '0'))
+        self.incremental = opts.get('incremental', 'false') == 'true'
+        self.copy_workers = int(opts.get('copy-workers', '1'))
+        self.zip_workers = int(opts.get('zip-workers', '1'))
+        self.precompile = opts.get('precompile', 'false') == 'true'
+        self.precompile_optimize = int(opts.get('precompile-optimize', '0'))
+        if self.precompile_optimize not in (0, 1, 2):
+            raise zc.buildout.UserError(
+                'Invalid precompile-optimize %r: must be 0, 1 or 2.' %
+                self.precompile_optimize)
+        self.precompile_workers = int(opts.get('precompile-workers', '1'))
+        self.slim_sources = opts.get('slim-sources', 'false') == 'true'
+        self.slim_ignore = recipe.ignore_patterns(*[
+            i.strip() for i in opts.get('slim-sources-ignore', '').splitlines()
+            if i.strip()
+        ])
+        self.slim_workers = int(opts.get('slim-sources-workers', '1'))
+        self.install_mode = opts.get('install-mode', 'copy').strip()
+        if self.install_mode not in utils.INSTALL_MODES:
+            raise zc.buildout.UserError(
+                'Invalid install-mode %r: must be one of %s.' % (
+                    self.install_mode, ', '.join(utils.INSTALL_MODES)))
+
+        self.store = None
+        store_dir = opts.get('shared-lib-store', '').strip()
+        if store_dir:
+            self.store = store.Store(os.path.abspath(store_dir))
+            # Files are linked from the store.
+            self.install_mode = 'hardlink'
+        self.timer = instrument.Timer(
+            'appfy.recipe.gae:app_lib', name, self.logger,
+            opts.get('timing-log', '').strip() or None)
         opts.setdefault('eggs', '')
         super(Recipe, self).__init__(buildout, name, opts)
 
     def install(self):
-        # Get all installed packages.
-        reqs, ws = self.working_set()
-        paths = self.get_package_paths(ws)
+        self.timer.restart()
+        try:
+            # Get all installed packages.
+            with self.timer.phase('working-set'):
+                reqs, ws = self.working_set()
+
+            with self.timer.phase('egg-metadata') as phase:
+                paths = self.get_package_paths(ws)
+                phase.count(files=len(ws.entries))
 
-        # For now we only support installing them in the app dir.
-        # In the future we may support installing libraries in the parts dir.
-        self.install_in_app_dir(paths)
+            # For now we only support installing them in the app dir.
+            # In the future we may support installing libraries in the parts
+            # dir.
+            self.install_in_app_dir(paths)
 
-        return super(Recipe, self).install()
+            with self.timer.phase('scripts'):
+                return super(Recipe, self).install()
+        finally:
+            utils.close_zip_files()
+            self.timer.finish()
 
     update = install
 
     def install_in_app_dir(self, paths):
-        # Delete old libs.
-        self.delete_libs()
+        with self.timer.phase('list-files') as phase:
+            files = self.get_install_files(paths)
+            phase.count(files=len(files))
+
+        if self.prune_entry_points:
+            with self.timer.phase('prune') as phase:
+                files = self.prune_unreachable(files)
+                phase.count(files=len(files))
+
+        if self.slim_sources:
+            with self.timer.phase('slim') as phase:
+                files = self.slim_files(files, phase)
+
+        if self.precompile:
+            files = self.remove_bytecode(files)
+
+        if self.store is not None and not self.use_zip:
+            with self.timer.phase('store') as phase:
+                files = self.add_to_store(files)
+                phase.count(files=len(files))
 
         if self.use_zip:
-            # Create temporary directory for the zip files.
-            tmp_dir = os.path.join(tempfile.gettempdir(), uuid.uuid4().hex)
+            # Files are written directly from the eggs to the zip file.
+            if self.precompile:
+                files = files + self.compile_for_zip(files)
+
+            with self.timer.phase('zip') as phase:
+                if self.use_single_zip:
+                    report = self.build_zip(files)
+                else:
+                    report = self.build_package_zips(files)
+
+                phase.count(files=len(files), bytes=report['bytes'])
+        elif self.incremental:
+            with self.timer.phase('sync') as phase:
+                report = self.sync_in_app_dir(files)
+                phase.count(files=len(files), bytes=report['bytes'])
         else:
-            tmp_dir = self.lib_path
+            with self.timer.phase('copy') as phase:
+                report = self.build_lib_dir(files)
+                phase.count(files=len(files), bytes=report['bytes'])
+
+        self.write_report(report)
+        self.remove_other_layout()
+
+    def build_lib_dir(self, files):
+        """Creates `lib-directory` from scratch and returns its report.
 
-        if not os.path.exists(tmp_dir):
-            os.mkdir(tmp_dir)
+        The new libs are built beside the old ones, which are kept until the
+        new ones are complete.
+        """
+        staging_path = self.get_staging_path()
 
         # Copy all files.
+        recipe.copy_files(
+            files,
+            staging_path,
+            workers=self.copy_workers,
+            mode=self.install_mode,
+            logger=self.logger
+        )
+
+        # Save README.
+        f = open(os.path.join(staging_path, 'README.txt'), 'w')
+        f.write(LIB_README)
+        f.close()
+
+        if self.precompile:
+            self.compile_in_app_dir(files, staging_path)
+
+        report = self.check_libs(staging_path)
+        self.swap_libs(staging_path)
+        return report
+
+    def get_report(self, lib_path):
+        """Returns the number of files and bytes of each package in `lib_path`.
+
+        Files are counted as installed, so the zip members and their
+        compressed size are counted with `use-zipimport`.
+        """
+        entries = []
+        if self.use_single_zip:
+            entries.extend(self.get_zip_entries(lib_path))
+        else:
+            for root, dirs, files in utils.walk(lib_path, followlinks=False):
+                for entry in files:
+                    relname = os.path.relpath(entry.path, lib_path)
+                    if self.use_zip and entry.name.endswith('.zip'):
+                        entries.extend(self.get_zip_entries(entry.path))
+                    else:
+                        entries.append((relname, entry.stat().st_size,
+                                        None))
+
+        packages = {}
+        for relname, size, compressed_size in entries:
+            relname = relname.replace(os.sep, '/')
+            name = relname.split('/')[0]
+            if name == relname:
+                name = os.path.splitext(name)[0]
+
+            package = packages.setdefault(name, {
+                'files': 0,
+                'bytes': 0,
+                'compressed-bytes': None,
+                'largest-files': [],
+            })
+            package['files'] += 1
+            package['bytes'] += size
+            if compressed_size is not None:
+                package['compressed-bytes'] = (
+                    (package['compressed-bytes'] or 0) + compressed_size)
+
+            package['largest-files'].append((size, relname))
+
+        for package in packages.values():
+            package['largest-files'] = [
+                [filename, size] for size, filename in
+                sorted(package['largest-files'], reverse=True)[:5]
+            ]
+
+        report = {
+            'lib-directory': self.lib_path,
+            'files': sum(p['files'] for p in packages.values()),
+            'bytes': sum(p['bytes'] for p in packages.values()),
+            'compressed-bytes': None,
+            'packages': packages,
+        }
+        if self.use_zip:
+            report['compressed-bytes'] = sum(
+                p['compressed-bytes'] or 0 for p in packages.values())
+
+        return report
+
+    def get_zip_entries(self, filename):
+        """Returns the (name, size, compressed size) of the files in a zip."""
+        z = zipfile.ZipFile(filename, 'r')
+        try:
+            return [(info.filename, info.file_size, info.compress_size)
+                    for info in z.infolist()]
+        finally:
+            z.close()
+
+    def check_libs(self, lib_path):
+        """Returns the report of the libraries built in `lib_path`.
+
+        Fails the build before `lib_path` replaces `lib-directory` if the
+        libraries are too big, removing them.
+        """
+        with self.timer.phase('report') as phase:
+            report = self.get_report(lib_path)
+            phase.count(files=report['files'], bytes=report['bytes'])
+
+        try:
+            self.check_report(report)
+        except zc.buildout.UserError:
+            if os.path.isdir(lib_path):
+                shutil.rmtree(lib_path)
+            else:
+                os.remove(lib_path)
+
+            raise
+
+        return report
+
+    def write_report(self, report):
+        """Saves the size report in `report-file`."""
+        utils.write_manifest(self.report_path, report)
+        if self.use_zip:
+            self.logger.info(
+                'Installed %d files, %d bytes (%d compressed). Saved report '
+                'in %r.', report['files'], report['bytes'],
+                report['compressed-bytes'], self.report_path)
+        else:
+            self.logger.info(
+                'Installed %d files, %d bytes. Saved report in %r.',
+                report['files'], report['bytes'], self.report_path)
+
+    def check_report(self, report):
+        """Fails the build if the libraries exceed `max-files` or `max-bytes`.
+
+        The error ranks the packages by the exceeded budget, with their
+        largest files, to help choosing what to ignore.
+        """
+        key = 'compressed-bytes' if self.use_zip else 'bytes'
+        errors = []
+        if self.max_files and report['files'] > self.max_files:
+            errors.append(('files', 'max-files', report['files'],
+                           self.max_files))
+
+        if self.max_bytes and report[key] > self.max_bytes:
+            errors.append((key, 'max-bytes', report[key], self.max_bytes))
+
+        if not errors:
+            return
+
+        lines = []
+        for sort_key, option, value, limit in errors:
+            lines.append('Libraries exceed %s: %d > %d. Largest packages '
+                         'by %s:' % (option, value, limit, sort_key))
+            packages = sorted(report['packages'].items(),
+                              key=lambda item: item[1][sort_key] or 0,
+                              reverse=True)
+            for name, package in packages[:10]:
+                lines.append('  %s: %d files, %d %s' % (
+                    name, package['files'], package[key] or 0,
+                    key.replace('-', ' ')))
+                for relname, size in package['largest-files'][:3]:
+                    lines.append('    %s: %d bytes' % (relname, size))
+
+        raise zc.buildout.UserError('\n'.join(lines))
+
+    def add_to_store(self, files):
+        """Adds the files to `shared-lib-store`.
+
+        Returns the list of (object path, relname) files to be installed.
+        """
+        files, hashes, added = self.store.add_files(
+            files,
+            utils.read_manifest(self.hashes_path),
+            workers=self.copy_workers
+        )
+        utils.write_manifest(self.hashes_path, hashes)
+        # Saved before the objects are linked, so that they are kept if the
+        # store is collected meanwhile.
+        self.store.write_manifest(self.lib_path, files)
+        self.logger.info('Added %d files to %r, %d already stored.',
+                         added, self.store.path, len(files) - added)
+
+        return files
+
+    def slim_files(self, files, phase):
+        """Removes the docstrings and comments of the python sources.
+
+        Slimmed files are cached in the parts dir, keyed by the content of
+        the source, and the list of files with the python sources replaced
+        by the slimmed ones is returned.
+        """
+        cache_dir = os.path.join(self.part_dir, 'slim')
+        sources = sorted(set(
+            srcname for srcname, relname in files
+            if relname.endswith('.py') and not self.slim_ignore.match(relname)
+        ))
+        results = utils.map_processes(
+            slim.slim_file,
+            [(srcname, cache_dir) for srcname in sources],
+            workers=self.slim_workers
+        )
+
+        slimmed = {}
+        size = 0
+        slim_size = 0
+        errors = []
+        for srcname, result in zip(sources, results):
+            path, src_size, path_size, error = result
+            slimmed[srcname] = path
+            size += src_size
+            slim_size += path_size
+            if error is not None:
+                errors.append((srcname, error))
+
+        phase.count(files=len(sources), bytes=size)
+        self.logger.info('Slimmed %d python sources from %d to %d bytes.',
+                         len(sources), size, slim_size)
+        if errors:
+            self.logger.info('%d sources could not be slimmed and are '
+                             'installed unchanged:', len(errors))
+            for srcname, error in sorted(errors):
+                self.logger.info('  %s: %s', srcname, error)
+
+        # Remove slimmed files for sources that are no longer used.
+        used = set(slimmed.values())
+        if os.path.isdir(cache_dir):
+            for root, dirs, entries in utils.walk(cache_dir):
+                for entry in entries:
+                    if entry.path not in used:
+                        os.remove(entry.path)
+
+        return [(slimmed.get(srcname, srcname), relname)
+                for srcname, relname in files]
+
+    def remove_bytecode(self, files):
+        """Removes the bytecode of the python files from the eggs.
+
+        It is compiled again, so it is not added to `shared-lib-store` nor
+        installed.
+        """
+        sources = set(relname for _, relname in files
+                      if relname.endswith('.py'))
+        return [(srcname, relname) for srcname, relname in files
+                if not (relname.endswith(('.pyc', '.pyo')) and
+                        relname[:-1] in sources)]
+
+    def compile_in_app_dir(self, files, lib_path):
+        """Byte-compiles the python files installed in `lib_path`."""
+        to_compile = []
+        for relname in set(relname for _, relname in files):
+            if relname.endswith('.py'):
+                to_compile.append((
+                    os.path.join(lib_path, relname),
+                    os.path.join(lib_path, relname) + self.bytecode_ext,
+                    self.get_code_filename(relname),
+                    None
+                ))
+
+        self.compile_files(to_compile)
+
+    def compile_for_zip(self, files):
+        """Byte-compiles the python files to be zipped.
+
+        Bytecode is cached in the parts dir, keyed by the source file, and
+        the list of (cfile, relname) files to be zipped is returned.
+        """
+        cache_dir = os.path.join(self.part_dir, 'bytecode')
+        # Bytecode in the zip must have the same timestamp as the source
+        # member. zipimport compares them in local time, and App Engine runs
+        # in UTC.
+        mtime = calendar.timegm(recipe.ZIP_DATE_TIME)
+
+        to_compile = []
+        result = []
+        seen = set()
+        for srcname, relname in files:
+            if not relname.endswith('.py') or relname in seen:
+                continue
+
+            seen.add(relname)
+            st = utils.stat_file(srcname)
+            key = hashlib.sha1('%s\0%d\0%r\0%d' % (
+                srcname, st.st_size, st.st_mtime,
+                self.precompile_optimize)).hexdigest()
+            cfile = os.path.join(cache_dir, key[:2], key + self.bytecode_ext)
+            to_compile.append(
+                (srcname, cfile, self.get_code_filename(relname), mtime))
+            result.append((cfile, relname + self.bytecode_ext))
+
+        for dirname in set(os.path.dirname(item[1]) for item in to_compile):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+        failed = set(source for source, error in
+                     self.compile_files(to_compile))
+        result = [item for item, (srcname, _, _, _) in
+                  zip(result, to_compile) if srcname not in failed]
+
+        # Remove bytecode for sources that are no longer used.
+        used = set(item[0] for item in result)
+        if os.path.isdir(cache_dir):
+            for root, dirs, entries in utils.walk(cache_dir):
+                for entry in entries:
+                    if entry.path not in used:
+                        os.remove(entry.path)
+
+        return result
+
+    def compile_files(self, to_compile):
+        """Byte-compiles files, reporting the ones that failed."""
+        with self.timer.phase('compile') as phase:
+            compiled, errors = recipe.compile_files(
+                to_compile,
+                optimize=self.precompile_optimize,
+                workers=self.precompile_workers
+            )
+            phase.count(files=compiled)
+
+        self.logger.info('Byte-compiled %d modules, %d up to date.',
+                         compiled, len(to_compile) - compiled - len(errors))
+        if errors:
+            self.logger.warning('%d modules failed to compile and were '
+                                'skipped:', len(errors))
+            for source, error in sorted(errors):
+                self.logger.warning('  %s: %s', source, error)
+
+        return errors
+
+    @property
+    def bytecode_ext(self):
+        if self.precompile_optimize:
+            return 'o'
+
+        return 'c'
+
+    def get_code_filename(self, relname):
+        """Returns the module file name shown in tracebacks.
+
+        It's relative to the app dir, so that sources are found if the app
+        dir is in sys.path, and doesn't leak the build path.
+        """
+        if self.use_zip and not self.use_single_zip:
+            return os.path.join(os.path.basename(self.lib_path),
+                                self.get_zip_name(relname), relname)
+
+        return os.path.join(os.path.basename(self.lib_path), relname)
+
+    def get_zip_name(self, relname):
+        """Returns the name of the package zip where a file is installed."""
+        name = relname.split(os.sep)[0]
+        if name == relname:
+            # A top-level module.
+            name = os.path.splitext(name)[0]
+
+        return name + '.zip'
+
+    def build_zip(self, files):
+        """Creates the lib zip, replacing the old one only if it changed.
+
+        `files` is a list of (srcname, relname) files to be zipped. Returns
+        the report of the zip.
+        """
+        tmp_path = self.lib_path + '.tmp'
+        previous = None
+        if self.incremental and os.path.isfile(self.lib_path):
+            previous = self.lib_path
+
+        recipe.zipfiles(
+            files,
+            tmp_path,
+            previous=previous,
+            data={'README.txt': LIB_README},
+            workers=self.zip_workers,
+            logger=self.logger
+        )
+
+        report = self.check_libs(tmp_path)
+        if (os.path.isfile(self.lib_path) and
+                filecmp.cmp(tmp_path, self.lib_path, shallow=False)):
+            # Keep the old file so that its timestamp doesn't change.
+            os.remove(tmp_path)
+            self.logger.info('Lib-zip %r is unchanged.' % self.lib_path)
+            return report
+
+        self.swap_libs(tmp_path)
+        return report
+
+    def build_package_zips(self, files):
+        """Creates a zip for each top-level package in `lib-directory`.
+
+        Only the zips whose files changed since the last build are created
+        again; the others are hardlinked from the old `lib-directory`. The
+        zips are listed in a `.pth` file, so that they are added to sys.path
+        by site.addsitedir(`lib-directory`). Returns the report of the zips.
+        """
+        packages = {}
+        for srcname, relname in files:
+            packages.setdefault(self.get_zip_name(relname), []).append(
+                (srcname, relname))
+
+        manifest = utils.read_manifest(self.manifest_path)
+        if (manifest.get('lib-directory') != self.lib_path or
+                manifest.get('zip-layout') != self.zip_layout or
+                not os.path.isdir(self.lib_path)):
+            manifest = {}
+
+        staging_path = self.get_staging_path()
+        old_zips = manifest.get('zips', {})
+        zips = {}
+        created = 0
+        for zip_name in sorted(packages):
+            path = os.path.join(staging_path, zip_name)
+            old_path = os.path.join(self.lib_path, zip_name)
+            signature = self.get_zip_signature(packages[zip_name])
+            info = old_zips.get(zip_name, {})
+            if (info.get('signature') == signature and
+                    os.path.isfile(old_path) and
+                    os.path.getsize(old_path) == info.get('size')):
+                utils.install_file(old_path, path, 'hardlink')
+                zips[zip_name] = info
+                continue
+
+            previous = None
+            if self.incremental:
+                previous = old_path
+
+            recipe.zipfiles(
+                packages[zip_name],
+                path,
+                previous=previous,
+                workers=self.zip_workers,
+                logger=self.logger
+            )
+            zips[zip_name] = {
+                'signature': signature,
+                'size': os.path.getsize(path),
+            }
+            created += 1
+
+        f = open(os.path.join(staging_path, ZIPS_PTH), 'w')
+        f.write(''.join(zip_name + '\n' for zip_name in sorted(zips)))
+        f.close()
+
+        f = open(os.path.join(staging_path, 'README.txt'), 'w')
+        f.write(LIB_README)
+        f.close()
+
+        self.logger.info('Created %d of %d package zips in %r.',
+                         created, len(zips), self.lib_path)
+
+        report = self.check_libs(staging_path)
+        self.remove_manifest()
+        self.swap_libs(staging_path)
+
+        utils.write_manifest(self.manifest_path, {
+            'lib-directory': self.lib_path,
+            'zip-layout': self.zip_layout,
+            'zips': zips,
+        })
+        return report
+
+    def remove_other_layout(self):
+        """Removes the libraries built before with another layout.
+
+        With `use-zipimport` and the `single` zip layout, this is the
+        libraries directory, otherwise it is the lib zip. They are only
+        removed if they have the README of this recipe, as `lib-directory`
+        is when it's replaced.
+        """
+        if self.use_single_zip:
+            path = self.lib_path[:-4]
+            try:
+                f = open(os.path.join(path, 'README.txt'))
+            except IOError:
+                return
+
+            try:
+                readme = f.read()
+            finally:
+                f.close()
+        else:
+            path = self.lib_path + '.zip'
+            try:
+                z = zipfile.ZipFile(path, 'r')
+            except (IOError, zipfile.BadZipfile):
+                return
+
+            try:
+                readme = z.read('README.txt')
+            except KeyError:
+                return
+            finally:
+                z.close()
+
+        if readme == LIB_README:
+            self.logger.info('Removing %r, built with another layout.', path)
+            self.delete_libs(path)
+
+    def remove_manifest(self):
+        """Removes the manifest before `lib-directory` is replaced.
+
+        It describes the old libraries until then, and a new one is only
+        written if the new libraries are installed.
+        """
+        if os.path.isfile(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    def get_zip_signature(self, files):
+        """Returns a hash of the names and stats of the files to be zipped."""
+        sha1 = hashlib.sha1()
+        for srcname, relname in files:
+            st = utils.stat_file(srcname)
+            sha1.update('%s\0%s\0%d\0%r\0' % (
+                relname, srcname, st.st_size, st.st_mtime))
+
+        return sha1.hexdigest()
+
+    def sync_in_app_dir(self, files):
+        """Updates `lib-directory` using the manifest of the last build.
+
+        The new libraries are synced in a copy of `lib-directory` made of
+        hardlinks, which replaces it when complete. Files are never written
+        in place, so the old libraries don't change. If there's no manifest
+        for the current `lib-directory` and `install-mode`, the directory is
+        created from scratch. Returns the report of `lib-directory`.
+        """
+        manifest = utils.read_manifest(self.manifest_path)
+        if (manifest.get('lib-directory') != self.lib_path or
+                manifest.get('install-mode', 'copy') != self.install_mode or
+                manifest.get('zip-layout') is not None or
+                not os.path.isdir(self.lib_path)):
+            lib_path = self.get_staging_path()
+            manifest = {}
+        else:
+            lib_path = self.get_staging_copy()
+
+        installed = recipe.sync_files(
+            files,
+            lib_path,
+            manifest.get('files', {}),
+            workers=self.copy_workers,
+            mode=self.install_mode,
+            logger=self.logger
+        )
+
+        readme = os.path.join(lib_path, 'README.txt')
+        if not os.path.isfile(readme):
+            f = open(readme, 'w')
+            f.write(LIB_README)
+            f.close()
+
+        if self.precompile:
+            self.compile_in_app_dir(files, lib_path)
+
+        report = self.check_libs(lib_path)
+        self.remove_manifest()
+        self.swap_libs(lib_path)
+
+        utils.write_manifest(self.manifest_path, {
+            'lib-directory': self.lib_path,
+            'install-mode': self.install_mode,
+            'files': installed,
+        })
+        return report
+
+    def get_install_files(self, paths):
+        """Returns the list of (srcname, relname) files to be installed."""
+        files = []
         for name, src in paths:
             if name in self.ignore_packages:
                 # This package or module must be ignored.
                 continue
 
-            dst = os.path.join(tmp_dir, name)
+            dirname = os.path.dirname(src) + os.sep
+            if utils.split_zip_path(src) is not None:
+                # Package or module in a zipped egg.
+                found = list(recipe.iter_files(src, dirname,
+                                               ignore=self.to_ignore))
+                if not found:
+                    found = list(recipe.iter_files(src + '.py', dirname,
+                                                   ignore=self.to_ignore))
+                    if not found:
+                        continue
+
+                files.extend(found)
+                continue
+
             if not os.path.isdir(src):
                 # Try single files listed as modules.
                 src += '.py'
-                dst += '.py'
-                if not os.path.isfile(src) or os.path.isfile(dst):
+                if not os.path.isfile(src):
                     continue
 
-            self.logger.info('Copying %r...' % src)
-
-            to_ignore = recipe.ignore_patterns(*self.ignore_globs)
-            recipe.copytree(
+            files.extend(recipe.iter_files(
                 src,
-                dst,
-                os.path.dirname(src) + os.sep,
-                ignore=to_ignore,
-                logger=self.logger
-            )
+                dirname,
+                ignore=self.to_ignore
+            ))
 
-        # Save README.
-        f = open(os.path.join(tmp_dir, 'README.txt'), 'w')
-        f.write(LIB_README)
-        f.close()
+        return files
 
-        if self.use_zip:
-            # Zip file and remove temporary dir.
-            recipe.zipdir(tmp_dir, self.lib_path)
-            if os.path.isdir(tmp_dir):
-                shutil.rmtree(tmp_dir)
+    def prune_unreachable(self, files):
+        """Removes modules not imported from `prune-entry-points`.
+
+        Other files are kept if any module from the same top-level package
+        is used.
+        """
+        modules = {}
+        for srcname, relname in files:
+            name = importgraph.get_module_name(relname)
+            if name is not None and (name not in modules or
+                                     srcname.endswith('.py')):
+                modules[name] = srcname
+
+        roots = []
+        paths = []
+        for entry_point in self.prune_entry_points:
+            dirname = os.path.dirname(entry_point)
+            if entry_point.endswith('.yaml'):
+                roots.extend(importgraph.get_app_yaml_scripts(entry_point))
+                roots.append('appengine_config')
+            else:
+                roots.append(importgraph.get_module_name(
+                    os.path.basename(entry_point)))
+
+            if dirname not in paths:
+                paths.append(dirname)
+
+        graph = importgraph.ImportGraph(modules, paths)
+        reached = graph.walk(roots, allow=self.prune_allow)
+        for name, error in sorted(graph.errors.items()):
+            self.logger.warning('Could not find imports of %r: %s',
+                                name, error)
+
+        packages = set(name.split('.')[0] for name in reached)
+        result = []
+        dropped = {}
+        for srcname, relname in files:
+            name = importgraph.get_module_name(relname)
+            if name is None:
+                keep = relname.split(os.sep)[0] in packages
+            else:
+                keep = name in reached
+
+            if keep:
+                result.append((srcname, relname))
+            else:
+                stats = dropped.setdefault(relname.split(os.sep)[0], [0, 0])
+                stats[0] += 1
+                stats[1] += utils.stat_file(srcname).st_size
+
+        if dropped:
+            self.logger.info(
+                'Pruned %d unreachable files, saving %d bytes:',
+                sum(s[0] for s in dropped.values()),
+                sum(s[1] for s in dropped.values()))
+            for package, (count, size) in sorted(dropped.items()):
+                if package.split('.')[0] in packages:
+                    self.logger.info('  %s: %d files (%d bytes)',
+                                     package, count, size)
+                else:
+                    self.logger.info('  %s: whole package (%d bytes)',
+                                     package, size)
+
+        return result
 
     def get_package_paths(self, ws):
         """Returns the list of package paths to be copied."""
+        # Top-level names are cached by egg path, and only read again if the
+        # metadata file changed.
+        cache = utils.read_manifest(self.metadata_cache_path)
+        new_cache = {}
         pkgs = []
         for path in ws.entries:
-            lib_paths = self.get_lib_paths(path)
+            lib_paths = None
+            cached = cache.get(path)
+            if cached is not None:
+                try:
+                    st = utils.stat_file(cached['top_level'])
+                except (IOError, OSError):
+                    pass
+                else:
+                    if (st.st_size == cached['size'] and
+                            st.st_mtime == cached['mtime']):
+                        # Module names are ascii; keep them as str.
+                        lib_paths = [str(lib) for lib in cached['libs'] or ()]
+                        new_cache[path] = cached
+
+            if lib_paths is None:
+                top_level = self.get_top_level_path(path)
+                if top_level is not None:
+                    st = utils.stat_file(top_level)
+                    lib_paths = self.get_top_level_libs(
+                        os.path.dirname(top_level))
+                    new_cache[path] = {
+                        'top_level': top_level,
+                        'size': st.st_size,
+                        'mtime': st.st_mtime,
+                        'libs': lib_paths,
+                    }
+
             if not lib_paths:
                 self.logger.info(
                     'Library not installed: missing egg info for %r.',
@@ -192,31 +1078,50 @@ class Recipe(egg.Scripts):
             for lib_path in lib_paths:
                 pkgs.append((lib_path, os.path.join(path, lib_path)))
 
+        if new_cache != cache:
+            utils.write_manifest(self.metadata_cache_path, new_cache)
+
         return pkgs
 
     def get_top_level_libs(self, egg_path):
         top_path = os.path.join(egg_path, 'top_level.txt')
-        if not os.path.isfile(top_path):
+        try:
+            f = utils.open_file(top_path)
+        except (IOError, OSError):
             return None
 
-        f = open(top_path, 'r')
-        libs = f.read().strip()
-        f.close()
+        try:
+            libs = f.read().strip()
+        finally:
+            f.close()
 
         # One lib per line.
         return [l.strip() for l in libs.splitlines() if l.strip()]
 
     def get_lib_paths(self, path):
-        """Returns the 'EGG-INFO' or '.egg-info' directory."""
+        """Returns the top-level libraries listed in the egg metadata."""
+        top_level = self.get_top_level_path(path)
+        if top_level is None:
+            return None
+
+        return self.get_top_level_libs(os.path.dirname(top_level))
+
+    def get_top_level_path(self, path):
+        """Returns 'top_level.txt' from the 'EGG-INFO' or '.egg-info' dir."""
         egg_path = os.path.join(path, 'EGG-INFO')
         if os.path.isdir(egg_path):
             # Unzipped egg metadata.
-            return self.get_top_level_libs(egg_path)
+            return self.find_top_level(egg_path)
 
         if os.path.isfile(path):
-            # Zipped egg? Should we try to unpack it?
-            # unpack_archive(path, self.eggs_dir)
-            return None
+            # Zipped egg: its files are read from the zip file.
+            top_path = os.path.join(path, 'EGG-INFO', 'top_level.txt')
+            try:
+                utils.stat_file(top_path)
+            except (IOError, OSError):
+                return None
+
+            return top_path
 
         # Last try: develop eggs.
         elif os.path.isdir(path):
@@ -224,19 +1129,111 @@ class Recipe(egg.Scripts):
             for filename in files:
                 if filename.endswith('.egg-info'):
                     egg_path = os.path.join(path, filename)
-                    return self.get_top_level_libs(egg_path)
+                    return self.find_top_level(egg_path)
+
+    def find_top_level(self, egg_path):
+        top_path = os.path.join(egg_path, 'top_level.txt')
+        if not os.path.isfile(top_path):
+            return None
+
+        return top_path
+
+    def get_staging_path(self):
+        """Returns an empty directory beside `lib-directory` to build in."""
+        staging_path = self.lib_path + '.staging'
+        if os.path.isdir(staging_path):
+            # Left by a failed build.
+            shutil.rmtree(staging_path)
+
+        os.mkdir(staging_path)
+        return staging_path
 
-    def delete_libs(self):
+    def get_staging_copy(self):
+        """Returns a staging directory with the files of `lib-directory`.
+
+        Files are hardlinked, or copied if they can't be linked.
+        """
+        staging_path = self.get_staging_path()
+        with self.timer.phase('link-old-libs') as phase:
+            files = list(recipe.iter_files(self.lib_path,
+                                           self.lib_path + os.sep))
+            recipe.copy_files(files, staging_path, workers=self.copy_workers,
+                              mode='hardlink')
+            phase.count(files=len(files))
+
+        return staging_path
+
+    def swap_libs(self, new_path):
+        """Replaces `lib-directory` or the lib zip by `new_path`.
+
+        The old libraries are renamed beside the new ones just before these
+        are renamed in place, so `lib-directory` is never incomplete, and is
+        only missing between the two renames. Old libraries are then removed
+        or backed up in a background thread, which buildout goes on without:
+        python waits for it before exiting.
+        """
+        old_path = None
+        if os.path.exists(self.lib_path):
+            old_path = self.lib_path + '.old'
+            thread = _delete_threads.pop(old_path, None)
+            if thread is not None:
+                thread.join()
+
+            if os.path.exists(old_path):
+                # Left by a failed build.
+                self.delete_libs(old_path)
+
+            with self.timer.phase('swap'):
+                os.rename(self.lib_path, old_path)
+                os.rename(new_path, self.lib_path)
+        else:
+            os.rename(new_path, self.lib_path)
+
+        if old_path is not None:
+            # Not needed to finish the build, so it is done while buildout
+            # goes on with other parts.
+            self.delete_thread = threading.Thread(
+                target=self.delete_libs_in_thread, args=(old_path,))
+            self.delete_thread.start()
+            _delete_threads[old_path] = self.delete_thread
+
+    def delete_libs_in_thread(self, lib_path):
+        """Removes or backs up the old libraries, logging any error.
+
+        The new libraries are already installed, so errors don't stop the
+        build. Not timed, as the build doesn't wait for it.
+        """
+        try:
+            self._delete_libs(lib_path)
+        except Exception as e:
+            self.logger.error('Error removing the old libraries %r: %s: %s',
+                              lib_path, e.__class__.__name__, e)
+
+    def wait_delete_libs(self):
+        """Waits until the old libraries are removed."""
+        if self.delete_thread is not None:
+            self.delete_thread.join()
+            self.delete_thread = None
+
+    def delete_libs(self, lib_path=None):
         """Removes old libraries
 
         If the `delete-safe` option is set to true, move the old libraries
         directory to a temporary directory inside the parts dir instead of
-        deleting it.
+        deleting it, and remove the oldest backups beyond the
+        `delete-safe-keep` and `delete-safe-max-bytes` limits.
         """
-        if not os.path.exists(self.lib_path):
+        if lib_path is None:
+            lib_path = self.lib_path
+
+        if not os.path.exists(lib_path):
             # Nothing to delete, so it is safe.
             return
 
+        with self.timer.phase('delete-libs'):
+            self._delete_libs(lib_path)
+
+    def _delete_libs(self, lib_path):
         if self.delete_safe is True:
             # Move directory or zip to temporary backup directory.
             if not os.path.exists(self.temp_dir):
@@ -244,20 +1241,65 @@ class Recipe(egg.Scripts):
 
             date = datetime.datetime.now().strftime('_%Y_%m_%d_%H_%M_%S')
             filename = os.path.basename(self.lib_path.rstrip(os.sep))
-            if self.use_zip:
-                filename = filename[:-4] + date + '.zip'
+            if self.use_single_zip:
+                filename = filename[:-4]
+
+            # Libraries of another layout may be removed too.
+            if os.path.isfile(lib_path):
+                filename += date + '.zip'
             else:
                 filename += date
 
             dst = os.path.join(self.temp_dir, filename)
-            shutil.move(self.lib_path, dst)
+            if os.path.exists(dst):
+                # More than one backup in the same second.
+                dst += '_' + uuid.uuid4().hex[:8]
+
+            shutil.move(lib_path, dst)
             self.logger.info('Saved libraries backup in %r.' % dst)
+            self.prune_backups()
         else:
             # Simply delete the directory or zip.
-            if self.use_zip:
-                os.remove(self.lib_path)
-                self.logger.info('Removed lib-zip %r.' % self.lib_path)
+            if os.path.isfile(lib_path):
+                os.remove(lib_path)
+                self.logger.info('Removed lib-zip %r.' % lib_path)
             else:
                 # Delete the directory.
-                shutil.rmtree(self.lib_path)
-                self.logger.info('Removed lib-directory %r.' % self.lib_path)
+                shutil.rmtree(lib_path)
+                self.logger.info('Removed lib-directory %r.' % lib_path)
+
+    def prune_backups(self):
+        """Removes the oldest backups beyond the retention limits."""
+        name = os.path.basename(self.lib_path.rstrip(os.sep))
+        if self.use_single_zip:
+            name = name[:-4]
+
+        # Backups of other libraries may start with the same name.
+        backup_re = re.compile(re.escape(name) + BACKUP_DATE_RE + (
+            r'\.zip$' if self.use_single_zip else '$'))
+        backups = []
+        for filename in os.listdir(self.temp_dir):
+            match = backup_re.match(filename)
+            if match is not None:
+                backup = os.path.join(self.temp_dir, filename)
+                # Moving a backup sets its ctime, after the date in the name.
+                backups.append((match.group(1), os.stat(backup).st_ctime,
+                                backup))
+
+        backups = [entry[2] for entry in sorted(backups, reverse=True)]
+
+        total = 0
+        for i, path in enumerate(backups):
+            total += utils.get_size(path)
+            if i == 0:
+                # Always keep the last backup.
+                continue
+
+            if (self.backup_keep and i >= self.backup_keep or
+                    self.backup_max_bytes and total > self.backup_max_bytes):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+                self.logger.info('Removed old libraries backup %r.' % path)
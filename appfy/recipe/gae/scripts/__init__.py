@@ -89,8 +89,8 @@ def get_config(filename, section=None, key=None):
         return None
 
 
-def get_dev_appserver_config(config_file):
-    config = get_config(config_file, 'dev_appserver', 'defaults')
+def get_dev_appserver_config(config_file, section='dev_appserver'):
+    config = get_config(config_file, section, 'defaults')
     if config:
         # Only accept multi-line configuration.
         config = [o.strip() for o in config.splitlines() if o.strip()]
@@ -127,3 +127,23 @@ def remote_api_shell(base, gae_path, config_file):
 
 def endpointscfg(base, gae_path, config_file):
     runpy.run_module('endpointscfg', run_name='__main__', alter_sys=True)
+
+
+def import_profile(base, gae_path, config_file):
+    from appfy.recipe.gae.scripts import profiler
+
+    config = get_dev_appserver_config(config_file, 'import_profile')
+    if config:
+        sys.argv = get_dev_appserver_argv(config)
+
+    profiler.main(sys.argv[1:], extra_paths=[gae_path])
+
+
+def lib_store_gc(base, gae_path, config_file):
+    from appfy.recipe import store
+
+    config = get_dev_appserver_config(config_file, 'lib_store_gc')
+    if config:
+        sys.argv = get_dev_appserver_argv(config)
+
+    store.main(sys.argv[1:])
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""Measures the import cost of the libraries installed by app_lib.
+
+Each library is imported in a fresh interpreter, one at a time.
+"""
+import json
+import optparse
+import os
+import subprocess
+import sys
+import zipfile
+
+from appfy.recipe import importgraph
+
+# Imports a library and writes its import time, the number of modules it
+# imported and the memory growth to stdout.
+_PROFILE_SCRIPT = """
+import json, os, sys, time
+
+def get_memory():
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+sys.path[0:0] = json.loads(sys.argv[1])
+name = sys.argv[2]
+before = set(sys.modules)
+memory = get_memory()
+error = None
+start = time.time()
+try:
+    __import__(name)
+except BaseException as e:
+    error = '%s: %s' % (e.__class__.__name__, e)
+elapsed = time.time() - start
+if memory is not None:
+    memory = get_memory() - memory
+modules = [m for m in sys.modules if m not in before and sys.modules[m]]
+sys.stdout.write(json.dumps({
+    'name': name,
+    'time': elapsed,
+    'modules': len(modules),
+    'memory': memory,
+    'error': error,
+}))
+"""
+
+
+def get_sys_paths(lib_path):
+    """Returns the sys.path entries needed to import from `lib_path`.
+
+    Like site.addsitedir(), the paths listed in the `.pth` files of a
+    libraries directory are added after it, e.g. the package zips of the
+    `per-package` zip layout of app_lib.
+    """
+    paths = [lib_path]
+    if not os.path.isdir(lib_path):
+        return paths
+
+    for filename in sorted(os.listdir(lib_path)):
+        if not filename.endswith('.pth'):
+            continue
+
+        f = open(os.path.join(lib_path, filename), 'rU')
+        try:
+            lines = f.read().splitlines()
+        finally:
+            f.close()
+
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(('#', 'import ', 'import\t')):
+                continue
+
+            path = os.path.join(lib_path, line)
+            if os.path.exists(path) and path not in paths:
+                paths.append(path)
+
+    return paths
+
+
+def find_libraries(lib_path):
+    """Returns the names of the top-level packages and modules in `lib_path`.
+
+    `lib_path` is a libraries directory or zip file. Zip files inside a
+    directory are not searched; use get_sys_paths() to find them.
+    """
+    if zipfile.is_zipfile(lib_path):
+        z = zipfile.ZipFile(lib_path, 'r')
+        try:
+            names = z.namelist()
+        finally:
+            z.close()
+
+        packages = set(name.split('/')[0] for name in names
+                       if name.count('/') == 1 and
+                       name.split('/')[1].startswith('__init__.'))
+        modules = set(name for name in names if '/' not in name)
+    else:
+        names = os.listdir(lib_path)
+        packages = set(name for name in names if
+                       os.path.isfile(os.path.join(lib_path, name,
+                                                   '__init__.py')) or
+                       os.path.isfile(os.path.join(lib_path, name,
+                                                   '__init__.pyc')))
+        modules = set(name for name in names
+                      if os.path.isfile(os.path.join(lib_path, name)))
+
+    for name in modules:
+        base, ext = os.path.splitext(name)
+        if ext in importgraph.MODULE_EXTENSIONS and base != '__init__':
+            packages.add(base)
+
+    return sorted(packages)
+
+
+def profile_library(name, paths):
+    """Imports a library in a new interpreter and returns its import costs.
+
+    `paths` is the list of paths inserted at the start of sys.path.
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-c', _PROFILE_SCRIPT, json.dumps(paths), name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    out, err = process.communicate()
+    try:
+        return json.loads(out)
+    except ValueError:
+        lines = err.strip().splitlines()
+        if not lines:
+            lines = ['Exit code %d' % process.returncode]
+
+        return {
+            'name': name,
+            'time': None,
+            'modules': None,
+            'memory': None,
+            'error': lines[-1],
+        }
+
+
+def format_report(results):
+    """Returns the profile results as a text table."""
+    row = '%-40s %10s %8s %12s'
+    lines = [row % ('Library', 'Time (ms)', 'Modules', 'Memory (KB)')]
+    lines.append('-' * len(lines[0]))
+    for result in results:
+        if result['time'] is None:
+            time = '-'
+        else:
+            time = '%.1f' % (result['time'] * 1000)
+
+        if result['memory'] is None:
+            memory = '-'
+        else:
+            memory = '%d' % (result['memory'] / 1024)
+
+        lines.append(row % (result['name'], time, result['modules'] or '-',
+                            memory))
+        if result['error']:
+            lines.append('    %s' % result['error'])
+
+    return '\n'.join(lines)
+
+
+def main(argv, extra_paths=()):
+    parser = optparse.OptionParser(
+        usage='%prog [options] LIB_PATH',
+        description='Imports each library found in LIB_PATH, a libraries '
+                    'directory or zip file, in a fresh interpreter and '
+                    'reports the slowest ones.'
+    )
+    parser.add_option(
+        '--output', default=None,
+        help='Also write the report to OUTPUT.txt and OUTPUT.json.')
+    parser.add_option(
+        '--sort', default='time', choices=('time', 'modules', 'memory'),
+        help='Sort libraries by time, modules or memory. Default: time.')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('LIB_PATH is required.')
+
+    lib_path = os.path.abspath(args[0])
+    if not os.path.exists(lib_path):
+        parser.error('%s does not exist.' % lib_path)
+
+    lib_paths = get_sys_paths(lib_path)
+    names = set()
+    for path in lib_paths:
+        names.update(find_libraries(path))
+
+    paths = lib_paths + list(extra_paths)
+    results = [profile_library(name, paths) for name in sorted(names)]
+    results.sort(key=lambda r: r[options.sort] or 0, reverse=True)
+
+    report = format_report(results)
+    sys.stdout.write(report + '\n')
+
+    if options.output:
+        dirname = os.path.dirname(os.path.abspath(options.output))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        f = open(options.output + '.txt', 'w')
+        try:
+            f.write(report + '\n')
+        finally:
+            f.close()
+
+        f = open(options.output + '.json', 'w')
+        try:
+            json.dump({'lib-path': lib_path, 'libraries': results}, f,
+                      indent=2, sort_keys=True)
+        finally:
+            f.close()
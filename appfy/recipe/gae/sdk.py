@@ -13,6 +13,35 @@ Options
 :destination: Destination of the extracted SDK. Default is the parts directory.
 :clear-destination: If `true`, deletes the destination dir before
     extracting the download. Default is `true`.
+:download-segments: Number of HTTP range requests used at the same time
+    to download the SDK. Interrupted downloads are resumed from the
+    download cache in the next run. Servers that don't support ranges are
+    downloaded in a single stream. `0` uses the zc.buildout downloader,
+    which starts over. Default is `0`.
+:stream-extract: If `true`, the SDK is extracted while it is downloaded
+    with `download-segments`: zip members are extracted as soon as they
+    arrive, and tar files in order. Default is `false`.
+:md5sum, sha1sum, sha256sum, sha512sum: Checksums of the SDK file. All of
+    them are computed in a single read of the file, or while it is
+    downloaded with `download-segments`. They are recorded beside the file
+    in the download cache, and not computed again while its size,
+    modification time and inode don't change. Default is none.
+:paranoid-verify: If `true`, the checksums of the cached SDK file are always
+    computed again. Default is `false`.
+:incremental-extract: If `true`, with `clear-destination`, keep a manifest of
+    the extracted files and only write the files that changed since the last
+    extraction, comparing their size and CRC in zip files or their header in
+    tar files. Files that are not in the SDK anymore are removed. When the
+    part is uninstalled, the extracted files are moved from the destination
+    to `extract-directory`, and moved back to be compared when it is
+    installed again. The SDK is not extracted while it is downloaded.
+    Default is `false`.
+:extract-directory: Directory with the manifest and the files kept by
+    `incremental-extract`. Default is the part name plus `.extract` in the
+    parts directory.
+:timing-log: File where the time of each phase (download, checksum,
+    extraction...), with the files and bytes it processed, is appended as a
+    JSON line. A summary of the phases is always logged. Default is none.
 
 Example
 ~~~~~~~
@@ -64,11 +93,12 @@ class Recipe(download.Recipe):
 
         super(Recipe, self).__init__(buildout, name, options)
 
-    def install(self):
+    def install_download(self):
         if not self.option_url:
-            self.option_url = self.find_latest_sdk_url()
+            with self.timer.phase('find-sdk'):
+                self.option_url = self.find_latest_sdk_url()
         self.logger.info('Using SDK version found at %s', self.option_url)
-        return super(Recipe, self).install()
+        return super(Recipe, self).install_download()
 
     def find_latest_sdk_url(self):
         def version_key(sdk):
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""Tests of appfy.recipe.gae.app_lib on synthetic eggs."""
+import imp
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import zc.buildout
+
+from appfy.recipe.gae import app_lib
+
+
+class WorkingSet(object):
+
+    def __init__(self, entries):
+        self.entries = entries
+
+
+def load_compiled(name, cfile):
+    """Loads bytecode as a new module: load_compiled() reuses modules."""
+    sys.modules.pop(name, None)
+    try:
+        return imp.load_compiled(name, cfile)
+    finally:
+        sys.modules.pop(name, None)
+
+
+class AppLibTestCase(unittest.TestCase):
+    """Installs two synthetic eggs with app_lib."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.recipes = []
+        self.eggs = []
+        for name in ('pkg_a', 'pkg_b'):
+            egg = os.path.join(self.tmp, 'eggs', '%s-1.0-py2.7.egg' % name)
+            os.makedirs(os.path.join(egg, 'EGG-INFO'))
+            os.makedirs(os.path.join(egg, name))
+            self.write(os.path.join(egg, 'EGG-INFO', 'top_level.txt'),
+                       name + '\n')
+            # The same content in both eggs, stored once.
+            self.write(os.path.join(egg, name, '__init__.py'), 'x = 1\n')
+            self.write(os.path.join(egg, name, 'mod.py'),
+                       '"""Module of %s."""\nname = %r\n' % (name, name))
+            # Bytecode left in the egg.
+            self.write(os.path.join(egg, name, 'mod.pyc'), 'egg bytecode')
+            self.eggs.append(egg)
+
+        for name in ('app', 'parts', 'bin', 'develop-eggs'):
+            os.makedirs(os.path.join(self.tmp, name))
+
+        self.lib_path = os.path.join(self.tmp, 'app', 'distlib')
+
+    def tearDown(self):
+        for recipe in self.recipes:
+            recipe.wait_delete_libs()
+
+        # Store objects are read-only.
+        for root, dirs, files in os.walk(self.tmp):
+            for name in files:
+                os.chmod(os.path.join(root, name), 0644)
+
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, content):
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+
+    def get_options(self):
+        return {
+            'lib-directory': self.lib_path,
+            'ignore-globs': '*.pyc',
+            'delete-safe': 'false',
+        }
+
+    def install(self, **options):
+        buildout = {'buildout': {
+            'eggs-directory': os.path.join(self.tmp, 'eggs'),
+            'develop-eggs-directory': os.path.join(self.tmp, 'develop-eggs'),
+            'parts-directory': os.path.join(self.tmp, 'parts'),
+            'bin-directory': os.path.join(self.tmp, 'bin'),
+            'directory': self.tmp,
+            'find-links': '',
+            'allow-hosts': '*',
+            'python': 'buildout',
+            'executable': sys.executable,
+            'offline': 'true',
+        }}
+        opts = self.get_options()
+        opts.update(options)
+        recipe = app_lib.Recipe(buildout, 'app_lib', opts)
+        self.recipes.append(recipe)
+        recipe.install_in_app_dir(recipe.get_package_paths(
+            WorkingSet(self.eggs)))
+        return recipe
+
+
+class TestStorePrecompile(AppLibTestCase):
+
+    def setUp(self):
+        super(TestStorePrecompile, self).setUp()
+        self.store_path = os.path.join(self.tmp, 'store')
+
+    def get_options(self):
+        options = super(TestStorePrecompile, self).get_options()
+        options['shared-lib-store'] = self.store_path
+        options['precompile'] = 'true'
+        return options
+
+    def get_store_objects(self):
+        objects = {}
+        objects_dir = os.path.join(self.store_path, 'objects')
+        for root, dirs, files in os.walk(objects_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                f = open(path)
+                objects[path] = f.read()
+                f.close()
+
+        return objects
+
+    def test_bytecode_out_of_the_store(self):
+        self.install()
+        objects = self.get_store_objects()
+        for name in ('pkg_a', 'pkg_b'):
+            source = os.path.join(self.lib_path, name, 'mod.py')
+            cfile = source + 'c'
+            # The sources are linked from the store, the bytecode is not.
+            self.assertTrue(os.stat(source).st_nlink > 1)
+            self.assertEqual(os.stat(cfile).st_nlink, 1)
+            self.assertTrue(os.stat(cfile).st_mode & stat.S_IWUSR)
+
+            f = open(cfile, 'rb')
+            self.assertEqual(f.read(4), imp.get_magic())
+            f.close()
+
+            module = load_compiled('%s_mod' % name, cfile)
+            self.assertEqual(module.name, name)
+
+        # Shared sources get their own bytecode.
+        self.assertEqual(os.stat(os.path.join(
+            self.lib_path, 'pkg_a', '__init__.py')).st_ino, os.stat(
+            os.path.join(self.lib_path, 'pkg_b', '__init__.py')).st_ino)
+        self.assertNotEqual(os.stat(os.path.join(
+            self.lib_path, 'pkg_a', '__init__.pyc')).st_ino, os.stat(
+            os.path.join(self.lib_path, 'pkg_b', '__init__.pyc')).st_ino)
+
+        # Building another lib-directory doesn't change the store.
+        self.install(**{'lib-directory': self.lib_path + '2'})
+        self.assertEqual(self.get_store_objects(), objects)
+
+    def test_egg_bytecode_unchanged(self):
+        self.install(**{'shared-lib-store': '', 'install-mode': 'hardlink',
+                        'ignore-globs': ''})
+        for egg in self.eggs:
+            name = os.path.basename(egg).split('-')[0]
+            f = open(os.path.join(egg, name, 'mod.pyc'))
+            self.assertEqual(f.read(), 'egg bytecode')
+            f.close()
+
+
+class TestPrecompile(AppLibTestCase):
+
+    def get_options(self):
+        options = super(TestPrecompile, self).get_options()
+        options['precompile'] = 'true'
+        return options
+
+    def import_mod(self, path, *args):
+        """Returns the file of pkg_a.mod imported from `path`."""
+        return subprocess.check_output([sys.executable] + list(args) + [
+            '-c', 'import sys; sys.path.insert(0, sys.argv[1]); '
+            'import pkg_a.mod; print pkg_a.mod.__file__', path]).strip()
+
+    def test_lib_directory(self):
+        self.install(**{'precompile-optimize': '2'})
+        cfile = os.path.join(self.lib_path, 'pkg_a', 'mod.pyo')
+        self.assertFalse(os.path.exists(cfile[:-1] + 'c'))
+        # Docstrings are removed at this level.
+        module = load_compiled('pkg_a_mod', cfile)
+        self.assertEqual(module.__doc__, None)
+        self.assertEqual(module.__file__, cfile)
+
+    def test_zip(self):
+        self.install(**{'use-zipimport': 'true'})
+        path = self.lib_path + '.zip'
+        z = zipfile.ZipFile(path)
+        self.assertTrue('pkg_a/mod.pyc' in z.namelist())
+        z.close()
+
+        # The bytecode is loaded by zipimport, not compiled again.
+        self.assertEqual(self.import_mod(path),
+                         os.path.join(path, 'pkg_a', 'mod.pyc'))
+
+    def test_zip_optimized(self):
+        self.install(**{'use-zipimport': 'true', 'precompile-optimize': '1'})
+        path = self.lib_path + '.zip'
+        self.assertEqual(self.import_mod(path, '-O'),
+                         os.path.join(path, 'pkg_a', 'mod.pyo'))
+
+    def test_package_zips(self):
+        self.install(**{'use-zipimport': 'true', 'zip-layout': 'per-package'})
+        path = os.path.join(self.lib_path, 'pkg_a.zip')
+        self.assertEqual(self.import_mod(path),
+                         os.path.join(path, 'pkg_a', 'mod.pyc'))
+
+
+class TestSwapLibs(AppLibTestCase):
+
+    def get_options(self):
+        options = super(TestSwapLibs, self).get_options()
+        options['delete-safe'] = 'true'
+        return options
+
+    def get_backups(self):
+        temp_dir = os.path.join(self.tmp, 'parts', 'temp')
+        return sorted(name for name in os.listdir(temp_dir)
+                      if name.startswith('distlib_'))
+
+    def test_backups(self):
+        for i in range(3):
+            recipe = self.install()
+            # The old libraries are moved in the background.
+            recipe.wait_delete_libs()
+
+        # All are kept by default.
+        self.assertEqual(len(self.get_backups()), 2)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.lib_path))),
+                         ['distlib'])
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.lib_path, 'pkg_a', 'mod.py')))
+
+    def test_backups_keep(self):
+        for i in range(3):
+            self.install(**{'delete-safe-keep': '1'}).wait_delete_libs()
+
+        self.assertEqual(len(self.get_backups()), 1)
+
+    def test_delete(self):
+        self.install(**{'delete-safe': 'false'})
+        self.install(**{'delete-safe': 'false'}).wait_delete_libs()
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.lib_path))),
+                         ['distlib'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'parts',
+                                                     'temp')))
+
+
+class TestZipLayout(AppLibTestCase):
+
+    def get_options(self):
+        options = super(TestZipLayout, self).get_options()
+        options['use-zipimport'] = 'true'
+        options['zip-layout'] = 'per-package'
+        return options
+
+    def get_zips(self):
+        return dict((name, os.stat(os.path.join(self.lib_path, name)).st_ino)
+                    for name in os.listdir(self.lib_path)
+                    if name.endswith('.zip'))
+
+    def test_package_zips(self):
+        self.install()
+        self.assertEqual(sorted(os.listdir(self.lib_path)),
+                         ['README.txt', 'archives.pth', 'pkg_a.zip',
+                          'pkg_b.zip'])
+        f = open(os.path.join(self.lib_path, 'archives.pth'))
+        self.assertEqual(f.read(), 'pkg_a.zip\npkg_b.zip\n')
+        f.close()
+
+        z = zipfile.ZipFile(os.path.join(self.lib_path, 'pkg_b.zip'))
+        self.assertEqual(sorted(z.namelist()),
+                         ['pkg_b/__init__.py', 'pkg_b/mod.py'])
+        z.close()
+
+        # The zips are added to sys.path by site.addsitedir().
+        out = subprocess.check_output([
+            sys.executable, '-S', '-c',
+            'import site, sys; site.addsitedir(sys.argv[1]); '
+            'import pkg_a.mod, pkg_b.mod; print pkg_b.mod.name',
+            self.lib_path])
+        self.assertEqual(out.strip(), 'pkg_b')
+
+    def test_only_changed_zips(self):
+        self.install()
+        before = self.get_zips()
+        self.install()
+        self.assertEqual(self.get_zips(), before)
+
+        self.write(os.path.join(self.eggs[1], 'pkg_b', 'mod.py'),
+                   'name = "changed"\n')
+        self.install()
+        after = self.get_zips()
+        self.assertEqual(after['pkg_a.zip'], before['pkg_a.zip'])
+        self.assertNotEqual(after['pkg_b.zip'], before['pkg_b.zip'])
+
+        # Zips of removed packages are removed.
+        self.eggs.pop()
+        self.install()
+        self.assertEqual(sorted(self.get_zips()), ['pkg_a.zip'])
+        f = open(os.path.join(self.lib_path, 'archives.pth'))
+        self.assertEqual(f.read(), 'pkg_a.zip\n')
+        f.close()
+
+    def test_change_layout(self):
+        self.install(**{'zip-layout': 'single'})
+        self.assertTrue(os.path.isfile(self.lib_path + '.zip'))
+        self.install()
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.lib_path))),
+                         ['distlib'])
+
+        self.install(**{'zip-layout': 'single'})
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.lib_path))),
+                         ['distlib.zip'])
+
+        # Only the libraries built by app_lib are removed.
+        os.mkdir(self.lib_path)
+        self.install(**{'zip-layout': 'single'})
+        self.assertTrue(os.path.isdir(self.lib_path))
+
+    def test_change_layout_backup(self):
+        self.install(**{'zip-layout': 'single'})
+        recipe = self.install(**{'delete-safe': 'true'})
+        recipe.wait_delete_libs()
+        self.assertFalse(os.path.exists(self.lib_path + '.zip'))
+        backups = os.listdir(os.path.join(self.tmp, 'parts', 'temp'))
+        self.assertEqual(len(backups), 1)
+        self.assertTrue(backups[0].startswith('distlib_'))
+        self.assertTrue(backups[0].endswith('.zip'))
+
+
+class TestReport(AppLibTestCase):
+
+    modes = [
+        {},
+        {'incremental': 'true'},
+        {'use-zipimport': 'true'},
+        {'use-zipimport': 'true', 'zip-layout': 'per-package'},
+        {'use-zipimport': 'true', 'zip-layout': 'per-package',
+         'incremental': 'true'},
+    ]
+
+    def read_report(self):
+        f = open(os.path.join(self.tmp, 'parts', 'app_lib', 'report.json'))
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def get_app_files(self):
+        files = {}
+        for root, dirs, names in os.walk(os.path.join(self.tmp, 'app')):
+            for name in names:
+                path = os.path.join(root, name)
+                files[path] = os.stat(path).st_ino
+
+        return files
+
+    def test_report(self):
+        self.install()
+        report = self.read_report()
+        self.assertEqual(report['lib-directory'], self.lib_path)
+        self.assertEqual(report['files'], 5)
+        self.assertEqual(report['compressed-bytes'], None)
+        self.assertEqual(sorted(report['packages']),
+                         ['README', 'pkg_a', 'pkg_b'])
+        package = report['packages']['pkg_a']
+        self.assertEqual(package['files'], 2)
+        size = os.path.getsize(os.path.join(self.lib_path, 'pkg_a', 'mod.py'))
+        self.assertEqual(package['largest-files'][0],
+                         [os.path.join('pkg_a', 'mod.py'), size])
+        self.assertEqual(report['bytes'], sum(
+            p['bytes'] for p in report['packages'].values()))
+
+    def test_report_zip(self):
+        self.install(**{'use-zipimport': 'true'})
+        report = self.read_report()
+        self.assertEqual(report['files'], 5)
+        self.assertTrue(report['compressed-bytes'] > 0)
+        self.assertEqual(report['packages']['pkg_a']['largest-files'][0][0],
+                         'pkg_a/mod.py')
+
+    def test_limits_keep_old_libs(self):
+        for mode in self.modes:
+            self.tearDown()
+            self.setUp()
+            self.install(**mode)
+            before = self.get_app_files()
+            count = self.read_report()['files']
+            self.write(os.path.join(self.eggs[0], 'pkg_a', 'new.py'), '')
+
+            options = {'max-files': str(count)}
+            options.update(mode)
+            self.assertRaises(zc.buildout.UserError, self.install, **options)
+            # The app is not touched and the new libraries are removed.
+            self.assertEqual(self.get_app_files(), before, mode)
+
+            options['max-files'] = str(count + 1)
+            self.install(**options)
+            self.assertEqual(self.read_report()['files'], count + 1)
+
+    def test_max_bytes(self):
+        self.write(os.path.join(self.eggs[1], 'pkg_b', 'big.txt'), 'x' * 1000)
+        try:
+            self.install(**{'max-bytes': '1000'})
+        except zc.buildout.UserError as e:
+            lines = str(e).splitlines()
+        else:
+            self.fail('UserError not raised')
+
+        self.assertTrue(lines[0].startswith('Libraries exceed max-bytes: '))
+        # The largest package first, with its largest files.
+        self.assertTrue(lines[1].strip().startswith('pkg_b: 3 files'))
+        self.assertEqual(lines[2].strip(), '%s: 1000 bytes' % os.path.join(
+            'pkg_b', 'big.txt'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'app',
+                                                     'distlib')))
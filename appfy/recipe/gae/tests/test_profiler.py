@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Tests of the import_profile script."""
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from appfy.recipe.gae.scripts import profiler
+
+
+class TestFindLibraries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.lib_path = os.path.join(self.tmp, 'distlib')
+        os.mkdir(self.lib_path)
+        os.mkdir(os.path.join(self.lib_path, 'pkg'))
+        self.write(os.path.join(self.lib_path, 'pkg', '__init__.py'), '')
+        self.write(os.path.join(self.lib_path, 'single.py'), '')
+        self.write(os.path.join(self.lib_path, 'README.txt'), '')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, content):
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+
+    def add_zip(self, name, members):
+        path = os.path.join(self.lib_path, name)
+        z = zipfile.ZipFile(path, 'w')
+        for member in members:
+            z.writestr(member, 'name = %r\n' % member)
+        z.close()
+        return path
+
+    def test_directory(self):
+        self.assertEqual(profiler.find_libraries(self.lib_path),
+                         ['pkg', 'single'])
+        self.assertEqual(profiler.get_sys_paths(self.lib_path),
+                         [self.lib_path])
+
+    def test_zip(self):
+        path = self.add_zip('lib.zip', ['zpkg/__init__.py', 'zpkg/a.py',
+                                        'zmod.pyc', 'README.txt'])
+        self.assertEqual(profiler.find_libraries(path), ['zmod', 'zpkg'])
+        self.assertEqual(profiler.get_sys_paths(path), [path])
+
+    def test_package_zips(self):
+        a = self.add_zip('a.zip', ['a/__init__.py'])
+        b = self.add_zip('b.zip', ['b.py'])
+        self.write(os.path.join(self.lib_path, 'archives.pth'),
+                   '# Package zips.\na.zip\nb.zip\nmissing.zip\n')
+        paths = profiler.get_sys_paths(self.lib_path)
+        self.assertEqual(paths, [self.lib_path, a, b])
+        names = set()
+        for path in paths:
+            names.update(profiler.find_libraries(path))
+        self.assertEqual(sorted(names), ['a', 'b', 'pkg', 'single'])
+
+        result = profiler.profile_library('b', paths)
+        self.assertEqual(result['error'], None)
+        self.assertEqual(result['modules'], 1)
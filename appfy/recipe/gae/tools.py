@@ -7,7 +7,9 @@ Installs a python executable and several SDK scripts in the buildout
 directory: appcfg, bulkload_client, bulkloader, dev_appserver and
 remote_api_shell.
 
-It also allows to set default values to start the dev_appserver.
+It also allows to set default values to start the dev_appserver, and
+installs an import_profile script to measure the import cost of the
+libraries installed by `appfy.recipe.gae:app_lib`.
 
 This recipe extends
 `zc.recipe.egg.Scripts <http://pypi.python.org/pypi/zc.recipe.egg>`_,
@@ -29,9 +31,15 @@ Options
     the bin directory. Default is `dev_appserver`.
 :remote_api_shell-script: Name of the remote_api_shell script to be
     installed in the bin directory. Default is `remote_api_shell`.
+:import_profile-script: Name of the import_profile script to be installed in
+    the bin directory. Default is `import_profile`.
+:lib_store_gc-script: Name of the lib_store_gc script to be installed in the
+    bin directory. Default is `lib_store_gc`.
 :config-file: Configuration file with the default values to use in
     scripts. Default is `gaetools.cfg`.
 :extra-paths: Extra paths to include in sys.path for generated scripts.
+:timing-log: File where the time to create the scripts is appended as a
+    JSON line. Default is none.
 :initialization: Allows to specify some Python code to be included in
     the scripts.
 
@@ -74,12 +82,38 @@ default). For example::
 
 Each option should be set in a separate line, as displayed above. Options
 provided when calling dev_appserver will override the default values.
+
+The import_profile script imports each top-level library found in a
+libraries directory or zip file in a fresh interpreter, and reports its
+import time, the number of modules it imported and the memory growth,
+slowest first. The zips listed in `.pth` files of the libraries directory,
+like the package zips of app_lib, are also searched. Default values can be
+set in a `import_profile` section of the same configuration file::
+
+  [import_profile]
+  defaults =
+      --output=var/import_profile
+      app/distlib
+
+With `--output`, the report is also written to `var/import_profile.txt`
+and `var/import_profile.json`.
+
+The lib_store_gc script removes the files of a `shared-lib-store` of
+`appfy.recipe.gae:app_lib` that are no longer used by any `lib-directory`.
+The store directory can also be set in a `lib_store_gc` section::
+
+  [lib_store_gc]
+  defaults =
+      --min-age=3600
+      /var/cache/lib-store
 """
+import logging
 import os
 
 import zc.recipe.egg
 
 from appfy import recipe
+from appfy.recipe import instrument
 
 
 BASE = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
@@ -88,6 +122,7 @@ BASE = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
 
 class Recipe(zc.recipe.egg.Scripts):
     def __init__(self, buildout, name, opts):
+        self.logger = logging.getLogger(name)
         self.parts_dir = buildout['buildout']['parts-directory']
         self.buildout_dir = buildout['buildout']['directory']
 
@@ -115,10 +150,16 @@ class Recipe(zc.recipe.egg.Scripts):
             'dev_appserver',
             'remote_api_shell',
             'endpointscfg',
+            'import_profile',
+            'lib_store_gc',
         ]
 
         self.scripts = [(s, opts.get(s + '-script', s)) for s in scripts]
 
+        self.timer = instrument.Timer(
+            'appfy.recipe.gae:tools', name, self.logger,
+            opts.get('timing-log', '').strip() or None)
+
         # Add the SDK and this recipe package to the path.
         opts['extra-paths'] += '\n%s\n%s' % (BASE, self.sdk_dir)
 
@@ -155,7 +196,15 @@ class Recipe(zc.recipe.egg.Scripts):
             'arguments':      'base, gae, cfg',
         })
 
-        return super(Recipe, self).install()
+        self.timer.restart()
+        try:
+            with self.timer.phase('scripts') as phase:
+                installed = super(Recipe, self).install()
+                phase.count(files=len(installed))
+        finally:
+            self.timer.finish()
+
+        return installed
 
     def get_path(self, path):
         if self.use_rel_paths is True:
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+appfy.recipe.importgraph
+------------------------
+
+Static import graph of python modules, used to find out which modules can
+be reached from the entry points of an app.
+"""
+import ast
+import fnmatch
+import os
+import re
+
+from appfy.recipe import utils
+
+MODULE_EXTENSIONS = ('.py', '.pyc', '.pyo', '.so', '.pyd')
+
+# Matches the script of app.yaml handlers, e.g. `script: main.app`.
+SCRIPT_RE = re.compile(r'^\s*-?\s*script:\s*([^\s#]+)', re.M)
+
+# Functions that import modules given by name.
+IMPORT_FUNCTIONS = ('__import__', 'import_module')
+
+
+def get_module_name(relname):
+    """Returns the module name of a file path relative to sys.path.
+
+    Returns None if the file is not a module.
+    """
+    base, ext = os.path.splitext(relname)
+    if ext not in MODULE_EXTENSIONS:
+        return None
+
+    parts = base.split(os.sep)
+    if parts[-1] == '__init__':
+        parts.pop()
+
+    if not parts or not all(re.match(r'^[A-Za-z_]\w*$', p) for p in parts):
+        return None
+
+    return '.'.join(parts)
+
+
+def get_app_yaml_scripts(filename):
+    """Returns the module names used as scripts in an app.yaml file."""
+    f = open(filename, 'r')
+    try:
+        content = f.read()
+    finally:
+        f.close()
+
+    names = []
+    for script in SCRIPT_RE.findall(content):
+        script = script.strip('\'"')
+        if script.startswith('$'):
+            # Scripts from the SDK, like $PYTHON_LIB/...
+            continue
+
+        if script.endswith('.py'):
+            # CGI script.
+            script = script[:-3].replace('/', '.')
+        else:
+            # WSGI application: module.path.variable
+            script = script.rsplit('.', 1)[0]
+
+        names.append(script)
+
+    return names
+
+
+def find_imports(source, filename='<unknown>'):
+    """Returns the imports in a module source.
+
+    Imports are returned as ``(name, fromlist, level)`` tuples, like the
+    arguments of __import__(). Calls to __import__() or import_module() with
+    a literal module name are also included.
+    """
+    imports = []
+    for node in ast.walk(ast.parse(source, filename)):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.append((alias.name, (), 0))
+        elif isinstance(node, ast.ImportFrom):
+            imports.append((node.module or '',
+                            tuple(alias.name for alias in node.names),
+                            node.level or 0))
+        elif (isinstance(node, ast.Call) and node.args and
+                isinstance(node.args[0], ast.Str)):
+            func = node.func
+            name = getattr(func, 'id', None) or getattr(func, 'attr', None)
+            if name in IMPORT_FUNCTIONS:
+                imports.append((node.args[0].s, (), 0))
+
+    return imports
+
+
+class ImportGraph(object):
+    """Follows imports between modules.
+
+    `modules` maps module names to their files, which can be inside zip
+    files, and `paths` is a list of directories, like the app dir, where
+    other modules are looked for.
+    """
+
+    def __init__(self, modules, paths=()):
+        self.modules = dict(modules)
+        self.paths = list(paths)
+        self.errors = {}
+
+    def find_module(self, name):
+        """Returns the file of a module, or None if it is unknown."""
+        if name in self.modules:
+            return self.modules[name]
+
+        filename = None
+        for path in self.paths:
+            base = os.path.join(path, *name.split('.'))
+            for candidate in (base + '.py',
+                              os.path.join(base, '__init__.py')):
+                if os.path.isfile(candidate):
+                    filename = candidate
+                    break
+
+            if filename is not None:
+                break
+
+        self.modules[name] = filename
+        return filename
+
+    def walk(self, names, allow=()):
+        """Returns the set of modules reachable from `names`.
+
+        `allow` is a list of glob patterns of module names that are always
+        reachable, e.g. because they are imported dynamically.
+        """
+        allowed = [name for name, filename in self.modules.items()
+                   if filename is not None and
+                   any(fnmatch.fnmatchcase(name, p) for p in allow)]
+
+        reached = set()
+        pending = list(names) + allowed
+        while pending:
+            name = pending.pop()
+            if name in reached:
+                continue
+
+            filename = self.find_module(name)
+            if filename is None:
+                continue
+
+            reached.add(name)
+            pending.extend(self.get_dependencies(name, filename))
+
+        return reached
+
+    def get_dependencies(self, name, filename):
+        """Returns the names of the modules imported by a module."""
+        if not filename.endswith('.py'):
+            return []
+
+        f = utils.open_file(filename)
+        try:
+            source = f.read().replace('\r\n', '\n')
+        finally:
+            f.close()
+
+        try:
+            imports = find_imports(source, filename)
+        except (SyntaxError, TypeError, ValueError) as e:
+            # Keep the module, even if its imports are unknown.
+            self.errors[name] = str(e)
+            return []
+
+        if os.path.basename(filename).startswith('__init__.'):
+            package = name
+        else:
+            package = name.rpartition('.')[0]
+
+        result = []
+        for imported, fromlist, level in imports:
+            if level:
+                parts = package.split('.') if package else []
+                if level - 1 > len(parts):
+                    continue
+
+                base = '.'.join(parts[:len(parts) - level + 1])
+                targets = ['.'.join(p for p in (base, imported) if p)]
+            elif package:
+                # Implicit relative imports, as in Python 2.
+                targets = [package + '.' + imported, imported]
+            else:
+                targets = [imported]
+
+            for target in targets:
+                if not target:
+                    continue
+
+                # Importing a module also imports its parent packages.
+                parts = target.split('.')
+                for i in range(1, len(parts) + 1):
+                    result.append('.'.join(parts[:i]))
+
+                for item in fromlist:
+                    if item == '*':
+                        result.extend(self.get_submodules(target))
+                    else:
+                        result.append(target + '.' + item)
+
+        return result
+
+    def get_submodules(self, name):
+        """Returns the known modules directly inside a package."""
+        prefix = name + '.'
+        return [m for m in self.modules if m.startswith(prefix) and
+                '.' not in m[len(prefix):]]
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+appfy.recipe.instrument
+-----------------------
+
+Timing of the phases of a recipe, with the files and bytes they processed.
+"""
+import json
+import os
+import threading
+import time
+
+
+class Phase(object):
+    """A timed phase. Used as a context manager by Timer.phase()."""
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.seconds = None
+        self.files = None
+        self.bytes = None
+        self.start = None
+
+    def count(self, files=0, bytes=0):
+        """Adds to the number of files and bytes processed in this phase."""
+        if files:
+            self.files = (self.files or 0) + files
+
+        if bytes:
+            self.bytes = (self.bytes or 0) + bytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.time() - self.start
+        self.timer.add(self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'seconds': self.seconds,
+            'files': self.files,
+            'bytes': self.bytes,
+        }
+
+
+class Timer(object):
+    """Times the phases of a recipe.
+
+    When finished, a summary table is logged and, if `log_file` is set, the
+    phases are appended to it as a JSON line, to compare builds over time.
+    """
+
+    def __init__(self, recipe, section, logger, log_file=None):
+        self.recipe = recipe
+        self.section = section
+        self.logger = logger
+        self.log_file = log_file
+        self.phases = []
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def restart(self):
+        """Starts timing again, discarding the finished phases.
+
+        Called when install() or update() starts, because recipes are created
+        when buildout loads the configuration, before other parts are built.
+        """
+        self.phases = []
+        self.start = time.time()
+
+    def phase(self, name):
+        """Returns a context manager that times a phase.
+
+        For example::
+
+            with timer.phase('copy') as phase:
+                copy_files(files, dst)
+                phase.count(files=len(files))
+        """
+        return Phase(self, name)
+
+    def add(self, phase):
+        # Phases may finish in other threads.
+        self.lock.acquire()
+        try:
+            self.phases.append(phase)
+        finally:
+            self.lock.release()
+
+    def get_phases(self):
+        """Returns the finished phases, in the order they started.
+
+        Phases can be nested, so their times can overlap.
+        """
+        return sorted(self.phases, key=lambda phase: phase.start)
+
+    def format_summary(self, total):
+        """Returns the phases as a text table."""
+        row = '%-24s %9s %9s %12s'
+        lines = [row % ('Phase', 'Seconds', 'Files', 'Bytes')]
+        lines.append('-' * len(lines[0]))
+        for phase in self.get_phases():
+            lines.append(row % (
+                phase.name,
+                '%.3f' % phase.seconds,
+                '-' if phase.files is None else phase.files,
+                '-' if phase.bytes is None else phase.bytes,
+            ))
+
+        lines.append((row % ('total', '%.3f' % total, '', '')).rstrip())
+        return '\n'.join(lines)
+
+    def finish(self):
+        """Logs the summary and appends it to `log_file`."""
+        total = time.time() - self.start
+        self.logger.info('Timing of %s:\n%s', self.section,
+                         self.format_summary(total))
+
+        if not self.log_file:
+            return
+
+        dirname = os.path.dirname(self.log_file)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        f = open(self.log_file, 'a')
+        try:
+            f.write(json.dumps({
+                'recipe': self.recipe,
+                'section': self.section,
+                'time': self.start,
+                'seconds': total,
+                'phases': [phase.to_dict() for phase in self.get_phases()],
+            }, sort_keys=True) + '\n')
+        finally:
+            f.close()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+appfy.recipe.slim
+-----------------
+
+Removes docstrings and comments from python sources, to reduce the size of
+the libraries installed by app_lib.
+
+Line numbers are kept, so tracebacks still point to the right lines. The
+shebang, the encoding declaration and comments or docstrings with license
+notices are kept.
+"""
+import hashlib
+import os
+import re
+import StringIO
+import tokenize
+import uuid
+
+from appfy.recipe import utils
+
+# Changed when the output changes, to invalidate the cached files.
+VERSION = '1'
+
+# Comment blocks and docstrings matching this are license notices.
+LICENSE_RE = re.compile(
+    r'copyright|licen[cs]e|\(c\)|\xc2\xa9|spdx-|all rights reserved|'
+    r'permission is hereby granted', re.I)
+
+# Encoding declaration (PEP 263), only valid in the first two lines.
+CODING_RE = re.compile(r'^[ \t\f]*#.*coding[:=][ \t]*[-\w.]+')
+
+# Tokens that can come before a statement.
+STATEMENT_START = (None, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT)
+
+
+def slim_source(source):
+    """Returns `source` without docstrings and comments.
+
+    Docstrings and other statements with only a string are replaced by an
+    empty string, so that blocks with only a docstring stay valid, followed
+    by the lines they spanned. Raises tokenize.TokenError or SyntaxError if
+    the source can't be tokenized.
+    """
+    tokens = list(tokenize.generate_tokens(
+        StringIO.StringIO(source).readline))
+    edits = []
+    comments = []
+    prev = None
+    i = 0
+    while i < len(tokens):
+        toktype, string, start, end, line = tokens[i]
+        if toktype == tokenize.COMMENT:
+            comments.append((start, end, string))
+        elif toktype == tokenize.STRING and prev in STATEMENT_START:
+            last = get_string_statement_end(tokens, i)
+            if last is not None:
+                strings = [t[1] for t in tokens[i:last + 1]
+                           if t[0] == tokenize.STRING]
+                if not LICENSE_RE.search(''.join(strings)):
+                    end = tokens[last][3]
+                    edits.append((start, end,
+                                  "''" + '\n' * (end[0] - start[0])))
+
+                i = last + 1
+                prev = tokenize.STRING
+                continue
+
+        if toktype not in (tokenize.NL, tokenize.COMMENT):
+            prev = toktype
+
+        i += 1
+
+    edits.extend(get_comment_edits(comments))
+    return apply_edits(source, edits)
+
+
+def get_string_statement_end(tokens, i):
+    """Returns the index of the last token of a statement with only strings.
+
+    The statement starts at `tokens[i]`. Returns None if it has other
+    tokens, like in ``'-'.join(names)``.
+    """
+    last = i
+    for j in range(i + 1, len(tokens)):
+        toktype = tokens[j][0]
+        if toktype == tokenize.STRING:
+            last = j
+        elif toktype in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            return last
+        elif toktype not in (tokenize.NL, tokenize.COMMENT):
+            return None
+
+
+def get_comment_edits(comments):
+    """Returns the edits to remove comments that aren't license notices.
+
+    Comments in consecutive lines are a block, kept if any of them is a
+    license notice.
+    """
+    blocks = []
+    for comment in comments:
+        if blocks and comment[0][0] == blocks[-1][-1][0][0] + 1:
+            blocks[-1].append(comment)
+        else:
+            blocks.append([comment])
+
+    edits = []
+    for block in blocks:
+        if LICENSE_RE.search(''.join(string for _, _, string in block)):
+            continue
+
+        for start, end, string in block:
+            if start[0] <= 2 and (CODING_RE.match(string) or
+                                  (start == (1, 0) and
+                                   string.startswith('#!'))):
+                continue
+
+            edits.append((start, end, ''))
+
+    return edits
+
+
+def apply_edits(source, edits):
+    """Replaces ``(start, end, replacement)`` spans of `source`.
+
+    Positions are ``(row, col)`` tuples, as given by tokenize. Whitespace
+    left at the end of edited lines is removed.
+    """
+    # Lines split like tokenize does.
+    offsets = [0, 0]
+    for line in StringIO.StringIO(source):
+        offsets.append(offsets[-1] + len(line))
+
+    parts = []
+    pos = 0
+    for start, end, replacement in sorted(edits):
+        start = offsets[start[0]] + start[1]
+        end = offsets[end[0]] + end[1]
+        parts.append(source[pos:start].rstrip(' \t\f') if not replacement
+                     else source[pos:start])
+        parts.append(replacement)
+        pos = end
+
+    parts.append(source[pos:])
+    return ''.join(parts)
+
+
+def get_cache_path(cache_dir, content):
+    """Returns the path of the slimmed file of `content` in `cache_dir`."""
+    key = hashlib.sha1(VERSION + '\0' + content).hexdigest()
+    return os.path.join(cache_dir, key[:2], key + '.py')
+
+
+def slim_file(item):
+    """Slims a ``(srcname, cache_dir)`` file, unless it is already cached.
+
+    Returns the path of the slimmed file, the original and new sizes, and
+    an error message if the source couldn't be slimmed; then the cached file
+    is a copy of the source. Used by a process pool, so it only takes and
+    returns picklable arguments.
+    """
+    srcname, cache_dir = item
+    f = utils.open_file(srcname)
+    try:
+        content = f.read()
+    finally:
+        f.close()
+
+    path = get_cache_path(cache_dir, content)
+    if os.path.isfile(path):
+        return path, len(content), os.path.getsize(path), None
+
+    error = None
+    try:
+        slimmed = slim_source(content)
+        compile(slimmed, srcname, 'exec')
+    except (tokenize.TokenError, SyntaxError, TypeError, ValueError) as e:
+        slimmed = content
+        error = '%s: %s' % (e.__class__.__name__, e)
+
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        # Created by another process.
+        if not os.path.isdir(dirname):
+            raise
+
+    # Files with the same content may be written by several processes.
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(slimmed)
+    finally:
+        f.close()
+
+    utils.rename(tmp_path, path)
+    return path, len(content), len(slimmed), error
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+appfy.recipe.store
+------------------
+
+Content-addressed store of library files, shared by several buildouts.
+
+Files are stored once in `objects`, named by the sha1 of their content, and
+installed in the libraries directory of each app as hardlinks. Each app
+keeps a manifest of the objects it uses in `manifests`, so that objects not
+used by any app can be removed by collect_garbage().
+"""
+import hashlib
+import optparse
+import os
+import stat
+import sys
+import time
+import uuid
+
+from appfy.recipe import utils
+
+# Objects are shared, so they must not be edited through their links.
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+class Store(object):
+    def __init__(self, path):
+        self.path = path
+        self.objects_dir = os.path.join(path, 'objects')
+        self.manifests_dir = os.path.join(path, 'manifests')
+
+    def get_object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def get_manifest_path(self, lib_path):
+        """Returns the manifest of the objects used by a libraries dir."""
+        name = hashlib.sha1(lib_path).hexdigest() + '.json'
+        return os.path.join(self.manifests_dir, name)
+
+    def add(self, srcname, digest=None):
+        """Adds a file to the store, if it isn't there yet.
+
+        Returns the path of the object and True if it was added.
+        """
+        if digest is None:
+            digest = utils.get_checksum(srcname)
+
+        path = self.get_object_path(digest)
+        if os.path.isfile(path):
+            return path, False
+
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Created by another build at the same time.
+            if not os.path.isdir(dirname):
+                raise
+
+        # Written under a unique name, so that builds adding the same file
+        # at the same time don't see a partial object.
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            utils.copy_file(srcname, tmp_path, hashtype=None)
+            os.chmod(tmp_path, READ_ONLY)
+            utils.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return path, True
+
+    def add_files(self, files, hashes=None, workers=1):
+        """Adds a list of (srcname, relname) files to the store.
+
+        `hashes` is a cache of sha1 hashes keyed by srcname, used for the
+        files with the same size and mtime. Returns the list of
+        (object path, relname) files, the updated cache and the number of
+        objects added.
+        """
+        hashes = hashes or {}
+        new_hashes = {}
+
+        def add(item):
+            srcname, relname = item
+            st = utils.stat_file(srcname)
+            cached = hashes.get(srcname)
+            if (cached is not None and cached['size'] == st.st_size and
+                    cached['mtime'] == st.st_mtime):
+                digest = cached['sha1']
+            else:
+                digest = utils.get_checksum(srcname)
+
+            new_hashes[srcname] = {
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'sha1': digest,
+            }
+            path, added = self.add(srcname, digest)
+            return (path, relname), added
+
+        results = utils.map_threads(add, files, workers=workers)
+        return ([item for item, _ in results], new_hashes,
+                len([added for _, added in results if added]))
+
+    def write_manifest(self, lib_path, files):
+        """Saves the objects used by `lib_path`, from the files added."""
+        utils.write_manifest(self.get_manifest_path(lib_path), {
+            'lib-directory': lib_path,
+            'objects': sorted(set(os.path.basename(path)
+                                  for path, _ in files)),
+        })
+
+    def collect_garbage(self, min_age=3600, logger=None):
+        """Removes the objects not used by any libraries directory.
+
+        Manifests of libraries directories that no longer exist are removed
+        first. Objects still linked somewhere or changed less than
+        `min_age` seconds ago, which may belong to a build in progress, are
+        kept. Returns the number of objects removed and their size.
+        """
+        used = set()
+        if os.path.isdir(self.manifests_dir):
+            for filename in os.listdir(self.manifests_dir):
+                if not filename.endswith('.json'):
+                    continue
+
+                path = os.path.join(self.manifests_dir, filename)
+                manifest = utils.read_manifest(path)
+                if not os.path.exists(manifest.get('lib-directory', '')):
+                    os.remove(path)
+                    if logger:
+                        logger.info('Removed manifest of %r.',
+                                    manifest.get('lib-directory'))
+                    continue
+
+                used.update(manifest.get('objects', ()))
+
+        removed = 0
+        size = 0
+        limit = time.time() - min_age
+        if not os.path.isdir(self.objects_dir):
+            return removed, size
+
+        for dirname in os.listdir(self.objects_dir):
+            dirname = os.path.join(self.objects_dir, dirname)
+            for digest in os.listdir(dirname):
+                path = os.path.join(dirname, digest)
+                st = os.lstat(path)
+                if (digest in used or st.st_nlink > 1 or
+                        st.st_ctime > limit):
+                    continue
+
+                os.remove(path)
+                removed += 1
+                size += st.st_size
+
+            if not os.listdir(dirname):
+                os.rmdir(dirname)
+
+        if logger:
+            logger.info('Removed %d unused objects (%d bytes) from %r.',
+                        removed, size, self.path)
+
+        return removed, size
+
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] STORE',
+        description='Removes the files of a shared library store that are '
+                    'not used by any libraries directory.'
+    )
+    parser.add_option(
+        '--min-age', default=3600, type='int',
+        help='Keep objects changed less than MIN_AGE seconds ago, which '
+             'may belong to a build in progress. Default: 3600.')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('STORE is required.')
+
+    store = Store(os.path.abspath(args[0]))
+    if not os.path.isdir(store.path):
+        parser.error('%s does not exist.' % store.path)
+
+    removed, size = store.collect_garbage(min_age=options.min_age)
+    sys.stdout.write('Removed %d unused objects (%d bytes) from %s.\n' % (
+        removed, size, store.path))
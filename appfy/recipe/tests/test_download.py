@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Tests of appfy.recipe.download."""
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import zc.buildout
+
+from appfy.recipe import download
+from appfy.recipe import utils
+
+
+class TestIncrementalExtract(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.parts = os.path.join(self.tmp, 'parts')
+        os.makedirs(os.path.join(self.tmp, 'downloads'))
+        os.makedirs(self.parts)
+        self.archive = os.path.join(self.tmp, 'package.zip')
+        z = zipfile.ZipFile(self.archive, 'w')
+        z.writestr('pkg/a.py', 'a')
+        z.writestr('pkg/sub/b.py', 'b')
+        z.close()
+        self.options = {
+            'url': self.archive,
+            'clear-destination': 'true',
+            'incremental-extract': 'true',
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def install(self):
+        buildout = {'buildout': {
+            'directory': self.tmp,
+            'parts-directory': self.parts,
+            'download-cache': os.path.join(self.tmp, 'downloads'),
+        }}
+        return download.Recipe(buildout, 'package', self.options).install()
+
+    def uninstall(self, installed):
+        # Like buildout.
+        download.uninstall('package', self.options)
+        for path in installed:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def test_installed_paths(self):
+        destination = os.path.join(self.parts, 'package')
+        self.assertEqual(self.install(), [destination,
+                                          os.path.join(destination, 'pkg')])
+
+    def test_reinstall(self):
+        destination = os.path.join(self.parts, 'package')
+        installed = self.install()
+        path = os.path.join(destination, 'pkg', 'sub', 'b.py')
+        inode = os.stat(path).st_ino
+
+        self.uninstall(installed)
+        self.assertFalse(os.path.exists(destination))
+
+        self.assertEqual(self.install(), installed)
+        # Kept, not extracted again.
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.options['extract-directory'], 'files')))
+
+    def test_uninstall_without_incremental_extract(self):
+        self.options['incremental-extract'] = 'false'
+        installed = self.install()
+        self.assertFalse('extract-directory' in self.options)
+        self.uninstall(installed)
+        self.assertEqual(os.listdir(self.parts), [])
+
+
+class TestChecksums(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp, 'downloads')
+        os.makedirs(self.cache)
+        self.archive = os.path.join(self.tmp, 'package.zip')
+        z = zipfile.ZipFile(self.archive, 'w')
+        z.writestr('pkg/a.py', 'a')
+        z.close()
+        f = open(self.archive, 'rb')
+        self.md5sum = hashlib.md5(f.read()).hexdigest()
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def install(self, **options):
+        options.setdefault('url', self.archive)
+        options.setdefault('md5sum', self.md5sum)
+        options.setdefault('clear-destination', 'true')
+        buildout = {'buildout': {
+            'directory': self.tmp,
+            'parts-directory': os.path.join(self.tmp, 'parts'),
+            'download-cache': self.cache,
+        }}
+        return download.Recipe(buildout, 'package', options).install()
+
+    def get_cached_path(self):
+        names = [name for name in os.listdir(self.cache)
+                 if not name.endswith('.checksums.json')]
+        self.assertEqual(len(names), 1)
+        return os.path.join(self.cache, names[0])
+
+    def record_md5sum(self, md5sum):
+        """Records a fake md5sum for the unchanged cached file."""
+        path = self.get_cached_path()
+        utils.write_checksums(path, {'md5': md5sum})
+        return path
+
+    def test_recorded(self):
+        self.install()
+        path = self.get_cached_path()
+        self.assertEqual(utils.read_checksums(path), {'md5': self.md5sum})
+
+    def test_recorded_checksums_are_trusted(self):
+        self.install()
+        # Not computed again: the fake checksum is accepted.
+        self.record_md5sum('0' * 32)
+        self.install(md5sum='0' * 32)
+
+    def test_wrong_md5sum(self):
+        self.assertRaises(zc.buildout.UserError, self.install,
+                          md5sum='0' * 32)
+        # Like zc.buildout, the new download is not kept.
+        self.assertEqual(os.listdir(self.cache), [])
+
+    def test_wrong_md5sum_of_cached_file(self):
+        self.install()
+        path = self.get_cached_path()
+        self.assertRaises(zc.buildout.UserError, self.install,
+                          md5sum='0' * 32)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(utils.read_checksums(path), {'md5': self.md5sum})
+
+    def test_changed_file(self):
+        self.install()
+        path = self.record_md5sum('0' * 32)
+        f = open(path, 'ab')
+        f.write('changed')
+        f.close()
+        # The recorded checksum is not used for the changed file.
+        self.assertRaises(zc.buildout.UserError, self.install,
+                          md5sum='0' * 32)
+
+    def test_paranoid_verify(self):
+        self.install()
+        path = self.record_md5sum('0' * 32)
+        self.assertRaises(zc.buildout.UserError, self.install,
+                          md5sum='0' * 32, **{'paranoid-verify': 'true'})
+        self.install(**{'paranoid-verify': 'true'})
+        self.assertTrue(os.path.exists(path))
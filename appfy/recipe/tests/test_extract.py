@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Tests of appfy.recipe.extract."""
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from appfy.recipe import extract
+
+
+class FetchedFile(object):
+    """Stands for a fetch.Fetch whose file is already downloaded."""
+
+    def __init__(self, path):
+        self.part_path = path
+        self.size = os.path.getsize(path)
+
+    def wait_available(self, pos):
+        return max(self.size - pos, 0)
+
+
+def add_member(tar, name, data=None, linkname=None, type=tarfile.REGTYPE):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mtime = 1000000
+    if linkname is not None:
+        info.linkname = linkname
+
+    if data is not None:
+        info.size = len(data)
+        tar.addfile(info, StringIO.StringIO(data))
+    else:
+        tar.addfile(info)
+
+
+class TestLinks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp, 'dest')
+        os.mkdir(self.dest)
+        self.archive = os.path.join(self.tmp, 'archive.tar')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_tar(self, members):
+        tar = tarfile.open(self.archive, 'w')
+        try:
+            for args in members:
+                add_member(tar, *args)
+        finally:
+            tar.close()
+
+    def extract_stream(self):
+        extractor = extract.StreamExtractor(FetchedFile(self.archive), 'tar',
+                                            self.dest)
+        extractor.extract()
+
+    def test_is_safe_link(self):
+        def link(name, linkname, type=tarfile.SYMTYPE):
+            info = tarfile.TarInfo(name)
+            info.type = type
+            info.linkname = linkname
+            return extract.is_safe_link(info, self.dest)
+
+        self.assertTrue(link('a/b', 'c'))
+        self.assertTrue(link('a/b', '../c'))
+        self.assertTrue(link('a/b', '..'))
+        self.assertFalse(link('a/b', '../../c'))
+        self.assertFalse(link('a', '/etc/passwd'))
+        self.assertTrue(link('a/b', 'a/c', tarfile.LNKTYPE))
+        self.assertFalse(link('a/b', '../c', tarfile.LNKTYPE))
+        self.assertTrue(extract.is_safe_link(tarfile.TarInfo('a'),
+                                             self.dest))
+
+    def test_stream_skips_outside_links(self):
+        self.make_tar([
+            ('pkg/file.txt', 'data'),
+            ('pkg/link', None, 'file.txt', tarfile.SYMTYPE),
+            ('pkg/up', None, '../..', tarfile.SYMTYPE),
+            ('pkg/abs', None, '/etc', tarfile.SYMTYPE),
+            ('pkg/hard', None, 'pkg/file.txt', tarfile.LNKTYPE),
+            ('pkg/hard-out', None, '../outside', tarfile.LNKTYPE),
+        ])
+        self.extract_stream()
+        pkg = os.path.join(self.dest, 'pkg')
+        self.assertEqual(sorted(os.listdir(pkg)),
+                         ['file.txt', 'hard', 'link'])
+        self.assertEqual(open(os.path.join(pkg, 'link')).read(), 'data')
+
+    def test_stream_skips_chained_links(self):
+        # pkg/up points to the destination, so pkg/up/out points outside.
+        self.make_tar([
+            ('pkg/up', None, '..', tarfile.SYMTYPE),
+            ('pkg/up/out', None, '..', tarfile.SYMTYPE),
+        ])
+        self.extract_stream()
+        self.assertTrue(os.path.islink(os.path.join(self.dest, 'pkg', 'up')))
+        self.assertFalse(os.path.lexists(os.path.join(self.dest, 'out')))
+
+    def test_incremental_skips_outside_links(self):
+        self.make_tar([
+            ('pkg/file.txt', 'data'),
+            ('pkg/link', None, 'file.txt', tarfile.SYMTYPE),
+            ('pkg/up', None, '../..', tarfile.SYMTYPE),
+            ('pkg/hard-out', None, '../outside', tarfile.LNKTYPE),
+        ])
+        manifest = os.path.join(self.tmp, 'manifest.json')
+        extractor = extract.IncrementalExtractor(self.archive, self.dest,
+                                                 manifest)
+        extractor()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest, 'pkg'))),
+                         ['file.txt', 'link'])
+        self.assertEqual(extractor.written, 2)
+
+    def test_incremental_strip_skips_outside_links(self):
+        # Inside the archive, but outside the destination once stripped.
+        self.make_tar([
+            ('pkg/file.txt', 'data'),
+            ('pkg/up', None, '../file.txt', tarfile.SYMTYPE),
+        ])
+        extract.IncrementalExtractor(
+            self.archive, self.dest, os.path.join(self.tmp, 'manifest.json'),
+            strip=True)()
+        self.assertEqual(os.listdir(self.dest), ['file.txt'])
+
+
+class TestIncrementalExtractor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp, 'dest')
+        self.archive = os.path.join(self.tmp, 'archive.zip')
+        self.manifest = os.path.join(self.tmp, 'manifest.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_zip(self, files):
+        z = zipfile.ZipFile(self.archive, 'w')
+        try:
+            for name, data in sorted(files.items()):
+                z.writestr(name, data)
+        finally:
+            z.close()
+
+    def extract(self, **kwargs):
+        extractor = extract.IncrementalExtractor(self.archive, self.dest,
+                                                 self.manifest, **kwargs)
+        kept = extractor()
+        return extractor.written, kept, extractor.removed
+
+    def read(self, relname):
+        f = open(os.path.join(self.dest, *relname.split('/')))
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_unchanged(self):
+        self.make_zip({'pkg/a.py': 'a', 'pkg/sub/b.py': 'b'})
+        self.assertEqual(self.extract(), (2, 0, 0))
+        self.assertEqual(self.extract(), (0, 2, 0))
+        self.assertEqual(self.read('pkg/sub/b.py'), 'b')
+
+    def test_changed_member(self):
+        self.make_zip({'pkg/a.py': 'a', 'pkg/b.py': 'b'})
+        self.extract()
+        self.make_zip({'pkg/a.py': 'a', 'pkg/b.py': 'changed'})
+        self.assertEqual(self.extract(), (1, 1, 0))
+        self.assertEqual(self.read('pkg/b.py'), 'changed')
+
+    def test_local_change(self):
+        self.make_zip({'pkg/a.py': 'a', 'pkg/b.py': 'b'})
+        self.extract()
+        f = open(os.path.join(self.dest, 'pkg', 'b.py'), 'w')
+        f.write('edited locally')
+        f.close()
+        self.assertEqual(self.extract(), (1, 1, 0))
+        self.assertEqual(self.read('pkg/b.py'), 'b')
+
+    def test_removed_member(self):
+        self.make_zip({'pkg/a.py': 'a', 'pkg/old/b.py': 'b'})
+        self.extract()
+        self.make_zip({'pkg/a.py': 'a'})
+        self.assertEqual(self.extract(), (0, 1, 1))
+        self.assertEqual(os.listdir(os.path.join(self.dest, 'pkg')),
+                         ['a.py'])
+
+    def test_without_manifest(self):
+        self.make_zip({'pkg/a.py': 'a'})
+        os.makedirs(os.path.join(self.dest, 'pkg'))
+        open(os.path.join(self.dest, 'pkg', 'stale.py'), 'w').close()
+        open(os.path.join(self.dest, 'other.txt'), 'w').close()
+        self.assertEqual(self.extract(), (1, 0, 0))
+        # Only the top-level entries of the archive are replaced.
+        self.assertEqual(sorted(os.listdir(self.dest)), ['other.txt', 'pkg'])
+        self.assertEqual(os.listdir(os.path.join(self.dest, 'pkg')),
+                         ['a.py'])
+
+    def test_strip(self):
+        self.make_zip({'pkg-1.0/a.py': 'a', 'pkg-1.0/sub/b.py': 'b'})
+        self.extract(strip=True)
+        self.assertEqual(sorted(os.listdir(self.dest)), ['a.py', 'sub'])
+        self.assertEqual(self.extract(strip=True), (0, 2, 0))
+
+    def test_strip_several_top_level(self):
+        self.make_zip({'pkg/a.py': 'a', 'b.txt': 'b'})
+        self.assertRaises(extract.ExtractError, self.extract, strip=True)
+
+    def test_stash(self):
+        self.make_zip({'pkg/a.py': 'a', 'b.txt': 'b'})
+        extractor = extract.IncrementalExtractor(self.archive, self.dest,
+                                                 self.manifest)
+        extractor()
+        self.assertEqual(extractor.get_top_level(), ['b.txt', 'pkg'])
+
+        stash = os.path.join(self.tmp, 'stash')
+        extractor.stash(stash)
+        self.assertEqual(os.listdir(self.dest), [])
+        extractor.restore(stash)
+        self.assertFalse(os.path.exists(stash))
+        self.assertEqual(self.extract(), (0, 2, 0))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Tests of appfy.recipe.fetch against a local HTTP server."""
+import BaseHTTPServer
+import hashlib
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+from appfy.recipe import fetch
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves `server.data`, as configured by the test."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.lock.acquire()
+        try:
+            server.requests.append((self.headers.getheader('Range'),
+                                    self.headers.getheader('If-Range')))
+            change = server.changes.pop(len(server.requests), None)
+            if change is not None:
+                server.data = change
+
+            data = server.data
+        finally:
+            server.lock.release()
+
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        match = re.match(r'^bytes=(\d+)-(\d*)$',
+                         self.headers.getheader('Range') or '')
+        if_range = self.headers.getheader('If-Range')
+        if (match is None or not server.ranges or
+                if_range is not None and if_range != etag):
+            start, end = 0, len(data) - 1
+            self.send_response(200)
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                self.send_response(416)
+                self.end_headers()
+                return
+
+            if start in server.broken:
+                self.send_response(500)
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, len(data)))
+
+        body = data[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if server.fail_after is not None and len(body) > server.fail_after:
+            # The connection is closed before the end.
+            body = body[:server.fail_after]
+
+        self.wfile.write(body)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.data = data
+        self.ranges = True
+        # Bytes sent of each response, or None to send them all.
+        self.fail_after = None
+        # Starts of the ranges that fail.
+        self.broken = set()
+        # New data sent from the request with the given number.
+        self.changes = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        # Polls often, for a quick shutdown.
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        # Clients close connections when a download fails.
+        pass
+
+    def get_url(self):
+        return 'http://127.0.0.1:%d/file.zip' % self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.min_segment_size = fetch.MIN_SEGMENT_SIZE
+        fetch.MIN_SEGMENT_SIZE = 2 ** 12
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'file.zip')
+        self.data = os.urandom(2 ** 16 + 123)
+        self.server = Server(self.data)
+
+    def tearDown(self):
+        fetch.MIN_SEGMENT_SIZE = self.min_segment_size
+        self.server.close()
+        shutil.rmtree(self.tmp)
+
+    def get_fetch(self, **kwargs):
+        kwargs.setdefault('segments', 4)
+        kwargs.setdefault('retries', 0)
+        kwargs.setdefault('timeout', 5)
+        return fetch.Fetch(self.server.get_url(), self.path, **kwargs)
+
+    def read(self):
+        f = open(self.path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_segments(self):
+        f = self.get_fetch(hashtypes=['md5', 'sha1'])
+        self.assertEqual(f(), len(self.data))
+        self.assertEqual(self.read(), self.data)
+        self.assertEqual(f.get_checksums(), {
+            'md5': hashlib.md5(self.data).hexdigest(),
+            'sha1': hashlib.sha1(self.data).hexdigest(),
+        })
+        self.assertEqual(len(f.state['segments']), 4)
+        self.assertFalse(os.path.exists(f.part_path))
+        self.assertFalse(os.path.exists(f.state_path))
+
+    def test_if_range(self):
+        self.get_fetch()()
+        etag = '"%s"' % hashlib.sha1(self.data).hexdigest()
+        # The first request finds the size and validator.
+        self.assertEqual(self.server.requests[0], ('bytes=0-0', None))
+        self.assertEqual(len(self.server.requests), 5)
+        for byte_range, if_range in self.server.requests[1:]:
+            self.assertEqual(if_range, etag)
+
+    def test_resume(self):
+        self.server.fail_after = 2 ** 12
+        f = self.get_fetch()
+        self.assertRaises(IOError, f)
+        self.assertTrue(os.path.exists(f.part_path))
+        self.assertTrue(os.path.exists(f.state_path))
+        self.assertFalse(os.path.exists(self.path))
+
+        self.server.fail_after = None
+        del self.server.requests[:]
+        f = self.get_fetch()
+        fetched = f()
+        self.assertEqual(self.read(), self.data)
+        self.assertEqual(fetched, len(self.data) - 4 * 2 ** 12)
+        # Each segment is requested from the bytes already saved.
+        starts = sorted(int(re.match(r'bytes=(\d+)-', r).group(1))
+                        for r, if_range in self.server.requests[1:])
+        self.assertEqual(starts, [start + 2 ** 12 for start, end, pos in
+                                  fetch.split_segments(len(self.data), 4)])
+
+    def test_resume_changed(self):
+        self.server.fail_after = 2 ** 12
+        self.assertRaises(IOError, self.get_fetch())
+
+        # The saved bytes are not used for a different file.
+        self.data = self.server.data = os.urandom(len(self.data))
+        self.server.fail_after = None
+        self.assertEqual(self.get_fetch()(), len(self.data))
+        self.assertEqual(self.read(), self.data)
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        f = self.get_fetch(hashtypes=['sha1'])
+        self.assertEqual(f(), len(self.data))
+        self.assertEqual(self.read(), self.data)
+        self.assertEqual(f.get_checksums(),
+                         {'sha1': hashlib.sha1(self.data).hexdigest()})
+        self.assertFalse(os.path.exists(f.state_path))
+        # The response to the first request is used.
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_failed_segment(self):
+        segments = fetch.split_segments(len(self.data), 4)
+        self.server.broken.add(segments[2][0])
+        f = self.get_fetch(retries=1)
+        self.assertRaises(IOError, f)
+        self.assertEqual(f.get_done(), len(self.data) - (
+            segments[2][1] - segments[2][0] + 1))
+        # Requested again once.
+        starts = [r for r, if_range in self.server.requests
+                  if r.startswith('bytes=%d-' % segments[2][0])]
+        self.assertEqual(len(starts), 2)
+
+        self.server.broken.clear()
+        f = self.get_fetch()
+        self.assertEqual(f(), segments[2][1] - segments[2][0] + 1)
+        self.assertEqual(self.read(), self.data)
+
+    def test_changed_while_fetched(self):
+        # The file changes after the first request.
+        new_data = os.urandom(len(self.data))
+        self.server.changes[2] = new_data
+        f = self.get_fetch(retries=1, hashtypes=['sha1'])
+        self.assertEqual(f(), len(new_data))
+        self.assertEqual(f.restarts, 1)
+        self.assertEqual(self.read(), new_data)
+        self.assertEqual(f.get_checksums(),
+                         {'sha1': hashlib.sha1(new_data).hexdigest()})
+
+    def test_changed_without_retries(self):
+        self.server.changes[2] = os.urandom(len(self.data))
+        self.assertRaises(fetch.FileChanged, self.get_fetch())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_empty_file(self):
+        self.server.data = ''
+        self.assertEqual(self.get_fetch()(), 0)
+        self.assertEqual(self.read(), '')
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Tests of appfy.recipe.importgraph."""
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from appfy.recipe import importgraph
+
+
+class TestHelpers(unittest.TestCase):
+
+    def test_get_module_name(self):
+        join = os.path.join
+        self.assertEqual(importgraph.get_module_name('a.py'), 'a')
+        self.assertEqual(importgraph.get_module_name(join('pkg', 'b.pyc')),
+                         'pkg.b')
+        self.assertEqual(importgraph.get_module_name(
+            join('pkg', '__init__.py')), 'pkg')
+        self.assertEqual(importgraph.get_module_name(join('pkg', 'c.so')),
+                         'pkg.c')
+        self.assertEqual(importgraph.get_module_name('README.txt'), None)
+        self.assertEqual(importgraph.get_module_name(
+            join('pkg-1.0', 'a.py')), None)
+        self.assertEqual(importgraph.get_module_name('__init__.py'), None)
+
+    def test_find_imports(self):
+        source = '\n'.join([
+            'import os, a.b',
+            'from c import d, e',
+            'from . import f',
+            'from ..g import h',
+            'def load():',
+            '    __import__("i")',
+            '    importlib.import_module("j.k")',
+            '    __import__(name)',
+        ])
+        self.assertEqual(sorted(importgraph.find_imports(source)), [
+            ('', ('f',), 1),
+            ('a.b', (), 0),
+            ('c', ('d', 'e'), 0),
+            ('g', ('h',), 2),
+            ('i', (), 0),
+            ('j.k', (), 0),
+            ('os', (), 0),
+        ])
+
+    def test_get_app_yaml_scripts(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'app.yaml')
+            f = open(filename, 'w')
+            f.write('\n'.join([
+                'handlers:',
+                '- url: /cgi',
+                '  script: cgi/main.py',
+                '- url: /.*',
+                "  script: 'main.app'  # WSGI",
+                '- url: /remote',
+                '  script: $PYTHON_LIB/google/remote_api.py',
+            ]))
+            f.close()
+            self.assertEqual(importgraph.get_app_yaml_scripts(filename),
+                             ['cgi.main', 'main'])
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestImportGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.lib = os.path.join(self.tmp, 'lib')
+        self.app = os.path.join(self.tmp, 'app')
+        os.makedirs(self.app)
+        self.modules = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def add(self, name, source, package=False, root=None):
+        parts = name.split('.')
+        if package:
+            parts.append('__init__')
+
+        path = os.path.join(root or self.lib, *parts) + '.py'
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        f = open(path, 'w')
+        f.write(source)
+        f.close()
+        if root is None:
+            self.modules[name] = path
+
+    def walk(self, names, allow=()):
+        graph = importgraph.ImportGraph(self.modules, [self.app])
+        return graph.walk(names, allow)
+
+    def test_walk(self):
+        self.add('main', 'import pkg.used\nfrom other import *\n',
+                 root=self.app)
+        self.add('pkg', 'from . import helper\n', package=True)
+        self.add('pkg.used', 'from .sub import thing\n')
+        self.add('pkg.helper', '')
+        self.add('pkg.sub', 'import os\n', package=True)
+        self.add('pkg.sub.thing', '')
+        self.add('pkg.unused', 'import pkg.used\n')
+        self.add('other', '', package=True)
+        self.add('other.a', '')
+        self.add('unused', 'import pkg\n')
+        self.assertEqual(self.walk(['main']), set([
+            'main', 'pkg', 'pkg.used', 'pkg.helper', 'pkg.sub',
+            'pkg.sub.thing', 'other', 'other.a']))
+
+    def test_implicit_relative_import(self):
+        self.add('pkg', 'import sibling\n', package=True)
+        self.add('pkg.sibling', '')
+        self.assertEqual(self.walk(['pkg']), set(['pkg', 'pkg.sibling']))
+
+    def test_allow(self):
+        self.add('plugins', '', package=True)
+        self.add('plugins.a', 'import dep\n')
+        self.add('dep', '')
+        self.add('unused', '')
+        self.assertEqual(self.walk([], allow=['plugins.*']),
+                         set(['plugins', 'plugins.a', 'dep']))
+
+    def test_syntax_error(self):
+        self.add('bad', 'import dep\ndef f(:\n')
+        self.add('dep', '')
+        graph = importgraph.ImportGraph(self.modules)
+        self.assertEqual(graph.walk(['bad']), set(['bad']))
+        self.assertTrue('bad' in graph.errors)
+
+    def test_zipped_module(self):
+        egg = os.path.join(self.tmp, 'pkg.egg')
+        z = zipfile.ZipFile(egg, 'w')
+        z.writestr('pkg/__init__.py', 'import dep\n')
+        z.close()
+        self.modules['pkg'] = os.path.join(egg, 'pkg', '__init__.py')
+        self.add('dep', '')
+        self.assertEqual(self.walk(['pkg']), set(['pkg', 'dep']))
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""Tests of the file tree functions of appfy.recipe."""
+import fnmatch
+import imp
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from appfy import recipe
+
+
+class TestPatternMatcher(unittest.TestCase):
+
+    patterns = ('*.pyc', '*/tests', 'pkg/sub?/*.txt', '*[0-9].cfg',
+                '*/.svn', 'docs')
+
+    paths = ('a.pyc', 'pkg/mod.pyc', 'pkg/mod.py', 'pkg/tests',
+             'pkg/tests/test_a.py', 'tests', 'pkg/sub1/a.txt',
+             'pkg/sub12/a.txt', 'pkg/sub/a.txt', 'setup1.cfg', 'setup.cfg',
+             'pkg/.svn', 'docs', 'pkg/docs', 'a.pyc.bak', 'A.PYC')
+
+    def test_like_fnmatch(self):
+        matcher = recipe.PatternMatcher(self.patterns)
+        for path in self.paths:
+            expected = [pattern for pattern in self.patterns
+                        if fnmatch.fnmatch(path, pattern)] != []
+            self.assertEqual(matcher.match(path), expected, path)
+
+    def test_no_patterns(self):
+        matcher = recipe.PatternMatcher([])
+        self.assertFalse(matcher.match('a.pyc'))
+        self.assertEqual(matcher('pkg', ['a.pyc']), set())
+
+    def test_special_characters(self):
+        matcher = recipe.PatternMatcher(['a+b(1).txt', '[!a]*.py'])
+        self.assertTrue(matcher.match('a+b(1).txt'))
+        self.assertFalse(matcher.match('aab1.txt'))
+        self.assertTrue(matcher.match('b.py'))
+        self.assertFalse(matcher.match('a.py'))
+
+    def test_ignore_names(self):
+        ignore = recipe.ignore_patterns(*self.patterns)
+        path = os.path.join('pkg', 'sub1')
+        self.assertEqual(ignore(path, ['a.txt', 'b.py', 'c.pyc']),
+                         set([os.path.join(path, 'a.txt'),
+                              os.path.join(path, 'c.pyc')]))
+
+    def test_matchers_are_cached(self):
+        self.assertTrue(recipe.ignore_patterns('*.pyc', '*.txt') is
+                        recipe.ignore_patterns('*.pyc', '*.txt'))
+        self.assertFalse(recipe.ignore_patterns('*.pyc') is
+                         recipe.ignore_patterns('*.txt'))
+
+
+class TestRmfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_rmfiles(self):
+        for relname in ('a.py', 'a.pyc', 'sub/b.pyc', 'sub/b.py',
+                        'sub/tests/c.py'):
+            path = os.path.join(self.tmp, *relname.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+        recipe.rmfiles(self.tmp, only=recipe.include_patterns(
+            '*.pyc', '*/tests'))
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['a.py', 'sub'])
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'sub')),
+                         ['b.py'])
+
+
+class TestSyncFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        self.write('pkg/__init__.py', '')
+        self.write('pkg/a.py', 'a = 1\n')
+        self.write('pkg/sub/b.py', 'b = 1\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, relname, content):
+        path = os.path.join(self.src, *relname.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+
+    def sync(self, manifest):
+        files = list(recipe.iter_files(os.path.join(self.src, 'pkg'),
+                                       self.src + os.sep))
+        return recipe.sync_files(files, self.dst, manifest)
+
+    def dst_stat(self, relname):
+        return os.stat(os.path.join(self.dst, *relname.split('/')))
+
+    def read(self, relname):
+        f = open(os.path.join(self.dst, *relname.split('/')))
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_unchanged(self):
+        manifest = self.sync({})
+        before = self.dst_stat('pkg/a.py')
+        self.assertEqual(self.sync(manifest), manifest)
+        after = self.dst_stat('pkg/a.py')
+        self.assertEqual(after.st_ino, before.st_ino)
+        self.assertEqual(after.st_mtime, before.st_mtime)
+
+    def test_touched(self):
+        manifest = self.sync({})
+        before = self.dst_stat('pkg/a.py')
+        # Same content with a new mtime is checked by hash, not copied.
+        os.utime(os.path.join(self.src, 'pkg', 'a.py'), (1, 1))
+        self.sync(manifest)
+        self.assertEqual(self.dst_stat('pkg/a.py').st_ino, before.st_ino)
+
+    def test_changed(self):
+        manifest = self.sync({})
+        before = self.dst_stat('pkg/a.py')
+        self.write('pkg/a.py', 'a = 2\n')
+        manifest = self.sync(manifest)
+        self.assertEqual(self.read('pkg/a.py'), 'a = 2\n')
+        self.assertNotEqual(self.dst_stat('pkg/a.py').st_ino, before.st_ino)
+        self.assertEqual(manifest['pkg/a.py'.replace('/', os.sep)]['size'],
+                         6)
+
+    def test_removed(self):
+        manifest = self.sync({})
+        bytecode = os.path.join(self.dst, 'pkg', 'sub', 'b.pyc')
+        open(bytecode, 'w').close()
+        os.remove(os.path.join(self.src, 'pkg', 'sub', 'b.py'))
+        os.rmdir(os.path.join(self.src, 'pkg', 'sub'))
+        manifest = self.sync(manifest)
+        # The removed module, its bytecode and its empty dir are removed.
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'pkg', 'sub')))
+        self.assertEqual(sorted(manifest), [os.path.join('pkg', '__init__.py'),
+                                            os.path.join('pkg', 'a.py')])
+        self.assertEqual(self.read('pkg/a.py'), 'a = 1\n')
+
+    def test_changed_in_destination(self):
+        manifest = self.sync({})
+        f = open(os.path.join(self.dst, 'pkg', 'a.py'), 'w')
+        f.write('# edited by hand\n')
+        f.close()
+        self.sync(manifest)
+        self.assertEqual(self.read('pkg/a.py'), 'a = 1\n')
+
+
+class TestZipFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.files = []
+        for i in range(20):
+            relname = os.path.join('pkg', 'mod%02d.py' % i)
+            self.write(relname, 'value = %r\n' % ('x' * i * 100))
+            self.files.append((os.path.join(self.tmp, 'src', relname),
+                               relname))
+
+        # Members are sorted in the zip.
+        self.files.reverse()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, relname, content):
+        path = os.path.join(self.tmp, 'src', relname)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+
+    def build(self, name, **kwargs):
+        path = os.path.join(self.tmp, name)
+        recipe.zipfiles(self.files, path, data={'README.txt': 'Hi.'},
+                        **kwargs)
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_reproducible(self):
+        data = self.build('a.zip')
+        # Times of the sources are not stored.
+        os.utime(self.files[0][0], (1, 1))
+        self.assertEqual(self.build('b.zip'), data)
+        self.assertEqual(self.build('c.zip', workers=4), data)
+        self.assertEqual(self.build('d.zip', previous=os.path.join(
+            self.tmp, 'a.zip')), data)
+
+    def test_reuse_previous(self):
+        self.build('a.zip')
+        self.write(os.path.join('pkg', 'mod03.py'), 'changed = True\n')
+        data = self.build('b.zip')
+        self.assertEqual(self.build('c.zip', previous=os.path.join(
+            self.tmp, 'a.zip'), workers=4), data)
+        z = zipfile.ZipFile(os.path.join(self.tmp, 'c.zip'))
+        self.assertEqual(z.read('pkg/mod03.py'), 'changed = True\n')
+        self.assertEqual(z.testzip(), None)
+        z.close()
+
+    def test_members(self):
+        self.build('a.zip')
+        z = zipfile.ZipFile(os.path.join(self.tmp, 'a.zip'))
+        names = z.namelist()
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len(names), 21)
+        for info in z.infolist():
+            self.assertEqual(info.date_time, recipe.ZIP_DATE_TIME)
+            self.assertEqual(info.external_attr >> 16, stat.S_IFREG | 0o644)
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+        z.close()
+
+
+class TestCompileFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'mod.py')
+        f = open(self.source, 'w')
+        f.write('"""Docs."""\ndebug = True\nassert not debug\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def load(self, cfile):
+        # A new module each time: load_compiled() reuses loaded modules.
+        sys.modules.pop('mod', None)
+        try:
+            return imp.load_compiled('mod', cfile)
+        finally:
+            sys.modules.pop('mod', None)
+
+    def compile(self, cfile, optimize=0):
+        return recipe.compile_files([(self.source, cfile, 'lib/mod.py', None)],
+                                    optimize=optimize)
+
+    def test_compile(self):
+        cfile = self.source + 'c'
+        self.assertEqual(self.compile(cfile), (1, []))
+        # Compiled without -O: the assert is kept.
+        self.assertRaises(AssertionError, self.load, cfile)
+        # Up to date.
+        self.assertEqual(self.compile(cfile), (0, []))
+
+    def test_optimize(self):
+        cfile = self.source + 'o'
+        self.assertEqual(self.compile(cfile, optimize=2), (1, []))
+        module = self.load(cfile)
+        self.assertEqual(module.__doc__, None)
+        self.assertEqual(module.debug, True)
+
+        os.remove(cfile)
+        self.assertEqual(self.compile(cfile, optimize=1), (1, []))
+        self.assertEqual(self.load(cfile).__doc__, 'Docs.')
+
+    def test_errors(self):
+        f = open(self.source, 'w')
+        f.write('def f(:\n')
+        f.close()
+        compiled, errors = self.compile(self.source + 'c')
+        self.assertEqual(compiled, 0)
+        self.assertEqual([source for source, error in errors], [self.source])
+        self.assertFalse(os.path.exists(self.source + 'c'))
+
+    def test_zipped_source(self):
+        archive = os.path.join(self.tmp, 'lib.zip')
+        z = zipfile.ZipFile(archive, 'w')
+        z.write(self.source, 'pkg/mod.py')
+        z.close()
+        cfile = os.path.join(self.tmp, 'mod.pyo')
+        self.assertEqual(recipe.compile_files(
+            [(os.path.join(archive, 'pkg', 'mod.py'), cfile, 'mod.py', 0)],
+            optimize=1), (1, []))
+        module = self.load(cfile)
+        self.assertEqual(module.__doc__, 'Docs.')
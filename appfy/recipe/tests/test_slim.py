@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Tests of appfy.recipe.slim."""
+import os
+import shutil
+import tempfile
+import tokenize
+import unittest
+
+from appfy.recipe import slim
+
+SOURCE = '''#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2015 Someone. Licensed under the Apache License.
+"""Module docstring,
+in two lines."""
+import os  # A comment.
+
+SEPARATOR = '-'
+
+
+def join(names):
+    """Function docstring."""
+    # Explain.
+    return SEPARATOR.join(names)
+
+
+class A(object):
+    """Only a docstring."""
+
+
+def fail():
+    raise ValueError(
+        'message')
+'''
+
+
+class TestSlimSource(unittest.TestCase):
+
+    def test_slim_source(self):
+        result = slim.slim_source(SOURCE)
+        lines = result.splitlines()
+        # Line numbers are kept.
+        self.assertEqual(len(lines), len(SOURCE.splitlines()))
+        self.assertEqual(lines[0], '#!/usr/bin/env python')
+        self.assertEqual(lines[1], '# -*- coding: utf-8 -*-')
+        self.assertTrue('Copyright 2015' in lines[2])
+        self.assertEqual(lines[3], "''")
+        self.assertEqual(lines[5], 'import os')
+        self.assertEqual(lines[11], "    ''")
+        self.assertEqual(lines[12], '')
+        self.assertEqual(lines[13], '    return SEPARATOR.join(names)')
+        self.assertFalse('docstring' in result)
+        self.assertTrue("'message'" in result)
+
+    def test_still_valid(self):
+        namespace = {}
+        exec compile(slim.slim_source(SOURCE), '<slim>', 'exec') in namespace
+        self.assertEqual(namespace['join'](['a', 'b']), 'a-b')
+        self.assertEqual(namespace['A'].__doc__, '')
+
+    def test_tracebacks_lines(self):
+        original = compile(SOURCE, '<original>', 'exec')
+        slimmed = compile(slim.slim_source(SOURCE), '<slim>', 'exec')
+        lines = []
+        for code in (original, slimmed):
+            namespace = {}
+            exec code in namespace
+            lines.append(namespace['fail'].func_code.co_firstlineno)
+
+        self.assertEqual(lines[0], lines[1])
+
+    def test_license_docstring_kept(self):
+        source = '"""Licensed under the MIT license."""\nx = 1\n'
+        self.assertEqual(slim.slim_source(source), source)
+
+    def test_string_expressions_kept(self):
+        source = "x = 1\n'-'.join(['a'])\n"
+        self.assertEqual(slim.slim_source(source), source)
+
+    def test_invalid_source(self):
+        self.assertRaises(tokenize.TokenError, slim.slim_source,
+                          'def f():\n    """')
+
+
+class TestSlimFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+        return path
+
+    def test_cached(self):
+        srcname = self.write('a.py', SOURCE)
+        path, size, new_size, error = slim.slim_file((srcname,
+                                                      self.cache_dir))
+        self.assertEqual(error, None)
+        self.assertEqual(size, len(SOURCE))
+        self.assertEqual(new_size, os.path.getsize(path))
+        self.assertTrue(new_size < size)
+
+        # Same content in another file.
+        other = self.write('b.py', SOURCE)
+        self.assertEqual(slim.slim_file((other, self.cache_dir)),
+                         (path, size, new_size, None))
+
+    def test_invalid_source_copied(self):
+        content = 'def f(:\n    """Doc."""\n'
+        srcname = self.write('a.py', content)
+        path, size, new_size, error = slim.slim_file((srcname,
+                                                      self.cache_dir))
+        self.assertTrue(error.startswith('TokenError'))
+        self.assertEqual(open(path).read(), content)
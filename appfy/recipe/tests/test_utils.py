@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Tests of appfy.recipe.utils."""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+
+from appfy.recipe import utils
+
+
+class TestZipPaths(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.egg = os.path.join(self.tmp, 'pkg-1.0.egg')
+        z = zipfile.ZipFile(self.egg, 'w')
+        z.writestr('pkg/__init__.py', 'x = 1\n')
+        z.writestr('pkg/sub/mod.py', 'y = 2\n')
+        z.close()
+
+    def tearDown(self):
+        utils.close_zip_files()
+        shutil.rmtree(self.tmp)
+
+    def test_split_zip_path(self):
+        path = os.path.join(self.egg, 'pkg', 'sub', 'mod.py')
+        self.assertEqual(utils.split_zip_path(path),
+                         (self.egg, 'pkg/sub/mod.py'))
+        # Also once the zip file is open.
+        utils.get_zip_file(self.egg)
+        self.assertEqual(utils.split_zip_path(path),
+                         (self.egg, 'pkg/sub/mod.py'))
+
+    def test_split_regular_paths(self):
+        self.assertEqual(utils.split_zip_path(self.egg), None)
+        self.assertEqual(utils.split_zip_path(self.tmp), None)
+        # Not a zip file.
+        path = os.path.join(self.tmp, 'a.txt')
+        open(path, 'w').close()
+        self.assertEqual(utils.split_zip_path(os.path.join(path, 'b')),
+                         None)
+
+    def test_split_missing_paths(self):
+        # Stops at the root.
+        self.assertEqual(utils.split_zip_path(
+            os.path.join(self.tmp, 'missing', 'a.py')), None)
+        self.assertEqual(utils.split_zip_path(
+            os.path.join(os.sep, 'missing-appfy-test', 'a.py')), None)
+        self.assertEqual(utils.split_zip_path(
+            os.path.join('missing-appfy-test', 'a.py')), None)
+
+    def test_open_and_stat(self):
+        path = os.path.join(self.egg, 'pkg', '__init__.py')
+        f = utils.open_file(path)
+        try:
+            self.assertEqual(f.read(), 'x = 1\n')
+        finally:
+            f.close()
+
+        self.assertEqual(utils.stat_file(path).st_size, 6)
+        self.assertRaises(IOError, utils.stat_file,
+                          os.path.join(self.egg, 'pkg', 'missing.py'))
+        self.assertRaises(OSError, utils.stat_file,
+                          os.path.join(self.tmp, 'missing.py'))
+        self.assertRaises(IOError, utils.open_file,
+                          os.path.join(self.tmp, 'missing.py'))
+
+    def test_stat_before_open(self):
+        path = os.path.join(self.egg, 'pkg', 'sub', 'mod.py')
+        self.assertEqual(utils.stat_file(path).st_size, 6)
+
+    def test_split_without_check(self):
+        path = os.path.join(self.egg, 'pkg', '__init__.py')
+        self.assertEqual(utils.split_zip_path(path, check=False), None)
+        utils.get_zip_file(self.egg)
+        self.assertEqual(utils.split_zip_path(path, check=False),
+                         (self.egg, 'pkg/__init__.py'))
+
+    def test_close_zip_files(self):
+        z = utils.get_zip_file(self.egg)
+        self.assertTrue(utils.get_zip_file(self.egg) is z)
+        utils.close_zip_files()
+        self.assertEqual(z.fp, None)
+        self.assertFalse(utils.get_zip_file(self.egg) is z)
+
+
+class TestChecksums(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'file.zip')
+        self.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, data):
+        f = open(self.path, 'wb')
+        f.write(data)
+        f.close()
+
+    def test_get_checksums(self):
+        self.assertEqual(utils.get_checksums(self.path, ['md5', 'sha1']), {
+            'md5': hashlib.md5('data').hexdigest(),
+            'sha1': hashlib.sha1('data').hexdigest(),
+        })
+        self.assertFalse(os.path.exists(utils.get_checksums_path(self.path)))
+        self.assertEqual(utils.get_checksums(
+            os.path.join(self.tmp, 'missing'), ['md5']), None)
+
+    def test_recorded(self):
+        checksums = utils.get_checksums(self.path, ['sha1'], cache=True)
+        self.assertEqual(utils.read_checksums(self.path), checksums)
+        # Recorded checksums are used, without reading the file.
+        utils.write_checksums(self.path, {'sha1': 'recorded'})
+        self.assertEqual(utils.get_checksums(self.path, ['sha1'],
+                                             cache=True),
+                         {'sha1': 'recorded'})
+
+    def test_missing_hash_type(self):
+        utils.get_checksums(self.path, ['sha1'], cache=True)
+        self.assertEqual(utils.get_checksums(self.path, ['md5', 'sha1'],
+                                             cache=True), {
+            'md5': hashlib.md5('data').hexdigest(),
+            'sha1': hashlib.sha1('data').hexdigest(),
+        })
+
+    def test_changed_file(self):
+        utils.write_checksums(self.path, {'sha1': 'recorded'})
+        st = os.stat(self.path)
+        self.write('other')
+        os.utime(self.path, (st.st_atime, st.st_mtime))
+        # The size changed.
+        self.assertEqual(utils.read_checksums(self.path), {})
+
+        utils.write_checksums(self.path, {'sha1': 'recorded'})
+        os.utime(self.path, (time.time(), st.st_mtime + 10))
+        self.assertEqual(utils.read_checksums(self.path), {})
+        self.assertEqual(utils.get_checksums(self.path, ['sha1'],
+                                             cache=True),
+                         {'sha1': hashlib.sha1('other').hexdigest()})
+
+    def test_replaced_file(self):
+        utils.write_checksums(self.path, {'sha1': 'recorded'})
+        st = os.stat(self.path)
+        # Same size and mtime, but another inode.
+        other = self.path + '.new'
+        shutil.copy2(self.path, other)
+        os.rename(other, self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime))
+        self.assertEqual(utils.read_checksums(self.path), {})
+
+    def test_remove_checksums(self):
+        utils.write_checksums(self.path, {'sha1': 'recorded'})
+        utils.remove_checksums(self.path)
+        self.assertFalse(os.path.exists(utils.get_checksums_path(self.path)))
+        utils.remove_checksums(self.path)
+
+
+class TestInstallFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'eggs', 'pkg-1.0.egg', 'pkg',
+                                'mod.py')
+        os.makedirs(os.path.dirname(self.src))
+        f = open(self.src, 'w')
+        f.write('x = 1\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_relative_symlink(self):
+        dst = os.path.join(self.tmp, 'app', 'distlib', 'pkg', 'mod.py')
+        os.makedirs(os.path.dirname(dst))
+        self.assertTrue(utils.install_file(self.src, dst, 'symlink'))
+        self.assertEqual(os.readlink(dst), os.path.join(
+            '..', '..', '..', 'eggs', 'pkg-1.0.egg', 'pkg', 'mod.py'))
+
+        # Still works after moving the project.
+        moved = self.tmp + '.moved'
+        os.rename(self.tmp, moved)
+        self.tmp = moved
+        f = open(os.path.join(moved, 'app', 'distlib', 'pkg', 'mod.py'))
+        self.assertEqual(f.read(), 'x = 1\n')
+        f.close()
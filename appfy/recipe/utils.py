@@ -1,21 +1,66 @@
+import errno
 import hashlib
+import json
+from multiprocessing import pool
 import os
+import shutil
+import stat
+import threading
+import time
+import zipfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        # Backport of os.scandir() for Python 2, if installed.
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 TRUE_VALUES = ('yes', 'true', '1', 'on')
 
+INSTALL_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+
+HASH_TYPES = ('md5', 'sha1', 'sha256', 'sha512')
+
+# Chunks read to compute the checksums of large files.
+CHECKSUM_CHUNK_SIZE = 2 ** 20
+
+# ioctl to share the data blocks of a file (Linux, on btrfs, xfs...).
+FICLONE = 0x40049409
+
+# Zip files opened by get_zip_file(), keyed by path.
+_zip_files = {}
+_zip_files_lock = threading.Lock()
+
 
 def get_bool_option(option):
     return option.strip().lower() in TRUE_VALUES
 
 
-def get_checksum(path, hashtype='sha1'):
-    if not os.path.isfile(path):
+def get_checksum(path, hashtype='sha1', cache=False):
+    """Returns the checksum of a file, or None if it can't be read.
+
+    If `cache` is true, the checksum recorded by get_checksums() is used.
+    """
+    if cache:
+        checksums = get_checksums(path, [hashtype], cache=True)
+        return checksums and checksums[hashtype]
+
+    try:
+        f = open_file(path)
+    except (IOError, OSError):
         return None
 
     func = getattr(hashlib, hashtype)
     checksum = func()
 
-    f = open(path, 'rb')
     try:
         chunk = f.read(2**16)
         while chunk:
@@ -25,3 +70,524 @@ def get_checksum(path, hashtype='sha1'):
         return checksum.hexdigest()
     finally:
         f.close()
+
+
+def get_checksums(path, hashtypes, cache=False):
+    """Returns the checksums of a file for each of `hashtypes`, by hash type.
+
+    The file is read once, in large chunks that update all the checksums.
+    Returns None if the file can't be read.
+
+    If `cache` is true, the checksums are recorded beside the file, and not
+    computed again while its size, modification time and inode don't change.
+    """
+    cache = cache and split_zip_path(path) is None
+    recorded = {}
+    if cache:
+        try:
+            key = get_file_key(os.stat(path))
+        except OSError:
+            return None
+
+        recorded = read_checksums(path, key)
+        if not [hashtype for hashtype in hashtypes
+                if hashtype not in recorded]:
+            return dict((hashtype, recorded[hashtype])
+                        for hashtype in hashtypes)
+
+    try:
+        f = open_file(path)
+    except (IOError, OSError):
+        return None
+
+    checksums = [(hashtype, getattr(hashlib, hashtype)())
+                 for hashtype in hashtypes]
+    try:
+        chunk = f.read(CHECKSUM_CHUNK_SIZE)
+        while chunk:
+            for hashtype, checksum in checksums:
+                checksum.update(chunk)
+
+            chunk = f.read(CHECKSUM_CHUNK_SIZE)
+    finally:
+        f.close()
+
+    checksums = dict((hashtype, checksum.hexdigest())
+                     for hashtype, checksum in checksums)
+    if cache:
+        recorded.update(checksums)
+        write_checksums(path, recorded, key)
+
+    return checksums
+
+
+def get_checksums_path(path):
+    """Returns the path of the checksums recorded for a file."""
+    return path + '.checksums.json'
+
+
+def get_file_key(st):
+    """Returns what identifies a version of a file, from its stat result."""
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+def read_checksums(path, key=None):
+    """Returns the checksums recorded for a file, by hash type.
+
+    They are ignored if the file changed since they were recorded: then, an
+    empty dict is returned. `key` is the get_file_key() of the file, if
+    known.
+    """
+    record = read_manifest(get_checksums_path(path))
+    if not record:
+        return {}
+
+    if key is None:
+        try:
+            key = get_file_key(os.stat(path))
+        except OSError:
+            return {}
+
+    if record.get('file') != key:
+        return {}
+
+    return record.get('checksums', {})
+
+
+def write_checksums(path, checksums, key=None):
+    """Records the checksums of a file, by hash type.
+
+    `key` is the get_file_key() of the file when they were computed, if
+    known, so that changes made while computing them are detected.
+    """
+    try:
+        if key is None:
+            key = get_file_key(os.stat(path))
+
+        write_manifest(get_checksums_path(path), {
+            'file': key,
+            'checksums': checksums,
+        })
+    except (IOError, OSError):
+        # The record only saves time, e.g. a read-only download cache.
+        pass
+
+
+def remove_checksums(path):
+    """Removes the checksums recorded for a file, if any."""
+    if os.path.exists(get_checksums_path(path)):
+        os.remove(get_checksums_path(path))
+
+
+def copy_file(src, dst, hashtype='sha1'):
+    """Copies a file with its permission bits and times.
+
+    Returns the checksum of the copied data, computed while copying, or None
+    if `hashtype` is None.
+    """
+    checksum = None
+    if hashtype is not None:
+        checksum = getattr(hashlib, hashtype)()
+
+    fsrc = open_file(src)
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            chunk = fsrc.read(2**16)
+            while chunk:
+                if checksum is not None:
+                    checksum.update(chunk)
+                fdst.write(chunk)
+                chunk = fsrc.read(2**16)
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+    if split_zip_path(src, check=False) is None:
+        # Zip files are opened by open_file().
+        shutil.copystat(src, dst)
+    else:
+        st = stat_file(src)
+        os.utime(dst, (st.st_atime, st.st_mtime))
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+
+    if checksum is not None:
+        return checksum.hexdigest()
+
+
+def install_file(src, dst, mode='copy'):
+    """Installs a file by copying or linking it, according to `mode`.
+
+    Returns True if the file was linked. If linking is not possible, e.g.
+    across devices or in platforms without support for it, the file is
+    copied instead and False is returned. Files inside zip files are always
+    copied.
+    """
+    # Other links to a file in a zip file that isn't open yet just fail.
+    check = mode == 'symlink'
+    if mode != 'copy' and split_zip_path(src, check=check) is not None:
+        mode = 'copy'
+
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return True
+        elif mode == 'symlink':
+            os.symlink(get_link_target(src, dst), dst)
+            return True
+        elif mode == 'reflink' and fcntl is not None:
+            reflink(src, dst)
+            return True
+    except (AttributeError, IOError, OSError):
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+    copy_file(src, dst, hashtype=None)
+    return False
+
+
+def get_link_target(src, dst):
+    """Returns the path of `src` relative to the directory of `dst`.
+
+    Relative links keep working when the directories of both files are
+    moved together. Absolute paths are used if `src` is in another drive.
+    """
+    src = os.path.abspath(src)
+    try:
+        return os.path.relpath(src, os.path.dirname(os.path.abspath(dst)))
+    except ValueError:
+        return src
+
+
+def split_zip_path(path, check=True):
+    """Splits a path to a file inside a zip file, like zipimport paths.
+
+    Returns the zip file path and the member name, or None if `path` is not
+    inside a zip file. If `check` is false, only the zip files opened by
+    get_zip_file() are considered, without checking the file system.
+    """
+    for archive in list(_zip_files):
+        if path.startswith(archive + os.sep):
+            return archive, path[len(archive) + len(os.sep):].replace(
+                os.sep, '/')
+
+    if not check or os.path.exists(path):
+        return None
+
+    archive = os.path.dirname(path)
+    while not os.path.isfile(archive):
+        dirname = os.path.dirname(archive)
+        if dirname == archive:
+            return None
+
+        archive = dirname
+
+    if archive not in _zip_files and not zipfile.is_zipfile(archive):
+        return None
+
+    return archive, path[len(archive) + len(os.sep):].replace(os.sep, '/')
+
+
+def get_zip_file(path):
+    """Returns a ZipFile to read `path`, opened once and shared."""
+    _zip_files_lock.acquire()
+    try:
+        z = _zip_files.get(path)
+        if z is None:
+            z = _zip_files[path] = zipfile.ZipFile(path, 'r')
+
+        return z
+    finally:
+        _zip_files_lock.release()
+
+
+def close_zip_files():
+    """Closes the zip files opened by get_zip_file()."""
+    _zip_files_lock.acquire()
+    try:
+        for z in _zip_files.values():
+            z.close()
+
+        _zip_files.clear()
+    finally:
+        _zip_files_lock.release()
+
+
+def get_zip_info(archive, name):
+    """Returns the ZipInfo of a file inside a zip file."""
+    try:
+        return get_zip_file(archive).getinfo(name)
+    except KeyError:
+        raise IOError(errno.ENOENT, 'No such file in zip file',
+                      os.path.join(archive, name))
+
+
+def get_missing_zip_path(path, error):
+    """Returns split_zip_path() for a file that could not be found.
+
+    Regular files are read without checking if they are in a zip file
+    first, so this is only done when they are missing. Raises `error` if
+    `path` is not in a zip file either.
+    """
+    if error.errno in (errno.ENOENT, errno.ENOTDIR):
+        zip_path = split_zip_path(path)
+        if zip_path is not None:
+            return zip_path
+
+    raise error
+
+
+def open_file(path):
+    """Opens a file to read binary data, even if it is inside a zip file.
+
+    Files inside zip files are decompressed while they are read.
+    """
+    zip_path = split_zip_path(path, check=False)
+    if zip_path is None:
+        try:
+            return open(path, 'rb')
+        except IOError as e:
+            zip_path = get_missing_zip_path(path, e)
+
+    return get_zip_file(zip_path[0]).open(get_zip_info(*zip_path))
+
+
+def stat_file(path):
+    """Like os.stat(), but also for files inside a zip file.
+
+    For these, the size, permission bits and date stored in the zip file are
+    returned.
+    """
+    zip_path = split_zip_path(path, check=False)
+    if zip_path is None:
+        try:
+            return os.stat(path)
+        except OSError as e:
+            zip_path = get_missing_zip_path(path, e)
+
+    info = get_zip_info(*zip_path)
+    mode = stat.S_IMODE(info.external_attr >> 16) or 0644
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    return os.stat_result((stat.S_IFREG | mode, 0, 0, 1, 0, 0,
+                           info.file_size, mtime, mtime, mtime))
+
+
+def reflink(src, dst):
+    """Creates `dst` as a copy-on-write clone of `src`."""
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+    shutil.copystat(src, dst)
+
+
+def rename(src, dst):
+    """Renames a file, replacing `dst` if it exists."""
+    if os.name == 'nt' and os.path.exists(dst):
+        # Windows doesn't allow renaming over an existing file.
+        os.remove(dst)
+
+    os.rename(src, dst)
+
+
+def get_size(path):
+    """Returns the size of a file, or the total size of a directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, dirs, files in walk(path, followlinks=False):
+        for entry in files:
+            size += entry.stat().st_size
+
+    return size
+
+
+class DirEntry(object):
+    """A directory entry like the ones returned by os.scandir().
+
+    Used when scandir is not available. The type of the entry is read with
+    a single lstat() call, cached for all the other methods.
+    """
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._lstat = None
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+
+        if not follow_symlinks or not stat.S_ISLNK(self._lstat.st_mode):
+            return self._lstat
+
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+
+        return self._stat
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            # Broken symlink.
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def scandir(path):
+    """Returns the entries of a directory, as a list.
+
+    Uses os.scandir() or the scandir package if available, which know the
+    type of most entries without calling stat(); otherwise each entry calls
+    lstat() once, when its type is first needed.
+    """
+    if _scandir is not None:
+        return list(_scandir(path))
+
+    return [DirEntry(path, name) for name in os.listdir(path)]
+
+
+def walk(top, dirname='', ignore=None, followlinks=True, onerror=None):
+    """Yields the ``(dirpath, dirs, files)`` of a directory tree.
+
+    Like os.walk(), but `dirs` and `files` are lists of scandir() entries,
+    so each file is stat()ed at most once no matter how many times its type
+    or size is checked. Entries removed from `dirs` are not visited.
+
+    The optional ignore argument has the same meaning as in
+    recipe.copytree(), with paths relative to `dirname`; ignored entries are
+    not listed. Symlinks to directories are listed in `dirs` and only
+    visited if `followlinks` is true. Errors listing a directory are passed
+    to `onerror`, if given, or raised.
+    """
+    try:
+        entries = scandir(top)
+    except OSError as err:
+        if onerror is None:
+            raise
+
+        onerror(err)
+        return
+
+    if ignore is not None:
+        ignored_names = ignore(top[len(dirname):],
+                               [entry.name for entry in entries])
+        if ignored_names:
+            entries = [entry for entry in entries
+                       if entry.path[len(dirname):] not in ignored_names]
+
+    dirs = []
+    files = []
+    for entry in entries:
+        if entry.is_dir():
+            dirs.append(entry)
+        else:
+            files.append(entry)
+
+    yield top, dirs, files
+
+    for entry in dirs:
+        if followlinks or not entry.is_symlink():
+            for item in walk(entry.path, dirname, ignore, followlinks,
+                             onerror):
+                yield item
+
+
+def read_manifest(path):
+    """Returns the manifest saved in `path`, or an empty dict."""
+    if not os.path.isfile(path):
+        return {}
+
+    f = open(path, 'r')
+    try:
+        return json.load(f)
+    except ValueError:
+        # Corrupted manifest: start again from scratch.
+        return {}
+    finally:
+        f.close()
+
+
+def write_manifest(path, manifest):
+    """Saves a manifest to `path`, replacing it in a single step."""
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    f = open(path + '.tmp', 'w')
+    try:
+        json.dump(manifest, f)
+    finally:
+        f.close()
+
+    rename(path + '.tmp', path)
+
+
+def map_threads(func, items, workers=1):
+    """Like map(), but splits the calls across `workers` threads."""
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    threads = pool.ThreadPool(min(workers, len(items)))
+    try:
+        return threads.map(func, items)
+    finally:
+        threads.close()
+        threads.join()
+
+
+def map_processes(func, items, workers=1):
+    """Like map(), but splits the calls across `workers` processes.
+
+    For CPU bound functions; `func` must be a module function, and the items
+    and results must be picklable.
+    """
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    processes = pool.Pool(min(workers, len(items)))
+    try:
+        return processes.map(func, items)
+    finally:
+        processes.close()
+        processes.join()
+
+
+def imap_threads(func, items, workers=1):
+    """Like map(), but yields the results in order as soon as they are ready.
+
+    Calls are split across `workers` threads.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+
+        return
+
+    threads = pool.ThreadPool(workers)
+    try:
+        for result in threads.imap(func, items):
+            yield result
+
+        threads.close()
+    finally:
+        threads.terminate()
+        threads.join()
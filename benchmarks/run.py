@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the file tree functions and recipes of appfy.recipe.
+
+Builds synthetic eggs in a temporary directory and times each benchmark,
+all offline: downloads are served by a local HTTP server. Results can be
+saved and compared with a previous run::
+
+    python benchmarks/run.py --output=before.json
+    # ...change something...
+    python benchmarks/run.py --compare=before.json --threshold=0.1
+
+With --compare, the exit status is 1 if a benchmark got slower than the
+threshold allows.
+"""
+import json
+import logging
+import optparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+
+from appfy import recipe  # noqa
+from appfy.recipe import utils  # noqa
+import server  # noqa
+import trees  # noqa
+
+
+class Environment(object):
+    """Synthetic eggs and a scratch directory shared by the benchmarks."""
+
+    def __init__(self, root, options):
+        self.root = root
+        self.options = options
+        self.eggs = trees.make_eggs(
+            os.path.join(root, 'eggs'), eggs=options.eggs,
+            files=options.files, depth=options.depth, size=options.size)
+        self.zipped_eggs = trees.make_eggs(
+            os.path.join(root, 'zipped-eggs'), eggs=options.eggs,
+            files=options.files, depth=options.depth, size=options.size,
+            zipped=True)
+        self.globs = trees.make_globs(options.globs)
+        self.count = 0
+        self.server = None
+
+    def get_packages(self, eggs=None):
+        """Returns the (egg, package dir) of each egg."""
+        return [(egg, os.path.join(egg, 'package%d' % i))
+                for i, egg in enumerate(eggs or self.eggs)]
+
+    def get_files(self):
+        """Returns the paths of all files in the eggs."""
+        files = []
+        for egg in self.eggs:
+            for root, dirs, names in os.walk(egg):
+                files.extend(os.path.join(root, name) for name in names)
+
+        return files
+
+    def mkdtemp(self):
+        """Returns a new empty directory."""
+        self.count += 1
+        path = os.path.join(self.root, 'run%d' % self.count)
+        os.makedirs(path)
+        return path
+
+    def get_archive_url(self):
+        """Returns the URL of a zip with all the eggs, served locally."""
+        if self.server is None:
+            served = os.path.join(self.root, 'served')
+            os.makedirs(served)
+            trees.make_archive(os.path.join(self.root, 'eggs'),
+                               os.path.join(served, 'eggs.zip'))
+            self.server = server.FileServer(served)
+
+        return self.server.get_url('eggs.zip')
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+def bench_copytree(env):
+    dst = env.mkdtemp()
+    ignore = recipe.ignore_patterns(*env.globs)
+    start = time.time()
+    for egg, package in env.get_packages():
+        recipe.copytree(package, os.path.join(dst, os.path.basename(package)),
+                        egg + os.sep, ignore=ignore)
+
+    return time.time() - start
+
+
+def bench_ignore_patterns(env):
+    listing = []
+    for egg, package in env.get_packages():
+        for root, dirs, names in os.walk(package):
+            listing.append((root[len(egg) + 1:], dirs + names))
+
+    start = time.time()
+    # Compiled again each time, as done for each recipe section.
+    recipe._matchers.clear()
+    ignore = recipe.ignore_patterns(*env.globs)
+    for path, names in listing:
+        ignore(path, names)
+
+    return time.time() - start
+
+
+def bench_rmfiles(env):
+    dst = env.mkdtemp()
+    for egg, package in env.get_packages():
+        shutil.copytree(package, os.path.join(dst, os.path.basename(package)))
+
+    only = recipe.include_patterns('*.pyc', '*.txt')
+    start = time.time()
+    recipe.rmfiles(dst, only=only)
+    return time.time() - start
+
+
+def bench_zipdir(env):
+    dst = env.mkdtemp()
+    start = time.time()
+    for i, egg in enumerate(env.eggs):
+        recipe.zipdir(egg, os.path.join(dst, 'egg%d.zip' % i))
+
+    return time.time() - start
+
+
+def bench_get_checksum(env):
+    files = env.get_files()
+    start = time.time()
+    for filename in files:
+        utils.get_checksum(filename)
+
+    return time.time() - start
+
+
+def run_app_lib(env, eggs=None, runs=1, **opts):
+    """Runs app_lib like buildout does, `runs` times in the same dirs.
+
+    Returns the time of the last run.
+    """
+    from appfy.recipe.gae import app_lib
+
+    class WorkingSet(object):
+        entries = eggs or env.eggs
+
+    root = env.mkdtemp()
+    buildout = {'buildout': {
+        'eggs-directory': os.path.join(env.root, 'eggs'),
+        'develop-eggs-directory': os.path.join(root, 'develop-eggs'),
+        'parts-directory': os.path.join(root, 'parts'),
+        'bin-directory': os.path.join(root, 'bin'),
+        'directory': root,
+        'find-links': '',
+        'allow-hosts': '*',
+        'python': 'buildout',
+        'executable': sys.executable,
+        'offline': 'true',
+    }}
+    for name in ('develop-eggs', 'parts', 'bin'):
+        os.makedirs(os.path.join(root, name))
+
+    options = {
+        'lib-directory': os.path.join(root, 'app', 'distlib'),
+        'ignore-globs': '\n'.join(env.globs),
+        'delete-safe': 'false',
+    }
+    options.update(opts)
+    os.makedirs(os.path.join(root, 'app'))
+
+    for i in range(runs):
+        lib = app_lib.Recipe(buildout, 'app_lib', dict(options))
+        start = time.time()
+        lib.install_in_app_dir(lib.get_package_paths(WorkingSet()))
+        elapsed = time.time() - start
+        # Like install(), but the old libraries are removed out of the time.
+        lib.wait_delete_libs()
+
+    return elapsed
+
+
+def bench_app_lib(env):
+    return run_app_lib(env)
+
+
+def bench_app_lib_zip(env):
+    return run_app_lib(env, **{'use-zipimport': 'true'})
+
+
+def bench_app_lib_incremental(env):
+    # Time a build without changes, after a first one.
+    return run_app_lib(env, runs=2, incremental='true')
+
+
+def bench_app_lib_zipped_eggs(env):
+    return run_app_lib(env, eggs=env.zipped_eggs)
+
+
+def run_download(env, **opts):
+    """Runs the download recipe on the served zip, with an empty cache.
+
+    Returns the time of the install.
+    """
+    from appfy.recipe import download
+
+    url = env.get_archive_url()
+    root = env.mkdtemp()
+    buildout = {'buildout': {
+        'directory': root,
+        'parts-directory': os.path.join(root, 'parts'),
+        'download-cache': os.path.join(root, 'downloads'),
+    }}
+    for name in ('parts', 'downloads'):
+        os.makedirs(os.path.join(root, name))
+
+    options = {
+        'url': url,
+        'download-segments': '4',
+    }
+    options.update(opts)
+
+    part = download.Recipe(buildout, 'download', options)
+    start = time.time()
+    part.install()
+    return time.time() - start
+
+
+def bench_download(env):
+    return run_download(env, **{'download-only': 'true'})
+
+
+def bench_download_extract(env):
+    # Extracted while it is downloaded.
+    return run_download(env, **{'stream-extract': 'true'})
+
+
+BENCHMARKS = [
+    ('copytree', bench_copytree),
+    ('ignore_patterns', bench_ignore_patterns),
+    ('rmfiles', bench_rmfiles),
+    ('zipdir', bench_zipdir),
+    ('get_checksum', bench_get_checksum),
+    ('app_lib', bench_app_lib),
+    ('app_lib-zip', bench_app_lib_zip),
+    ('app_lib-incremental', bench_app_lib_incremental),
+    ('app_lib-zipped-eggs', bench_app_lib_zipped_eggs),
+    ('download', bench_download),
+    ('download-extract', bench_download_extract),
+]
+
+
+def run_benchmarks(env, names, repeat):
+    """Runs each benchmark `repeat` times and returns their timings."""
+    results = {}
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        runs = sorted(func(env) for i in range(repeat))
+        results[name] = {
+            'min': runs[0],
+            'median': runs[len(runs) // 2],
+            'runs': runs,
+        }
+        sys.stdout.write('%-24s min %8.4fs  median %8.4fs\n' % (
+            name, runs[0], runs[len(runs) // 2]))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the change of each benchmark against `baseline`.
+
+    Returns the names of the benchmarks that got slower than `threshold`,
+    a fraction of the baseline time.
+    """
+    regressions = []
+    row = '%-24s %10s %10s %8s'
+    sys.stdout.write(row % ('Benchmark', 'Before', 'After', 'Change') + '\n')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        before = baseline[name]['min']
+        after = results[name]['min']
+        change = (after - before) / max(before, 1e-9)
+        mark = ''
+        if change > threshold:
+            regressions.append(name)
+            mark = '  REGRESSION'
+
+        sys.stdout.write(row % (name, '%.4f' % before, '%.4f' % after,
+                                '%+.1f%%' % (change * 100)) + mark + '\n')
+
+    return regressions
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [BENCHMARK...]',
+                                   description=__doc__.split('\n\n')[0])
+    parser.add_option('--eggs', type='int', default=5,
+                      help='Number of eggs. Default: 5.')
+    parser.add_option('--files', type='int', default=500,
+                      help='Number of files in each egg. Default: 500.')
+    parser.add_option('--depth', type='int', default=3,
+                      help='Maximum depth of the packages. Default: 3.')
+    parser.add_option('--size', type='int', default=2048,
+                      help='Median file size, in bytes. Default: 2048.')
+    parser.add_option('--globs', type='int', default=10,
+                      help='Number of ignore globs. Default: 10.')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='Runs of each benchmark. Default: 5.')
+    parser.add_option('--output', default=None,
+                      help='Save the results to this JSON file.')
+    parser.add_option('--compare', default=None,
+                      help='Compare the results with this JSON file.')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='Slowdown allowed by --compare, as a fraction. '
+                           'Default: 0.1.')
+    parser.add_option('--verbose', action='store_true', default=False,
+                      help='Show the log of the recipes.')
+    options, names = parser.parse_args(argv)
+
+    unknown = set(names) - set(name for name, func in BENCHMARKS)
+    if unknown:
+        parser.error('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+
+    logging.basicConfig(
+        level=logging.INFO if options.verbose else logging.WARNING)
+
+    root = tempfile.mkdtemp(prefix='appfy-benchmarks-')
+    try:
+        env = Environment(root, options)
+        try:
+            results = run_benchmarks(env, names, options.repeat)
+        finally:
+            env.close()
+    finally:
+        shutil.rmtree(root)
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'shape': {
+                    'eggs': options.eggs,
+                    'files': options.files,
+                    'depth': options.depth,
+                    'size': options.size,
+                    'globs': options.globs,
+                },
+                'benchmarks': results,
+            }, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.compare:
+        f = open(options.compare, 'r')
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+
+        if baseline.get('shape') != json.loads(json.dumps({
+                'eggs': options.eggs, 'files': options.files,
+                'depth': options.depth, 'size': options.size,
+                'globs': options.globs})):
+            sys.stdout.write('Warning: the baseline was run with a '
+                             'different shape.\n')
+
+        if compare(results, baseline['benchmarks'], options.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""A local HTTP file server for the download benchmarks.
+
+Serves the files of a directory with support for ranged requests, like the
+servers that the download recipe fetches from in segments.
+"""
+import BaseHTTPServer
+import os
+import re
+import SimpleHTTPServer
+import SocketServer
+import threading
+
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class RangeHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves files, answering `Range: bytes=start-end` requests with 206."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def translate_path(self, path):
+        # Serve the server root instead of the current directory.
+        return os.path.join(self.server.root, path.split('?')[0].lstrip('/'))
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = RANGE_RE.match(self.headers.getheader('Range') or '')
+        if match is not None:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+
+            if start >= size:
+                self.send_error(416, 'Requested range not satisfiable')
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+
+        st = os.stat(path)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"%x-%x"' % (st.st_size, int(st.st_mtime)))
+        self.send_header('Last-Modified',
+                         self.date_time_string(int(st.st_mtime)))
+        self.end_headers()
+
+        f = open(path, 'rb')
+        try:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, 2 ** 16))
+                if not chunk:
+                    break
+
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        finally:
+            f.close()
+
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the files in `root` from a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, root):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           RangeHandler)
+        self.root = root
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_url(self, filename):
+        """Returns the URL of a file in `root`."""
+        return 'http://%s:%d/%s' % (self.server_address[0],
+                                    self.server_address[1], filename)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
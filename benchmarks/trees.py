@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Synthetic egg trees and archives used by the benchmarks."""
+import os
+import random
+import shutil
+import zipfile
+
+# Words used to fill files with text that compresses like source code.
+WORDS = (
+    'def', 'class', 'return', 'import', 'self', 'if', 'else', 'for', 'in',
+    'None', 'True', 'False', 'value', 'name', 'path', 'result', '=', '(',
+    ')', ':', '.', ',', '\n', '\n    ', '\n        ', '#', 'data', 'key',
+)
+
+# Extensions of the generated files, with their weight.
+EXTENSIONS = (('.py', 6), ('.pyc', 2), ('.txt', 1), ('.html', 1))
+
+
+def get_text(rnd, size=2**16):
+    """Returns random text made of WORDS."""
+    words = []
+    length = 0
+    while length < size:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+
+    return ' '.join(words)[:size]
+
+
+def get_sizes(rnd, count, size):
+    """Returns `count` file sizes with a log-normal distribution.
+
+    Most files are small and a few are large, like in real packages; the
+    median size is `size`.
+    """
+    return [max(int(rnd.lognormvariate(0, 1) * size), 0)
+            for i in range(count)]
+
+
+def make_tree(root, files=1000, depth=3, size=2048, seed=0):
+    """Creates a package with `files` files, up to `depth` levels deep.
+
+    Returns the total size of the files.
+    """
+    rnd = random.Random(seed)
+    text = get_text(rnd)
+    extensions = [ext for ext, weight in EXTENSIONS for i in range(weight)]
+
+    dirs = [root]
+    for i in range(max(files // 20, 1)):
+        parent = rnd.choice(dirs)
+        if len(os.path.relpath(parent, root).split(os.sep)) < depth:
+            dirs.append(os.path.join(parent, 'sub%d' % i))
+
+    for dirname in dirs:
+        os.makedirs(dirname)
+        f = open(os.path.join(dirname, '__init__.py'), 'w')
+        f.write('"""Package."""\n')
+        f.close()
+
+    total = 0
+    for i, file_size in enumerate(get_sizes(rnd, files, size)):
+        dirname = rnd.choice(dirs)
+        filename = os.path.join(dirname, 'm%d%s' % (i, rnd.choice(extensions)))
+        start = rnd.randint(0, len(text) - 1)
+        content = (text[start:] + text) * (file_size // len(text) + 1)
+        f = open(filename, 'w')
+        f.write(content[:file_size])
+        f.close()
+        total += file_size
+
+    return total
+
+
+def make_eggs(root, eggs=5, files=1000, depth=3, size=2048, zipped=False):
+    """Creates `eggs` eggs, each with one package of `files` files.
+
+    Returns the list of egg paths. If `zipped` is true, the eggs are zip
+    files.
+    """
+    paths = []
+    for i in range(eggs):
+        name = 'package%d' % i
+        egg = os.path.join(root, '%s-1.0-py2.7.egg' % name)
+        os.makedirs(os.path.join(egg, 'EGG-INFO'))
+        f = open(os.path.join(egg, 'EGG-INFO', 'top_level.txt'), 'w')
+        f.write(name + '\n')
+        f.close()
+
+        make_tree(os.path.join(egg, name), files=files, depth=depth,
+                  size=size, seed=i)
+        if zipped:
+            make_archive(egg, egg + '.zip')
+            shutil.rmtree(egg)
+            os.rename(egg + '.zip', egg)
+
+        paths.append(egg)
+
+    return paths
+
+
+def make_archive(dirname, filename):
+    """Creates a deflated zip file with the files inside `dirname`."""
+    z = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for root, dirs, names in os.walk(dirname):
+            for name in names:
+                path = os.path.join(root, name)
+                z.write(path, os.path.relpath(path, dirname))
+    finally:
+        z.close()
+
+
+def make_globs(count):
+    """Returns `count` ignore globs; most of them don't match any file."""
+    globs = ['*.pyc', '*/sub1']
+    for i in range(count - len(globs)):
+        globs.append('*/unused%d/*.ext%d' % (i, i))
+
+    return globs[:count]
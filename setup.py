@@ -77,6 +77,9 @@ setuptools.setup(
             'sdk = appfy.recipe.gae.sdk:Recipe',
             'app_lib = appfy.recipe.gae.app_lib:Recipe',
         ],
+        'zc.buildout.uninstall': [
+            'sdk = appfy.recipe.download:uninstall',
+        ],
     },
     zip_safe=False,
     keywords=('buildout recipe google app engine appengine gae zc.buildout '